@@ -38,6 +38,7 @@
 #include "idle-muc-manager.h"
 #include "idle-roomlist-manager.h"
 #include "idle-parser.h"
+#include "idle-presence.h"
 #include "idle-server-connection.h"
 #include "server-tls-manager.h"
 
@@ -54,6 +55,12 @@
 #define MSG_QUEUE_TIMEOUT 2
 static gboolean flush_queue_faster = FALSE;
 
+/* Replies to CTCP requests come out of a bucket of CTCP_REPLY_BURST tokens,
+ * refilled at one per CTCP_REPLY_INTERVAL, so that a CTCP flood can't fill
+ * the message queue with replies and hold up everything else */
+#define CTCP_REPLY_BURST 3
+#define CTCP_REPLY_INTERVAL 10 /* sec */
+
 #define SERVER_CMD_MIN_PRIORITY 0
 #define SERVER_CMD_NORMAL_PRIORITY G_MAXUINT/2
 #define SERVER_CMD_MAX_PRIORITY G_MAXUINT
@@ -72,13 +79,14 @@ G_DEFINE_TYPE_WITH_CODE(IdleConnection, idle_connection, TP_TYPE_BASE_CONNECTION
 		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CONNECTION_INTERFACE_CONTACT_INFO, idle_contact_info_iface_init);
 		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CONNECTION_INTERFACE_RENAMING, _renaming_iface_init);
 		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CONNECTION_INTERFACE_CONTACTS, tp_contacts_mixin_iface_init);
+		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CONNECTION_INTERFACE_SIMPLE_PRESENCE, idle_presence_iface_init);
 		G_IMPLEMENT_INTERFACE(IDLE_TYPE_SVC_CONNECTION_INTERFACE_IRC_COMMAND1, irc_command_iface_init);
 );
 
 typedef struct _IdleOutputPendingMsg IdleOutputPendingMsg;
 
 struct _IdleOutputPendingMsg {
-	gchar *message;
+	GBytes *message;
 	guint priority;
 	guint64 id;
 };
@@ -86,7 +94,7 @@ struct _IdleOutputPendingMsg {
 /* Steals @message. */
 static IdleOutputPendingMsg *
 idle_output_pending_msg_new (
-    gchar *message,
+    GBytes *message,
     guint priority)
 {
 	IdleOutputPendingMsg *msg = g_slice_new(IdleOutputPendingMsg);
@@ -103,10 +111,41 @@ static void idle_output_pending_msg_free(IdleOutputPendingMsg *msg) {
 	if (!msg)
 		return;
 
-	g_free(msg->message);
+	g_bytes_unref(msg->message);
 	g_slice_free(IdleOutputPendingMsg, msg);
 }
 
+/* Messages at SERVER_CMD_NORMAL_PRIORITY are queued per target, which is the
+ * first parameter of the command (usually a channel or a nick), and the
+ * targets take turns. A long paste to one channel thus can't hold up what is
+ * being sent to the others. */
+typedef struct _IdleOutputTarget IdleOutputTarget;
+
+struct _IdleOutputTarget {
+	gchar *name;
+	GQueue messages;
+};
+
+static IdleOutputTarget *idle_output_target_new(const gchar *name) {
+	IdleOutputTarget *target = g_slice_new0(IdleOutputTarget);
+
+	target->name = g_strdup(name);
+	g_queue_init(&target->messages);
+
+	return target;
+}
+
+static void idle_output_target_free(gpointer data) {
+	IdleOutputTarget *target = data;
+	IdleOutputPendingMsg *msg;
+
+	while ((msg = g_queue_pop_head(&target->messages)) != NULL)
+		idle_output_pending_msg_free(msg);
+
+	g_free(target->name);
+	g_slice_free(IdleOutputTarget, target);
+}
+
 static gint pending_msg_compare(gconstpointer a, gconstpointer b, gpointer unused) {
 	const IdleOutputPendingMsg *msg1 = a, *msg2 = b;
 
@@ -123,6 +162,7 @@ enum {
 	PROP_NICKNAME = 1,
 	PROP_SERVER,
 	PROP_PORT,
+	PROP_FALLBACK_SERVERS,
 	PROP_PASSWORD,
 	PROP_REALNAME,
 	PROP_USERNAME,
@@ -131,6 +171,13 @@ enum {
 	PROP_QUITMESSAGE,
 	PROP_USE_SSL,
 	PROP_PASSWORD_PROMPT,
+	PROP_MAX_PENDING_MESSAGES,
+	PROP_MAX_PENDING_BYTES,
+	PROP_PENDING_RESUME_PERCENT,
+	PROP_MAX_PENDING_IN_MEMORY,
+	PROP_SENDER_FLOOD_LIMIT,
+	PROP_IM_CHANNEL_THRESHOLD,
+	PROP_UNREAD_TIMEOUT,
 	LAST_PROPERTY_ENUM
 };
 
@@ -157,6 +204,7 @@ struct _IdleConnectionPrivate {
 	char *nickname;
 	char *server;
 	guint port;
+	gchar **fallback_servers;
 	char *password;
 	char *realname;
 	char *username;
@@ -165,6 +213,25 @@ struct _IdleConnectionPrivate {
 	char *quit_message;
 	gboolean use_ssl;
 	gboolean password_prompt;
+	guint max_pending_messages;
+	guint max_pending_bytes;
+	/* how far, as a percentage of the limits, pending messages must fall
+	 * before reading resumes */
+	guint pending_resume_percent;
+	guint max_pending_in_memory;
+	guint sender_flood_limit;
+	guint im_channel_threshold;
+	/* seconds */
+	guint unread_timeout;
+
+	/* received messages, and the bytes of text in them, which are waiting
+	 * in channels for a client to acknowledge them */
+	guint pending_messages;
+	gsize pending_bytes;
+
+	/* TRUE if we stopped reading from the server because too much is
+	 * pending; reading starts again once it has drained to half the limits */
+	gboolean reading_paused;
 
 	/* the string used by the a server as a prefix to any messages we send that
 	 * it relays to other users.  We need to know this so we can keep our sent
@@ -172,15 +239,35 @@ struct _IdleConnectionPrivate {
 	 * this prefix added */
 	char *relay_prefix;
 
-	/* output message queue */
+	/* output message queue, for messages not at normal priority */
 	GQueue *msg_queue;
 
+	/* normal priority messages: target name => IdleOutputTarget */
+	GHashTable *msg_targets;
+
+	/* the IdleOutputTargets with messages waiting, in the order they take
+	 * their turns */
+	GQueue *msg_target_turns;
+
+	/* commands which go out as soon as the connection is free, rather than
+	 * waiting for the next tick of the message queue */
+	GQueue *express_queue;
+
+	/* express commands sent since the last tick, each of which uses up a
+	 * tick's worth of flood allowance */
+	guint express_sent;
+
 	/* has it submitted a message for sending and waiting for acknowledgement */
 	gboolean msg_sending;
 
 	/* UNIX time the last message was sent on */
 	time_t last_msg_sent;
 
+	/* CTCP replies we may still send, and the monotonic time they were last
+	 * topped up */
+	guint ctcp_reply_tokens;
+	gint64 ctcp_reply_refilled;
+
 	/* GSource id for keep alive message timeout */
 	guint keepalive_timeout;
 
@@ -206,6 +293,9 @@ struct _IdleConnectionPrivate {
 
 	/* TpHandle -> owned gchar * */
 	GHashTable *aliases;
+
+	/* RPL_ISUPPORT token name -> owned value, "" for tokens without one */
+	GHashTable *isupport;
 };
 
 static void _iface_create_handle_repos(TpBaseConnection *self, TpHandleRepoIface **repos);
@@ -217,6 +307,7 @@ static gboolean _iface_start_connecting(TpBaseConnection *self, GError **error);
 
 static IdleParserHandlerResult _error_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
 static IdleParserHandlerResult _erroneous_nickname_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
+static IdleParserHandlerResult _isupport_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
 static IdleParserHandlerResult _nick_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
 static IdleParserHandlerResult _nickname_in_use_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
 static IdleParserHandlerResult _ping_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
@@ -227,7 +318,7 @@ static IdleParserHandlerResult _welcome_handler(IdleParser *parser, IdleParserMe
 static IdleParserHandlerResult _whois_user_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
 
 static void sconn_disconnected_cb(IdleServerConnection *sconn, IdleServerConnectionStateReason reason, IdleConnection *conn);
-static void sconn_received_cb(IdleServerConnection *sconn, gchar *raw_msg, IdleConnection *conn);
+static void sconn_received_cb(IdleServerConnection *sconn, const gchar *raw_msg, gpointer user_data);
 
 static void irc_handshakes(IdleConnection *conn);
 static void send_quit_request(IdleConnection *conn);
@@ -240,6 +331,7 @@ static void idle_connection_add_queue_timeout (IdleConnection *self);
 static void idle_connection_clear_queue_timeout (IdleConnection *self);
 
 static void _send_with_priority(IdleConnection *conn, const gchar *msg, guint priority);
+static void _flush_express_queue(IdleConnection *conn);
 static void conn_aliasing_fill_contact_attributes (
     GObject *obj,
     const GArray *contacts,
@@ -251,7 +343,11 @@ static void idle_connection_init(IdleConnection *obj) {
 	obj->priv = priv;
 	priv->sconn_connected = FALSE;
 	priv->msg_queue = g_queue_new();
+	priv->msg_targets = g_hash_table_new_full(g_str_hash, g_str_equal, NULL, idle_output_target_free);
+	priv->msg_target_turns = g_queue_new();
+	priv->express_queue = g_queue_new();
 	priv->aliases = g_hash_table_new_full (NULL, NULL, NULL, g_free);
+	priv->isupport = g_hash_table_new_full(g_str_hash, g_str_equal, g_free, g_free);
 
 	tp_contacts_mixin_init ((GObject *) obj, G_STRUCT_OFFSET (IdleConnection, contacts));
 	tp_base_connection_register_with_contacts_mixin ((TpBaseConnection *) obj);
@@ -264,6 +360,7 @@ idle_connection_constructed (GObject *object)
 
   self->parser = g_object_new (IDLE_TYPE_PARSER, "connection", self, NULL);
   idle_contact_info_init (self);
+  idle_presence_init (self);
   tp_contacts_mixin_add_contact_attributes_iface (object,
       TP_IFACE_CONNECTION_INTERFACE_ALIASING,
       conn_aliasing_fill_contact_attributes);
@@ -288,6 +385,11 @@ static void idle_connection_set_property(GObject *obj, guint prop_id, const GVal
 			priv->port = g_value_get_uint(value);
 			break;
 
+		case PROP_FALLBACK_SERVERS:
+			g_strfreev(priv->fallback_servers);
+			priv->fallback_servers = g_value_dup_boxed(value);
+			break;
+
 		case PROP_PASSWORD:
 			g_free(priv->password);
 			priv->password = g_value_dup_string(value);
@@ -325,6 +427,34 @@ static void idle_connection_set_property(GObject *obj, guint prop_id, const GVal
 			priv->password_prompt = g_value_get_boolean(value);
 			break;
 
+		case PROP_MAX_PENDING_MESSAGES:
+			priv->max_pending_messages = g_value_get_uint(value);
+			break;
+
+		case PROP_MAX_PENDING_BYTES:
+			priv->max_pending_bytes = g_value_get_uint(value);
+			break;
+
+		case PROP_PENDING_RESUME_PERCENT:
+			priv->pending_resume_percent = g_value_get_uint(value);
+			break;
+
+		case PROP_MAX_PENDING_IN_MEMORY:
+			priv->max_pending_in_memory = g_value_get_uint(value);
+			break;
+
+		case PROP_SENDER_FLOOD_LIMIT:
+			priv->sender_flood_limit = g_value_get_uint(value);
+			break;
+
+		case PROP_IM_CHANNEL_THRESHOLD:
+			priv->im_channel_threshold = g_value_get_uint(value);
+			break;
+
+		case PROP_UNREAD_TIMEOUT:
+			priv->unread_timeout = g_value_get_uint(value);
+			break;
+
 		default:
 			G_OBJECT_WARN_INVALID_PROPERTY_ID(obj, prop_id, pspec);
 			break;
@@ -348,6 +478,10 @@ static void idle_connection_get_property(GObject *obj, guint prop_id, GValue *va
 			g_value_set_uint(value, priv->port);
 			break;
 
+		case PROP_FALLBACK_SERVERS:
+			g_value_set_boxed(value, priv->fallback_servers);
+			break;
+
 		case PROP_PASSWORD:
 			g_value_set_string(value, priv->password);
 			break;
@@ -380,6 +514,34 @@ static void idle_connection_get_property(GObject *obj, guint prop_id, GValue *va
 			g_value_set_boolean(value, priv->password_prompt);
 			break;
 
+		case PROP_MAX_PENDING_MESSAGES:
+			g_value_set_uint(value, priv->max_pending_messages);
+			break;
+
+		case PROP_MAX_PENDING_BYTES:
+			g_value_set_uint(value, priv->max_pending_bytes);
+			break;
+
+		case PROP_PENDING_RESUME_PERCENT:
+			g_value_set_uint(value, priv->pending_resume_percent);
+			break;
+
+		case PROP_MAX_PENDING_IN_MEMORY:
+			g_value_set_uint(value, priv->max_pending_in_memory);
+			break;
+
+		case PROP_SENDER_FLOOD_LIMIT:
+			g_value_set_uint(value, priv->sender_flood_limit);
+			break;
+
+		case PROP_IM_CHANNEL_THRESHOLD:
+			g_value_set_uint(value, priv->im_channel_threshold);
+			break;
+
+		case PROP_UNREAD_TIMEOUT:
+			g_value_set_uint(value, priv->unread_timeout);
+			break;
+
 		default:
 			G_OBJECT_WARN_INVALID_PROPERTY_ID(obj, prop_id, pspec);
 			break;
@@ -404,6 +566,7 @@ static void idle_connection_dispose (GObject *object) {
 		g_source_remove(priv->msg_queue_timeout);
 
 	if (priv->conn != NULL) {
+		idle_server_connection_set_received_func(priv->conn, NULL, NULL);
 		g_object_unref(priv->conn);
 		priv->conn = NULL;
 	}
@@ -419,6 +582,7 @@ static void idle_connection_dispose (GObject *object) {
 	g_object_unref(self->parser);
 
 	tp_clear_pointer (&priv->aliases, g_hash_table_unref);
+	tp_clear_pointer (&priv->isupport, g_hash_table_unref);
 
 	if (G_OBJECT_CLASS(idle_connection_parent_class)->dispose)
 		G_OBJECT_CLASS(idle_connection_parent_class)->dispose (object);
@@ -430,9 +594,11 @@ static void idle_connection_finalize (GObject *object) {
 	IdleOutputPendingMsg *msg;
 
 	idle_contact_info_finalize(object);
+	idle_presence_finalize(object);
 
 	g_free(priv->nickname);
 	g_free(priv->server);
+	g_strfreev(priv->fallback_servers);
 	g_free(priv->password);
 	g_free(priv->realname);
 	g_free(priv->username);
@@ -444,6 +610,13 @@ static void idle_connection_finalize (GObject *object) {
 		idle_output_pending_msg_free(msg);
 
 	g_queue_free(priv->msg_queue);
+
+	while ((msg = g_queue_pop_head(priv->express_queue)) != NULL)
+		idle_output_pending_msg_free(msg);
+
+	g_queue_free(priv->express_queue);
+	g_queue_free(priv->msg_target_turns);
+	g_hash_table_unref(priv->msg_targets);
 	tp_contacts_mixin_finalize (object);
 
 	G_OBJECT_CLASS(idle_connection_parent_class)->finalize(object);
@@ -455,6 +628,7 @@ static const gchar * interfaces_always_present[] = {
 	TP_IFACE_CONNECTION_INTERFACE_RENAMING,
 	TP_IFACE_CONNECTION_INTERFACE_REQUESTS,
 	TP_IFACE_CONNECTION_INTERFACE_CONTACTS,
+	TP_IFACE_CONNECTION_INTERFACE_SIMPLE_PRESENCE,
 	NULL};
 
 const gchar * const *idle_connection_get_implemented_interfaces (void) {
@@ -509,6 +683,9 @@ static void idle_connection_class_init(IdleConnectionClass *klass) {
 	param_spec = g_param_spec_uint("port", "IRC server port", "The destination port used when establishing the connection.", 0, G_MAXUINT16, 0, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
 	g_object_class_install_property(object_class, PROP_PORT, param_spec);
 
+	param_spec = g_param_spec_boxed("fallback-servers", "Fallback IRC servers", "Further servers, as \"host[:port]\", to race against the main one when establishing the connection.", G_TYPE_STRV, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS);
+	g_object_class_install_property(object_class, PROP_FALLBACK_SERVERS, param_spec);
+
 	param_spec = g_param_spec_string("password", "Server password", "Password to authenticate to the server with", NULL, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS);
 	g_object_class_install_property(object_class, PROP_PASSWORD, param_spec);
 
@@ -533,8 +710,30 @@ static void idle_connection_class_init(IdleConnectionClass *klass) {
 	param_spec = g_param_spec_boolean("password-prompt", "Password prompt", "Whether the connection should pop up a SASL channel if no password is given", FALSE, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
 	g_object_class_install_property(object_class, PROP_PASSWORD_PROMPT, param_spec);
 
+	param_spec = g_param_spec_uint("max-pending-messages", "Maximum pending messages", "Stop reading from the server while this many received messages are unacknowledged, or 0 for no limit", 0, G_MAXUINT, 0, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
+	g_object_class_install_property(object_class, PROP_MAX_PENDING_MESSAGES, param_spec);
+
+	param_spec = g_param_spec_uint("max-pending-bytes", "Maximum pending bytes", "Stop reading from the server while this many bytes of received messages are unacknowledged, or 0 for no limit", 0, G_MAXUINT, 0, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
+	g_object_class_install_property(object_class, PROP_MAX_PENDING_BYTES, param_spec);
+
+	param_spec = g_param_spec_uint("pending-resume-percent", "Pending resume percentage", "Once reading has stopped because of max-pending-messages or max-pending-bytes, start again when what is pending falls to this percentage of both limits", 0, 100, 50, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
+	g_object_class_install_property(object_class, PROP_PENDING_RESUME_PERCENT, param_spec);
+
+	param_spec = g_param_spec_uint("max-pending-in-memory", "Maximum pending messages in memory", "Keep at most this many unacknowledged messages per channel in memory, and older ones on disk until a client asks for them, or 0 for no limit", 0, G_MAXUINT, 0, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
+	g_object_class_install_property(object_class, PROP_MAX_PENDING_IN_MEMORY, param_spec);
+
+	param_spec = g_param_spec_uint("sender-flood-limit", "Sender flood limit", "How many messages one contact may send to a channel or to us every two seconds before the rest are combined into one, or 0 for no limit", 0, G_MAXUINT, 0, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
+	g_object_class_install_property(object_class, PROP_SENDER_FLOOD_LIMIT, param_spec);
+
+	param_spec = g_param_spec_uint("im-channel-threshold", "IM channel threshold", "How many private messages a contact must send before a channel is announced for them, unless one is requested first; 0 or 1 to announce one straight away", 0, G_MAXUINT, 0, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
+	g_object_class_install_property(object_class, PROP_IM_CHANNEL_THRESHOLD, param_spec);
+
+	param_spec = g_param_spec_uint("unread-timeout", "Unread message timeout", "With im-channel-threshold above 1, how many seconds private messages nobody has read are kept without another arriving: those held back for want of a channel, and those in a channel which was closed without acknowledging them", 1, G_MAXUINT, 300, G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS | G_PARAM_CONSTRUCT);
+	g_object_class_install_property(object_class, PROP_UNREAD_TIMEOUT, param_spec);
+
 	tp_contacts_mixin_class_init (object_class, G_STRUCT_OFFSET (IdleConnectionClass, contacts));
 	idle_contact_info_class_init(klass);
+	idle_presence_class_init(klass);
 
 	/* This is a hack to make the test suite run in finite time. */
 	if (!tp_str_empty (g_getenv ("IDLE_HTFU")))
@@ -739,10 +938,12 @@ static void _connection_connect_ready(GObject *source_object, GAsyncResult *res,
 
 	priv->sconn_connected = TRUE;
 
-	g_signal_connect(sconn, "received", (GCallback)(sconn_received_cb), conn);
+	idle_server_connection_set_received_func(sconn, sconn_received_cb, conn);
+	_flush_express_queue(conn);
 
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_CMD_ERROR, _error_handler, conn);
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_ERRONEOUSNICKNAME, _erroneous_nickname_handler, conn);
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_ISUPPORT, _isupport_handler, conn);
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_NICKNAMEINUSE, _nickname_in_use_handler, conn);
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_WELCOME, _welcome_handler, conn);
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_WHOISUSER, _whois_user_handler, conn);
@@ -757,6 +958,60 @@ static void _connection_connect_ready(GObject *source_object, GAsyncResult *res,
 	irc_handshakes(conn);
 }
 
+static gboolean _pending_over(guint64 pending, guint limit) {
+	return limit != 0 && pending >= limit;
+}
+
+static gboolean _pending_drained(guint64 pending, guint limit, guint percent) {
+	return limit == 0 || pending * 100 <= (guint64) limit * percent;
+}
+
+/* Pauses reading from the server when too many received messages are waiting
+ * for clients, so that a flood fills the server's socket buffers rather than
+ * our memory, and resumes once enough of them have been acknowledged to get
+ * below pending-resume-percent of the limits. */
+static void _update_reading(IdleConnection *conn) {
+	IdleConnectionPrivate *priv = conn->priv;
+
+	if (priv->conn == NULL)
+		return;
+
+	if (!priv->reading_paused) {
+		if (_pending_over(priv->pending_messages, priv->max_pending_messages) ||
+		    _pending_over(priv->pending_bytes, priv->max_pending_bytes)) {
+			IDLE_DEBUG("%u messages (%" G_GSIZE_FORMAT " bytes) pending, pausing reads",
+				priv->pending_messages, priv->pending_bytes);
+			priv->reading_paused = TRUE;
+			idle_server_connection_pause_reading(priv->conn);
+		}
+	} else if (_pending_drained(priv->pending_messages, priv->max_pending_messages, priv->pending_resume_percent) &&
+	           _pending_drained(priv->pending_bytes, priv->max_pending_bytes, priv->pending_resume_percent)) {
+		IDLE_DEBUG("%u messages (%" G_GSIZE_FORMAT " bytes) pending, resuming reads",
+			priv->pending_messages, priv->pending_bytes);
+		priv->reading_paused = FALSE;
+		idle_server_connection_resume_reading(priv->conn);
+	}
+}
+
+/**
+ * idle_connection_update_pending:
+ * @conn: the connection
+ * @messages: the change in the number of received messages waiting in a
+ *            channel for a client to acknowledge them
+ * @bytes: the change in the size of those messages' text
+ */
+void idle_connection_update_pending(IdleConnection *conn, gint messages, gssize bytes) {
+	IdleConnectionPrivate *priv = conn->priv;
+
+	g_return_if_fail(messages >= 0 || priv->pending_messages >= (guint) -messages);
+	g_return_if_fail(bytes >= 0 || priv->pending_bytes >= (gsize) -bytes);
+
+	priv->pending_messages += messages;
+	priv->pending_bytes += bytes;
+
+	_update_reading(conn);
+}
+
 static void _start_connecting_continue(IdleConnection *conn) {
 	IdleConnectionPrivate *priv = conn->priv;
 	IdleServerConnection *sconn;
@@ -780,14 +1035,18 @@ static void _start_connecting_continue(IdleConnection *conn) {
 	sconn = g_object_new(IDLE_TYPE_SERVER_CONNECTION,
             "host", priv->server,
             "port", priv->port,
+            "fallback-servers", priv->fallback_servers,
             "tls-manager", priv->tls_manager,
             NULL);
 	if (priv->use_ssl)
 		idle_server_connection_set_tls(sconn, TRUE);
 
+	priv->reading_paused = FALSE;
+
 	g_signal_connect(sconn, "disconnected", (GCallback)(sconn_disconnected_cb), conn);
 
 	priv->conn = sconn;
+	_update_reading(conn);
 	g_warn_if_fail (priv->connect_cancellable == NULL);
 	priv->connect_cancellable = g_cancellable_new ();
 	idle_server_connection_connect_async(sconn, priv->connect_cancellable, _connection_connect_ready, conn);
@@ -795,6 +1054,66 @@ static void _start_connecting_continue(IdleConnection *conn) {
 
 static gboolean keepalive_timeout_cb(gpointer user_data);
 
+static gboolean _msg_queue_is_empty(IdleConnectionPrivate *priv) {
+	return g_queue_is_empty(priv->msg_queue) && g_queue_is_empty(priv->msg_target_turns);
+}
+
+/* Returns the first parameter of @cmd, or "" if it has none */
+static gchar *_msg_target_name(const gchar *cmd) {
+	const gchar *start = strchr(cmd, ' ');
+	const gchar *end;
+
+	if (start == NULL || *(++start) == ':')
+		return g_strdup("");
+
+	end = strchr(start, ' ');
+	if (end == NULL)
+		end = start + strlen(start);
+
+	return g_strndup(start, end - start);
+}
+
+static void _msg_queue_push(IdleConnectionPrivate *priv, IdleOutputPendingMsg *msg, const gchar *name) {
+	IdleOutputTarget *target;
+
+	if (msg->priority != SERVER_CMD_NORMAL_PRIORITY) {
+		g_queue_insert_sorted(priv->msg_queue, msg, pending_msg_compare, NULL);
+		return;
+	}
+
+	target = g_hash_table_lookup(priv->msg_targets, name);
+
+	if (target == NULL) {
+		target = idle_output_target_new(name);
+		g_hash_table_insert(priv->msg_targets, target->name, target);
+		g_queue_push_tail(priv->msg_target_turns, target);
+	}
+
+	g_queue_push_tail(&target->messages, msg);
+}
+
+static IdleOutputPendingMsg *_msg_queue_pop(IdleConnectionPrivate *priv) {
+	IdleOutputPendingMsg *msg = g_queue_peek_head(priv->msg_queue);
+	IdleOutputTarget *target;
+
+	if (msg != NULL && msg->priority > SERVER_CMD_NORMAL_PRIORITY)
+		return g_queue_pop_head(priv->msg_queue);
+
+	target = g_queue_pop_head(priv->msg_target_turns);
+	if (target == NULL)
+		return g_queue_pop_head(priv->msg_queue);
+
+	msg = g_queue_pop_head(&target->messages);
+
+	/* go to the back of the line if there is more to send */
+	if (g_queue_is_empty(&target->messages))
+		g_hash_table_remove(priv->msg_targets, target->name);
+	else
+		g_queue_push_tail(priv->msg_target_turns, target);
+
+	return msg;
+}
+
 static void sconn_disconnected_cb(IdleServerConnection *sconn, IdleServerConnectionStateReason reason, IdleConnection *conn) {
 	IdleConnectionPrivate *priv = conn->priv;
 	TpConnectionStatusReason tp_reason;
@@ -826,7 +1145,8 @@ static void sconn_disconnected_cb(IdleServerConnection *sconn, IdleServerConnect
 	connection_disconnect_cb(conn, tp_reason);
 }
 
-static void sconn_received_cb(IdleServerConnection *sconn, gchar *raw_msg, IdleConnection *conn) {
+static void sconn_received_cb(IdleServerConnection *sconn, const gchar *raw_msg, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
 	gchar *converted = idle_connection_ntoh(conn, raw_msg);
 	idle_parser_receive(conn->parser, converted);
 
@@ -863,7 +1183,7 @@ static gboolean keepalive_timeout_cb(gpointer user_data) {
 		return TRUE;
 	}
 
-	if (priv->msg_queue->length > 0) {
+	if (!_msg_queue_is_empty(priv)) {
 		/* No point in sending a PING if we're sending data anyway. */
 		return TRUE;
 	}
@@ -875,6 +1195,44 @@ static gboolean keepalive_timeout_cb(gpointer user_data) {
 	return TRUE;
 }
 
+static void _msg_queue_timeout_ready(GObject *source_object, GAsyncResult *res, gpointer user_data);
+
+/* Commands which the server is waiting on, and so can't sit behind the flood
+ * control. */
+static gboolean _is_express_command(const gchar *cmd) {
+	static const gchar * const express_commands[] = {"PONG", "QUIT", NULL};
+	gsize len = strcspn(cmd, " ");
+	const gchar * const *command;
+
+	for (command = express_commands; *command != NULL; command++) {
+		if (len == strlen(*command) && g_ascii_strncasecmp(cmd, *command, len) == 0)
+			return TRUE;
+	}
+
+	return FALSE;
+}
+
+static void _flush_express_queue(IdleConnection *conn) {
+	IdleConnectionPrivate *priv = conn->priv;
+	IdleOutputPendingMsg *output_msg;
+
+	if (!priv->sconn_connected || priv->msg_sending)
+		return;
+
+	output_msg = g_queue_pop_head(priv->express_queue);
+	if (output_msg == NULL)
+		return;
+
+	/* only count against the allowance while the queue is being drained;
+	 * otherwise last_msg_sent takes care of it */
+	if (priv->msg_queue_timeout != 0)
+		priv->express_sent++;
+
+	priv->msg_sending = TRUE;
+	idle_server_connection_send_async(priv->conn, output_msg->message, NULL, _msg_queue_timeout_ready, conn);
+	idle_output_pending_msg_free(output_msg);
+}
+
 static void _msg_queue_timeout_ready(GObject *source_object, GAsyncResult *res, gpointer user_data) {
 	IdleServerConnection *sconn = IDLE_SERVER_CONNECTION(source_object);
 	IdleConnection *conn = IDLE_CONNECTION (user_data);
@@ -890,6 +1248,7 @@ static void _msg_queue_timeout_ready(GObject *source_object, GAsyncResult *res,
 	}
 
 	priv->last_msg_sent = time(NULL);
+	_flush_express_queue(conn);
 }
 
 static gboolean msg_queue_timeout_cb(gpointer user_data) {
@@ -910,7 +1269,13 @@ static gboolean msg_queue_timeout_cb(gpointer user_data) {
 	if (priv->msg_sending)
 		return TRUE;
 
-	output_msg = g_queue_pop_head(priv->msg_queue);
+	/* an express command went out in this tick's place */
+	if (priv->express_sent > 0) {
+		priv->express_sent--;
+		return TRUE;
+	}
+
+	output_msg = _msg_queue_pop(priv);
 
 	if (output_msg == NULL) {
 		priv->msg_queue_timeout = 0;
@@ -933,6 +1298,8 @@ idle_connection_add_queue_timeout (IdleConnection *self)
     {
       time_t curr_time = time(NULL);
 
+      priv->express_sent = 0;
+
       if (flush_queue_faster)
         priv->msg_queue_timeout = g_timeout_add (MSG_QUEUE_TIMEOUT,
             msg_queue_timeout_cb, self);
@@ -965,42 +1332,106 @@ idle_connection_clear_queue_timeout (IdleConnection *self)
  */
 static void _send_with_priority(IdleConnection *conn, const gchar *msg, guint priority) {
 	IdleConnectionPrivate *priv = conn->priv;
-	gchar cmd[IRC_MSG_MAXLEN + 3];
-	int len;
-	gchar *converted;
+	gchar *cmd;
+	gsize len;
+	gchar *converted = NULL;
+	GBytes *line;
 	GError *convert_error = NULL;
 
 	g_assert(msg != NULL);
 
-	/* Clip the message */
-	g_strlcpy(cmd, msg, IRC_MSG_MAXLEN + 1);
+	/* Clip the message; the line is built once, in the buffer which will be
+	 * written out to the socket. */
+	for (len = 0; len < IRC_MSG_MAXLEN && msg[len] != '\0'; len++)
+		;
+
+	cmd = g_malloc(len + 3);
+	memcpy(cmd, msg, len);
+	cmd[len] = '\0';
 
 	/* Strip out any <CR>/<LF> which have crept in */
 	g_strdelimit (cmd, "\r\n", ' ');
 
 	/* Append <CR><LF> */
-	len = strlen(cmd);
 	cmd[len++] = '\r';
 	cmd[len++] = '\n';
 
 	cmd[len] = '\0';
 
-	if (!idle_connection_hton(conn, cmd, &converted, &convert_error)) {
+	/* Converting from UTF-8 to UTF-8 would only give us a copy */
+	if (g_ascii_strcasecmp(priv->charset, "UTF-8") != 0 &&
+	    !idle_connection_hton(conn, cmd, &converted, &convert_error)) {
 		IDLE_DEBUG("hton: %s", convert_error->message);
 		g_error_free(convert_error);
-		converted = g_strdup(cmd);
 	}
 
-	g_queue_insert_sorted(priv->msg_queue,
-		idle_output_pending_msg_new(converted, priority),
-		pending_msg_compare, NULL);
-	idle_connection_add_queue_timeout (conn);
+	if (converted != NULL)
+		line = g_bytes_new_take(converted, strlen(converted));
+	else
+		line = g_bytes_new_take(cmd, len);
+
+	if (_is_express_command(cmd)) {
+		g_queue_push_tail(priv->express_queue, idle_output_pending_msg_new(line, priority));
+		_flush_express_queue(conn);
+	} else {
+		gchar *target = _msg_target_name(cmd);
+
+		_msg_queue_push(priv, idle_output_pending_msg_new(line, priority), target);
+		idle_connection_add_queue_timeout (conn);
+		g_free(target);
+	}
+
+	if (converted != NULL)
+		g_free(cmd);
 }
 
 void idle_connection_send(IdleConnection *conn, const gchar *msg) {
 	_send_with_priority(conn, msg, SERVER_CMD_NORMAL_PRIORITY);
 }
 
+/**
+ * Queue a line which is already in the connection's charset, and already ends
+ * with <CR><LF>, to be sent to @target in its turn (see idle_text_encode_and_split())
+ */
+void idle_connection_send_encoded(IdleConnection *conn, const gchar *target, const gchar *line, gsize len) {
+	IdleConnectionPrivate *priv = conn->priv;
+
+	g_assert(len <= IRC_MSG_MAXLEN + 2);
+
+	_msg_queue_push(priv, idle_output_pending_msg_new(g_bytes_new(line, len), SERVER_CMD_NORMAL_PRIORITY), target);
+	idle_connection_add_queue_timeout (conn);
+}
+
+const gchar *
+idle_connection_get_charset(IdleConnection *conn)
+{
+	return conn->priv->charset;
+}
+
+guint
+idle_connection_get_max_pending_in_memory(IdleConnection *conn)
+{
+	return conn->priv->max_pending_in_memory;
+}
+
+guint
+idle_connection_get_sender_flood_limit(IdleConnection *conn)
+{
+	return conn->priv->sender_flood_limit;
+}
+
+guint
+idle_connection_get_im_channel_threshold(IdleConnection *conn)
+{
+	return conn->priv->im_channel_threshold;
+}
+
+guint
+idle_connection_get_unread_timeout(IdleConnection *conn)
+{
+	return conn->priv->unread_timeout;
+}
+
 gsize
 idle_connection_get_max_message_length(IdleConnection *conn)
 {
@@ -1142,6 +1573,28 @@ static IdleParserHandlerResult _unknown_command_handler(IdleParser *parser, Idle
 	return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
 }
 
+static gboolean _take_ctcp_reply_token(IdleConnection *conn) {
+	IdleConnectionPrivate *priv = conn->priv;
+	gint64 now = g_get_monotonic_time();
+	gint64 interval = CTCP_REPLY_INTERVAL * G_USEC_PER_SEC;
+
+	if (priv->ctcp_reply_refilled == 0 || now - priv->ctcp_reply_refilled >= interval * (CTCP_REPLY_BURST - priv->ctcp_reply_tokens)) {
+		priv->ctcp_reply_tokens = CTCP_REPLY_BURST;
+		priv->ctcp_reply_refilled = now;
+	} else {
+		gint64 earned = (now - priv->ctcp_reply_refilled) / interval;
+
+		priv->ctcp_reply_tokens += earned;
+		priv->ctcp_reply_refilled += earned * interval;
+	}
+
+	if (priv->ctcp_reply_tokens == 0)
+		return FALSE;
+
+	priv->ctcp_reply_tokens--;
+	return TRUE;
+}
+
 static IdleParserHandlerResult _version_privmsg_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
 	IdleConnection *conn = IDLE_CONNECTION(user_data);
 	const gchar *msg = g_value_get_string(g_value_array_get_nth(args, 2));
@@ -1152,6 +1605,11 @@ static IdleParserHandlerResult _version_privmsg_handler(IdleParser *parser, Idle
 	if (g_ascii_strcasecmp(msg, "\001VERSION\001"))
 		return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
 
+	if (!_take_ctcp_reply_token(conn)) {
+		IDLE_DEBUG("too many CTCP requests, not replying to this one");
+		return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+	}
+
 	handle = g_value_get_uint(g_value_array_get_nth(args, 0));
 	nick = tp_handle_inspect(tp_base_connection_get_handles(TP_BASE_CONNECTION(conn), TP_HANDLE_TYPE_CONTACT), handle);
 	reply = g_strdup_printf("VERSION telepathy-idle %s Telepathy IM/VoIP Framework http://telepathy.freedesktop.org", VERSION);
@@ -1163,6 +1621,61 @@ static IdleParserHandlerResult _version_privmsg_handler(IdleParser *parser, Idle
 	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
 }
 
+static IdleParserHandlerResult _isupport_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+
+	for (guint i = 0; i < args->n_values; i++) {
+		const gchar *token = g_value_get_string(g_value_array_get_nth(args, i));
+		const gchar *equals = strchr(token, '=');
+		gsize name_len = (equals != NULL) ? (gsize) (equals - token) : strlen(token);
+		gboolean negated = (token[0] == '-');
+		gchar *name;
+		gsize j;
+
+		if (negated) {
+			token++;
+			name_len--;
+		}
+
+		/* token names are upper case, which tells them apart from the trailing
+		 * "are supported by this server" */
+		for (j = 0; j < name_len; j++) {
+			if (!g_ascii_isupper(token[j]) && !g_ascii_isdigit(token[j]))
+				break;
+		}
+
+		if (name_len == 0 || j < name_len)
+			continue;
+
+		name = g_strndup(token, name_len);
+
+		if (negated)
+			g_hash_table_remove(conn->priv->isupport, name);
+		else
+			g_hash_table_insert(conn->priv->isupport, g_strdup(name), g_strdup((equals != NULL) ? equals + 1 : ""));
+
+		IDLE_DEBUG("server %s %s", negated ? "no longer supports" : "supports", name);
+		g_free(name);
+	}
+
+	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+}
+
+/**
+ * idle_connection_get_isupport:
+ * @conn: the connection
+ * @name: an RPL_ISUPPORT token name, such as "WHOX"
+ *
+ * Returns: the value the server advertised for @name, "" if it advertised the
+ *          token without a value, or %NULL if it did not advertise it
+ */
+const gchar *idle_connection_get_isupport(IdleConnection *conn, const gchar *name) {
+	if (conn->priv->isupport == NULL)
+		return NULL;
+
+	return g_hash_table_lookup(conn->priv->isupport, name);
+}
+
 static IdleParserHandlerResult _welcome_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
 	IdleConnection *conn = IDLE_CONNECTION(user_data);
 	TpHandle handle = g_value_get_uint(g_value_array_get_nth(args, 0));
@@ -1244,7 +1757,7 @@ static void connection_connect_cb(IdleConnection *conn, gboolean success, TpConn
 		if (priv->keepalive_interval != 0 && priv->keepalive_timeout == 0)
 			priv->keepalive_timeout = g_timeout_add_seconds(priv->keepalive_interval, keepalive_timeout_cb, conn);
 
-		if (g_queue_get_length(priv->msg_queue) > 0) {
+		if (!_msg_queue_is_empty(priv)) {
 			IDLE_DEBUG("we had messages in queue, start unloading them now");
 			idle_connection_add_queue_timeout (conn);
 		}
@@ -33,17 +33,22 @@ G_BEGIN_DECLS
 typedef struct _IdleConnection IdleConnection;
 typedef struct _IdleConnectionClass IdleConnectionClass;
 typedef struct _IdleConnectionPrivate IdleConnectionPrivate;
+typedef struct _IdlePresenceTracker IdlePresenceTracker;
 
 struct _IdleConnectionClass {
 	TpBaseConnectionClass parent_class;
 	TpContactsMixinClass contacts;
+	TpPresenceMixinClass presence;
 };
 
 struct _IdleConnection {
 	TpBaseConnection parent;
 	TpContactsMixin contacts;
+	TpPresenceMixin presence;
 	IdleParser *parser;
 	GQueue *contact_info_requests;
+	GHashTable *contact_metadata;
+	IdlePresenceTracker *presence_tracker;
 	IdleConnectionPrivate *priv;
 };
 
@@ -66,7 +71,15 @@ GType idle_connection_get_type(void);
 void idle_connection_canon_nick_receive(IdleConnection *conn, TpHandle handle, const gchar *canon_nick);
 void idle_connection_emit_queued_aliases_changed(IdleConnection *conn);
 void idle_connection_send(IdleConnection *conn, const gchar *msg);
+void idle_connection_send_encoded(IdleConnection *conn, const gchar *target, const gchar *line, gsize len);
+const gchar *idle_connection_get_charset(IdleConnection *conn);
 gsize idle_connection_get_max_message_length(IdleConnection *conn);
+void idle_connection_update_pending(IdleConnection *conn, gint messages, gssize bytes);
+guint idle_connection_get_max_pending_in_memory(IdleConnection *conn);
+guint idle_connection_get_sender_flood_limit(IdleConnection *conn);
+guint idle_connection_get_im_channel_threshold(IdleConnection *conn);
+guint idle_connection_get_unread_timeout(IdleConnection *conn);
+const gchar *idle_connection_get_isupport(IdleConnection *conn, const gchar *name);
 const gchar * const *idle_connection_get_implemented_interfaces (void);
 
 G_END_DECLS
@@ -20,6 +20,8 @@
 #include "config.h"
 #include "idle-contact-info.h"
 
+#include <string.h>
+
 #include <telepathy-glib/telepathy-glib-dbus.h>
 
 #define IDLE_DEBUG_FLAG IDLE_DEBUG_CONNECTION
@@ -27,7 +29,15 @@
 #include "idle-muc-channel.h"
 #include "idle-parser.h"
 
+/* The <querytype> we tag our WHOX queries with, to tell their replies apart
+ * from anybody else's */
+#define WHOX_QUERY_TYPE "152"
+
+/* How long we trust what WHOX told us about a contact, in seconds */
+#define CONTACT_METADATA_TTL 300
+
 typedef struct _ContactInfoRequest ContactInfoRequest;
+typedef struct _ContactMetadata ContactMetadata;
 
 struct _ContactInfoRequest {
 	guint handle;
@@ -40,6 +50,16 @@ struct _ContactInfoRequest {
 	DBusGMethodInvocation *context;
 };
 
+struct _ContactMetadata {
+	gchar *user;
+	gchar *host;
+	gchar *account;
+	gchar *realname;
+	gboolean is_away;
+	gboolean is_operator;
+	gint64 updated;
+};
+
 /*
  * _insert_contact_field:
  * @contact_info: an array of Contact_Info_Field structures
@@ -57,6 +77,67 @@ static void _insert_contact_field(GPtrArray *contact_info, const gchar *field_na
 		G_TYPE_INVALID));
 }
 
+static void _contact_metadata_free(gpointer data) {
+	ContactMetadata *metadata = data;
+
+	g_free(metadata->user);
+	g_free(metadata->host);
+	g_free(metadata->account);
+	g_free(metadata->realname);
+	g_slice_free(ContactMetadata, metadata);
+}
+
+static gboolean _contact_metadata_is_stale(ContactMetadata *metadata, gint64 now) {
+	return (now - metadata->updated) > CONTACT_METADATA_TTL * G_USEC_PER_SEC;
+}
+
+static ContactMetadata *_get_fresh_metadata(IdleConnection *conn, TpHandle handle) {
+	ContactMetadata *metadata = g_hash_table_lookup(conn->contact_metadata, GUINT_TO_POINTER(handle));
+
+	if (metadata == NULL || _contact_metadata_is_stale(metadata, g_get_monotonic_time()))
+		return NULL;
+
+	return metadata;
+}
+
+/* Builds the fields a WHOIS would have given us, as far as WHOX knows them */
+static GPtrArray *_contact_metadata_to_contact_info(ContactMetadata *metadata) {
+	GPtrArray *contact_info = dbus_g_type_specialized_construct(TP_ARRAY_TYPE_CONTACT_INFO_FIELD_LIST);
+	/* WHOX uses "0" for contacts who are not logged in */
+	gboolean is_reg_nick = g_strcmp0(metadata->account, "0") != 0;
+	const gchar *field_values[2] = {NULL, NULL};
+	gchar *tmp;
+
+	field_values[0] = metadata->realname;
+	_insert_contact_field(contact_info, "fn", NULL, field_values);
+
+	tmp = g_strdup_printf("%s@%s", metadata->user, metadata->host);
+	field_values[0] = tmp;
+	_insert_contact_field(contact_info, "x-host", NULL, field_values);
+	g_free(tmp);
+
+	if (is_reg_nick) {
+		field_values[0] = metadata->account;
+		_insert_contact_field(contact_info, "nickname", NULL, field_values);
+	}
+
+	tmp = g_strdup_printf("%d", metadata->is_away ? TP_CONNECTION_PRESENCE_TYPE_AWAY : TP_CONNECTION_PRESENCE_TYPE_AVAILABLE);
+	field_values[0] = tmp;
+	_insert_contact_field(contact_info, "x-presence-type", NULL, field_values);
+	g_free(tmp);
+
+	field_values[0] = metadata->is_away ? "away" : "available";
+	_insert_contact_field(contact_info, "x-presence-status-identifier", NULL, field_values);
+
+	field_values[0] = (metadata->is_operator) ? "true" : "false";
+	_insert_contact_field(contact_info, "x-irc-operator", NULL, field_values);
+
+	field_values[0] = (is_reg_nick) ? "true" : "false";
+	_insert_contact_field(contact_info, "x-irc-registered-nick", NULL, field_values);
+
+	return contact_info;
+}
+
 static ContactInfoRequest * _get_matching_request(IdleConnection *conn, GValueArray *args) {
 	ContactInfoRequest *request;
 	TpHandle handle = g_value_get_uint(g_value_array_get_nth(args, 0));
@@ -128,6 +209,7 @@ static void idle_connection_request_contact_info(TpSvcConnectionInterfaceContact
 	TpBaseConnection *base = TP_BASE_CONNECTION(self);
 	TpHandleRepoIface *contact_handles = tp_base_connection_get_handles(base, TP_HANDLE_TYPE_CONTACT);
 	const gchar *nick;
+	ContactMetadata *metadata;
 	GError *error = NULL;
 
 	TP_BASE_CONNECTION_ERROR_IF_NOT_CONNECTED(base, context);
@@ -140,10 +222,103 @@ static void idle_connection_request_contact_info(TpSvcConnectionInterfaceContact
 
 	nick = tp_handle_inspect(contact_handles, contact);
 
+	metadata = _get_fresh_metadata(self, contact);
+	if (metadata != NULL) {
+		GPtrArray *contact_info = _contact_metadata_to_contact_info(metadata);
+
+		IDLE_DEBUG ("Answering contact info request for handle %u (%s) from the cache", contact, nick);
+		tp_svc_connection_interface_contact_info_return_from_request_contact_info(context, contact_info);
+		tp_svc_connection_interface_contact_info_emit_contact_info_changed(self, contact, contact_info);
+		g_boxed_free(TP_ARRAY_TYPE_CONTACT_INFO_FIELD_LIST, contact_info);
+		return;
+	}
+
 	IDLE_DEBUG ("Queued contact info request for handle: %u (%s)", contact, nick);
 	_queue_request_contact_info(self, contact, nick, context);
 }
 
+/**
+ * idle_contact_info_request_members:
+ * @conn: the connection
+ * @channel: the name of a channel we have joined
+ *
+ * Asks the server about everybody in @channel in one go, so that
+ * RequestContactInfo() can answer for them without a WHOIS each. Does nothing
+ * if the server does not support WHOX.
+ */
+void idle_contact_info_request_members(IdleConnection *conn, const gchar *channel) {
+	gchar cmd[IRC_MSG_MAXLEN + 1];
+	gint64 now = g_get_monotonic_time();
+	GHashTableIter iter;
+	gpointer value;
+
+	if (idle_connection_get_isupport(conn, "WHOX") == NULL)
+		return;
+
+	/* a good time to forget about contacts who parted long ago */
+	g_hash_table_iter_init(&iter, conn->contact_metadata);
+	while (g_hash_table_iter_next(&iter, NULL, &value)) {
+		if (_contact_metadata_is_stale(value, now))
+			g_hash_table_iter_remove(&iter);
+	}
+
+	g_snprintf(cmd, IRC_MSG_MAXLEN + 1, "WHO %s %%tnuhraf," WHOX_QUERY_TYPE, channel);
+	idle_connection_send(conn, cmd);
+}
+
+static IdleParserHandlerResult _whox_reply_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	ContactMetadata *metadata;
+	TpHandle handle;
+	const gchar *flags;
+
+	if (args->n_values != 7)
+		return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+
+	if (g_strcmp0(g_value_get_string(g_value_array_get_nth(args, 0)), WHOX_QUERY_TYPE))
+		return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+
+	handle = g_value_get_uint(g_value_array_get_nth(args, 3));
+	flags = g_value_get_string(g_value_array_get_nth(args, 4));
+
+	metadata = g_slice_new0(ContactMetadata);
+	metadata->user = g_value_dup_string(g_value_array_get_nth(args, 1));
+	metadata->host = g_value_dup_string(g_value_array_get_nth(args, 2));
+	metadata->account = g_value_dup_string(g_value_array_get_nth(args, 5));
+	metadata->realname = g_value_dup_string(g_value_array_get_nth(args, 6));
+	/* H(ere) or G(one), then * for IRC operators and channel prefixes */
+	metadata->is_away = (flags[0] == 'G');
+	metadata->is_operator = (strchr(flags, '*') != NULL);
+	metadata->updated = g_get_monotonic_time();
+
+	g_hash_table_insert(conn->contact_metadata, GUINT_TO_POINTER(handle), metadata);
+
+	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+}
+
+static IdleParserHandlerResult _metadata_nick_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	TpHandle old_handle = g_value_get_uint(g_value_array_get_nth(args, 0));
+	TpHandle new_handle = g_value_get_uint(g_value_array_get_nth(args, 1));
+	ContactMetadata *metadata = g_hash_table_lookup(conn->contact_metadata, GUINT_TO_POINTER(old_handle));
+
+	if (metadata != NULL && old_handle != new_handle) {
+		g_hash_table_steal(conn->contact_metadata, GUINT_TO_POINTER(old_handle));
+		g_hash_table_insert(conn->contact_metadata, GUINT_TO_POINTER(new_handle), metadata);
+	}
+
+	return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+static IdleParserHandlerResult _metadata_quit_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	TpHandle handle = g_value_get_uint(g_value_array_get_nth(args, 0));
+
+	g_hash_table_remove(conn->contact_metadata, GUINT_TO_POINTER(handle));
+
+	return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
 static IdleParserHandlerResult _away_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
 	IdleConnection *conn = IDLE_CONNECTION(user_data);
 	ContactInfoRequest *request = _get_matching_request(conn, args);
@@ -475,6 +650,7 @@ void idle_contact_info_finalize (GObject *object) {
 
 	g_queue_foreach(conn->contact_info_requests, _contact_info_requests_foreach_free, NULL);
 	g_queue_free(conn->contact_info_requests);
+	g_hash_table_unref(conn->contact_metadata);
 }
 
 void idle_contact_info_class_init (IdleConnectionClass *klass) {
@@ -499,18 +675,35 @@ idle_contact_info_fill_contact_attributes (
     const GArray *contacts,
     GHashTable *attributes_hash)
 {
-  /* We don't cache contact info, so we just never put /info into the
-   * attributes hash. This is spec-compliant: we don't implement
-   * GetContactInfo, and the spec says the attribute should be the same as the
-   * value returned by that method (or omitted if unknown). This function
-   * exists at all to make ContactInfo show up in ContactAttributeInterfaces
-   * (otherwise tp-glib might be justified in falling back to
-   * GetContactInfo(), which we know will fail).
+  /* We only know contact info for members of channels the server answered
+   * our WHOX for, and put /info into the attributes hash for just those;
+   * omitting it for everybody else is spec-compliant. This function also
+   * makes ContactInfo show up in ContactAttributeInterfaces (otherwise tp-glib
+   * might be justified in falling back to GetContactInfo(), which we know
+   * will fail).
    */
+  IdleConnection *self = IDLE_CONNECTION (obj);
+  guint i;
+
+  for (i = 0; i < contacts->len; i++)
+    {
+      TpHandle handle = g_array_index (contacts, TpHandle, i);
+      ContactMetadata *metadata = _get_fresh_metadata (self, handle);
+
+      if (metadata == NULL)
+        continue;
+
+      tp_contacts_mixin_set_contact_attribute (attributes_hash,
+          handle, TP_IFACE_CONNECTION_INTERFACE_CONTACT_INFO"/info",
+          tp_g_value_slice_new_take_boxed (
+              TP_ARRAY_TYPE_CONTACT_INFO_FIELD_LIST,
+              _contact_metadata_to_contact_info (metadata)));
+    }
 }
 
 void idle_contact_info_init (IdleConnection *conn) {
 	conn->contact_info_requests = g_queue_new();
+	conn->contact_metadata = g_hash_table_new_full(NULL, NULL, NULL, _contact_metadata_free);
 
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_WHOISUSER, _whois_user_handler, conn);
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_WHOISCHANNELS, _whois_channels_handler, conn);
@@ -527,6 +720,10 @@ void idle_contact_info_init (IdleConnection *conn) {
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_NOSUCHSERVER, _no_such_server_handler, conn);
 	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_TRYAGAIN, _try_again_handler, conn);
 
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_WHOSPCRPL, _whox_reply_handler, conn);
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_PREFIXCMD_NICK, _metadata_nick_handler, conn);
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_PREFIXCMD_QUIT, _metadata_quit_handler, conn);
+
 	tp_contacts_mixin_add_contact_attributes_iface ((GObject *) conn,
 		TP_IFACE_CONNECTION_INTERFACE_CONTACT_INFO,
 		idle_contact_info_fill_contact_attributes);
@@ -32,6 +32,7 @@ void idle_contact_info_finalize (GObject *object);
 void idle_contact_info_class_init (IdleConnectionClass *klass);
 void idle_contact_info_init (IdleConnection *conn);
 void idle_contact_info_iface_init (gpointer g_iface, gpointer iface_data);
+void idle_contact_info_request_members (IdleConnection *conn, const gchar *channel);
 
 G_END_DECLS
 
@@ -21,8 +21,6 @@
 #include "config.h"
 #include "idle-ctcp.h"
 
-#include <ctype.h>
-#include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
 
@@ -84,32 +82,33 @@ const gchar *idle_ctcp_notice(const gchar *target, const gchar *ctcp, IdleConnec
 	return _ctcp_send("NOTICE", target, ctcp, conn);
 }
 
-gchar *idle_ctcp_kill_blingbling(const gchar *msg) {
+gchar *idle_ctcp_kill_blingbling_len(const gchar *msg, gsize len) {
+	const gchar *iter = msg, *end = msg + len;
 	gchar *killed, *killed_iter;
 
 	if (msg == NULL)
 		return NULL;
 
-	killed = g_malloc0(strlen(msg) + 1);
+	killed = g_malloc(len + 1);
 	killed_iter = killed;
 
-	for (const gchar *iter = msg; *iter != '\0';) {
+	while (iter < end) {
 		switch (*iter) {
 			case '\x03': /* ^C */
 				iter++;
 
 				/* Color codes are 1-2 digits */
-                                if (isdigit(*iter))
+				if (iter < end && g_ascii_isdigit(*iter))
 					iter++;
-                                if (isdigit(*iter))
+				if (iter < end && g_ascii_isdigit(*iter))
 					iter++;
 
-				if (*iter == ',') {
+				if (iter < end && *iter == ',') {
 					iter++;
 
-	                                if (isdigit(*iter))
+					if (iter < end && g_ascii_isdigit(*iter))
 						iter++;
-	                                if (isdigit(*iter))
+					if (iter < end && g_ascii_isdigit(*iter))
 						iter++;
 				}
 				break;
@@ -129,86 +128,84 @@ gchar *idle_ctcp_kill_blingbling(const gchar *msg) {
 		}
 	}
 
+	*killed_iter = '\0';
+
 	return killed;
 }
 
+gchar *idle_ctcp_kill_blingbling(const gchar *msg) {
+	if (msg == NULL)
+		return NULL;
+
+	return idle_ctcp_kill_blingbling_len(msg, strlen(msg));
+}
+
 gchar **idle_ctcp_decode(const gchar *msg) {
 	GPtrArray *tokens;
-	gchar cur_token[IRC_MSG_MAXLEN] = {'\0'};
-	gchar *cur_iter = cur_token;
-	gchar **ret;
+	gchar *buf, *token, *out;
 	const gchar *iter;
 	gboolean string = FALSE;
 
 	if (!msg || (msg[0] != '\001') || !msg[1] || (msg[1] == '\001'))
 		return NULL;
 
+	/* Unquoting never makes anything longer, so every token is written into
+	 * one buffer, one after the other, and copied out once it's complete. */
+	buf = g_malloc(strlen(msg));
+	token = out = buf;
 	tokens = g_ptr_array_new();
 
-	iter = msg + 1;
-	while (*iter != '\0') {
+#define END_TOKEN() \
+	G_STMT_START { \
+		if (out != token) \
+			g_ptr_array_add(tokens, g_strndup(token, out - token)); \
+		token = out; \
+	} G_STMT_END
+
+	for (iter = msg + 1; *iter != '\0'; iter++) {
 		switch (*iter) {
 			case '\\':
-				if (isdigit(iter[1])) {
-					gchar *endptr = NULL;
-					gchar escaped_char = (gchar) strtol(iter + 1, &endptr, 8);
-
-					if (endptr != (iter + 1)) {
-						*cur_iter++ = escaped_char;
-						iter = endptr;
-					} else {
-						iter++;
-					}
-				} else {
-					*cur_iter++ = iter[1];
-					iter += 2;
+				if (iter[1] >= '0' && iter[1] <= '7') {
+					/* \ooo, as _ctcp_send() escapes things */
+					guint escaped = 0, digits;
+
+					for (digits = 0; digits < 3 && iter[1] >= '0' && iter[1] <= '7'; digits++)
+						escaped = escaped * 8 + (guint) (*++iter - '0');
+
+					*out++ = (gchar) escaped;
+				} else if (iter[1] != '\0') {
+					*out++ = *++iter;
 				}
+				/* else it's a stray backslash at the very end */
 				break;
 
 			case ' ':
-				if (string) {
-					*cur_iter++ = ' ';
-				} else {
-					if (cur_token[0] != '\0') {
-						g_ptr_array_add(tokens, g_strdup(cur_token));
-						memset(cur_token, '\0', IRC_MSG_MAXLEN);
-						cur_iter = cur_token;
-					}
-				}
-
-				iter++;
+				if (string)
+					*out++ = ' ';
+				else
+					END_TOKEN();
 				break;
 
 			case '"':
-				if (cur_token[0] != '\0') {
-					g_ptr_array_add(tokens, g_strdup(cur_token));
-					memset(cur_token, 0, IRC_MSG_MAXLEN);
-					cur_iter = cur_token;
-				}
-
+				END_TOKEN();
 				string ^= TRUE;
-
-				iter++;
 				break;
 
 			case '\001':
-				iter++;
 				break;
 
 			default:
-				*cur_iter++ = *iter++;
+				*out++ = *iter;
 				break;
 		}
 	}
 
-	if (cur_token[0] != '\0')
-		g_ptr_array_add(tokens, g_strdup(cur_token));
+	END_TOKEN();
 
-	g_ptr_array_add(tokens, NULL);
+#undef END_TOKEN
 
-	ret = (gchar **) tokens->pdata;
-	g_ptr_array_free(tokens, FALSE);
+	g_free(buf);
+	g_ptr_array_add(tokens, NULL);
 
-	return ret;
+	return (gchar **) g_ptr_array_free(tokens, FALSE);
 }
-
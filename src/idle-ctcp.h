@@ -42,6 +42,7 @@ const gchar *idle_ctcp_notice(const gchar *target, const gchar *ctcp, IdleConnec
  * Free with g_free(). */
 
 gchar *idle_ctcp_kill_blingbling(const gchar *msg);
+gchar *idle_ctcp_kill_blingbling_len(const gchar *msg, gsize len);
 
 /* De-escape, deframe and tokenize a CTCP message
  *
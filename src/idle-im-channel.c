@@ -38,8 +38,8 @@ static void idle_im_channel_send (GObject *obj, TpMessage *message, TpMessageSen
 static void idle_im_channel_finalize (GObject *object);
 
 G_DEFINE_TYPE_WITH_CODE(IdleIMChannel, idle_im_channel, TP_TYPE_BASE_CHANNEL,
-    G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CHANNEL_TYPE_TEXT, tp_message_mixin_text_iface_init);
-    G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CHANNEL_INTERFACE_MESSAGES, tp_message_mixin_messages_iface_init);
+    G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CHANNEL_TYPE_TEXT, idle_text_text_iface_init);
+    G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CHANNEL_INTERFACE_MESSAGES, idle_text_messages_iface_init);
     G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CHANNEL_INTERFACE_DESTROYABLE, _destroyable_iface_init);
     )
 
@@ -122,7 +122,7 @@ idle_im_channel_class_init (IdleIMChannelClass *idle_im_channel_class)
   base_class->get_object_path_suffix = idle_im_channel_get_path_suffix;
   base_class->get_interfaces = idle_im_channel_get_interfaces;
 
-  tp_message_mixin_init_dbus_properties (object_class);
+  idle_text_init_dbus_properties (object_class);
 }
 
 static void
@@ -145,6 +145,20 @@ idle_im_channel_receive (
   return idle_text_received (G_OBJECT (chan), base_conn, type, text, sender);
 }
 
+gboolean
+idle_im_channel_receive_at (
+    IdleIMChannel *chan,
+    TpChannelTextMessageType type,
+    TpHandle sender,
+    const gchar *text,
+    gint64 timestamp)
+{
+  TpBaseConnection *base_conn = tp_base_channel_get_connection (TP_BASE_CHANNEL (chan));
+
+  return idle_text_received_at (G_OBJECT (chan), base_conn, type, text, sender,
+      timestamp);
+}
+
 static void
 idle_im_channel_close (TpBaseChannel *base)
 {
@@ -153,11 +167,11 @@ idle_im_channel_close (TpBaseChannel *base)
   /* The IM manager will resurrect the channel if we have pending
    * messages. When we're resurrected, we want the initiator
    * to be the contact who sent us those messages, if it isn't already */
-  if (tp_message_mixin_has_pending_messages ((GObject *)obj, NULL))
+  if (idle_text_has_pending_messages ((GObject *)obj))
     {
       IDLE_DEBUG("%p not really closing, I still have pending messages", obj);
 
-      tp_message_mixin_set_rescued ((GObject *) obj);
+      idle_text_set_rescued ((GObject *) obj);
       tp_base_channel_reopened (base, tp_base_channel_get_target_handle (base));
     }
   else
@@ -202,19 +216,29 @@ idle_im_channel_send (
   idle_text_send (obj, message, flags, recipient, IDLE_CONNECTION (conn));
 }
 
-static void
-idle_im_channel_destroy (
-    TpSvcChannelInterfaceDestroyable *iface,
-    DBusGMethodInvocation *context)
+/**
+ * idle_im_channel_discard:
+ *
+ * Closes @chan for good, throwing away any messages still pending in it
+ */
+void
+idle_im_channel_discard (IdleIMChannel *chan)
 {
-  TpBaseChannel *chan = TP_BASE_CHANNEL (iface);
   GObject *obj = (GObject *) chan;
 
   IDLE_DEBUG ("called on %p with %spending messages", obj,
-      tp_message_mixin_has_pending_messages (obj, NULL) ? "" : "no ");
+      idle_text_has_pending_messages (obj) ? "" : "no ");
+
+  idle_text_clear (obj);
+  tp_base_channel_destroyed (TP_BASE_CHANNEL (chan));
+}
 
-  tp_message_mixin_clear (obj);
-  tp_base_channel_destroyed (chan);
+static void
+idle_im_channel_destroy (
+    TpSvcChannelInterfaceDestroyable *iface,
+    DBusGMethodInvocation *context)
+{
+  idle_im_channel_discard (IDLE_IM_CHANNEL (iface));
 
   tp_svc_channel_interface_destroyable_return_from_destroy(context);
 }
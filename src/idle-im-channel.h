@@ -55,6 +55,8 @@ GType idle_im_channel_get_type(void);
 	(G_TYPE_INSTANCE_GET_CLASS ((obj), IDLE_TYPE_IM_CHANNEL, IdleIMChannelClass))
 
 gboolean idle_im_channel_receive(IdleIMChannel *chan, TpChannelTextMessageType type, TpHandle sender, const gchar *msg);
+gboolean idle_im_channel_receive_at(IdleIMChannel *chan, TpChannelTextMessageType type, TpHandle sender, const gchar *msg, gint64 timestamp);
+void idle_im_channel_discard(IdleIMChannel *chan);
 
 G_END_DECLS
 
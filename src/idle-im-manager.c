@@ -22,6 +22,9 @@
 
 #include "idle-im-manager.h"
 
+#include <string.h>
+#include <time.h>
+
 #include <telepathy-glib/telepathy-glib.h>
 #include <telepathy-glib/telepathy-glib-dbus.h>
 
@@ -35,6 +38,8 @@
 
 static void _im_manager_iface_init(gpointer g_iface, gpointer iface_data);
 static void _im_manager_constructed (GObject *obj);
+static void _deferred_free(gpointer data);
+static void _reclaim_free(gpointer data);
 static void _im_manager_dispose (GObject *object);
 
 G_DEFINE_TYPE_WITH_CODE(IdleIMManager, idle_im_manager, G_TYPE_OBJECT,
@@ -58,10 +63,42 @@ static const gchar * const im_channel_allowed_properties[] = {
     NULL
 };
 
+/* Private messages from a contact we have no channel for are kept here until
+ * they've sent the connection's im-channel-threshold of them, or a client
+ * asks for a channel to them, so that one-off messages from spammers and
+ * service bots don't each cost a channel. If neither happens before the
+ * connection's unread-timeout passes without another message, they are
+ * forgotten. */
+typedef struct {
+	IdleIMManager *manager;
+	TpHandle handle;
+	GQueue messages;
+	guint timeout_id;
+} IdleIMDeferred;
+
+typedef struct {
+	TpChannelTextMessageType type;
+	gint64 timestamp;
+	gchar text[1];
+} IdleIMDeferredMessage;
+
+/* Likewise, a channel which was closed while it still had unread messages,
+ * and so came straight back, is destroyed along with them once the
+ * unread-timeout passes without another message or a client asking for it. */
+typedef struct {
+	IdleIMManager *manager;
+	TpHandle handle;
+	guint timeout_id;
+} IdleIMReclaim;
+
 typedef struct _IdleIMManagerPrivate IdleIMManagerPrivate;
 struct _IdleIMManagerPrivate {
 	IdleConnection *conn;
 	GHashTable *channels;
+	/* TpHandle => IdleIMDeferred */
+	GHashTable *deferred;
+	/* TpHandle => IdleIMReclaim */
+	GHashTable *reclaim;
 	int status_changed_id;
 	gboolean dispose_has_run;
 };
@@ -86,9 +123,152 @@ static IdleIMChannel *_im_manager_new_channel (IdleIMManager *mgr, TpHandle hand
 
 static void _im_channel_closed_cb (IdleIMChannel *chan, gpointer user_data);
 
+static void _deferred_free(gpointer data) {
+	IdleIMDeferred *deferred = data;
+
+	if (deferred->timeout_id != 0)
+		g_source_remove(deferred->timeout_id);
+
+	g_queue_foreach(&deferred->messages, (GFunc) g_free, NULL);
+	g_queue_clear(&deferred->messages);
+	g_slice_free(IdleIMDeferred, deferred);
+}
+
+static gboolean _deferred_timeout_cb(gpointer user_data) {
+	IdleIMDeferred *deferred = user_data;
+	IdleIMManagerPrivate *priv = IDLE_IM_MANAGER_GET_PRIVATE(deferred->manager);
+
+	IDLE_DEBUG("forgetting %u unclaimed messages from %u",
+		g_queue_get_length(&deferred->messages), deferred->handle);
+
+	deferred->timeout_id = 0;
+	g_hash_table_remove(priv->deferred, GUINT_TO_POINTER(deferred->handle));
+
+	return FALSE;
+}
+
+/* Returns TRUE if the message was kept back, or FALSE if the contact has sent
+ * enough messages to deserve a channel, in which case it's up to the caller
+ * to deliver this one. */
+static gboolean _defer_message(IdleIMManager *manager, TpHandle handle, TpChannelTextMessageType type, const gchar *text) {
+	IdleIMManagerPrivate *priv = IDLE_IM_MANAGER_GET_PRIVATE(manager);
+	guint threshold = idle_connection_get_im_channel_threshold(priv->conn);
+	IdleIMDeferred *deferred;
+	IdleIMDeferredMessage *msg;
+	gsize len;
+
+	if (threshold <= 1 || priv->deferred == NULL)
+		return FALSE;
+
+	deferred = g_hash_table_lookup(priv->deferred, GUINT_TO_POINTER(handle));
+
+	if (deferred == NULL) {
+		deferred = g_slice_new0(IdleIMDeferred);
+		deferred->manager = manager;
+		deferred->handle = handle;
+		g_hash_table_insert(priv->deferred, GUINT_TO_POINTER(handle), deferred);
+	} else if (g_queue_get_length(&deferred->messages) + 1 >= threshold) {
+		return FALSE;
+	}
+
+	len = strlen(text);
+	msg = g_malloc(G_STRUCT_OFFSET(IdleIMDeferredMessage, text) + len + 1);
+	msg->type = type;
+	msg->timestamp = time(NULL);
+	memcpy(msg->text, text, len + 1);
+	g_queue_push_tail(&deferred->messages, msg);
+
+	if (deferred->timeout_id != 0)
+		g_source_remove(deferred->timeout_id);
+	deferred->timeout_id = g_timeout_add_seconds(idle_connection_get_unread_timeout(priv->conn), _deferred_timeout_cb, deferred);
+
+	return TRUE;
+}
+
+/* Hands whatever was kept back from @handle to its newly created channel */
+static void _deliver_deferred(IdleIMManager *manager, IdleIMChannel *chan, TpHandle handle) {
+	IdleIMManagerPrivate *priv = IDLE_IM_MANAGER_GET_PRIVATE(manager);
+	IdleIMDeferred *deferred;
+	IdleIMDeferredMessage *msg;
+
+	if (priv->deferred == NULL)
+		return;
+
+	deferred = g_hash_table_lookup(priv->deferred, GUINT_TO_POINTER(handle));
+	if (deferred == NULL)
+		return;
+
+	while ((msg = g_queue_pop_head(&deferred->messages)) != NULL) {
+		idle_im_channel_receive_at(chan, msg->type, handle, msg->text, msg->timestamp);
+		g_free(msg);
+	}
+
+	g_hash_table_remove(priv->deferred, GUINT_TO_POINTER(handle));
+}
+
+static void _reclaim_free(gpointer data) {
+	IdleIMReclaim *reclaim = data;
+
+	if (reclaim->timeout_id != 0)
+		g_source_remove(reclaim->timeout_id);
+
+	g_slice_free(IdleIMReclaim, reclaim);
+}
+
+static gboolean _reclaim_timeout_cb(gpointer user_data) {
+	IdleIMReclaim *reclaim = user_data;
+	IdleIMManager *manager = reclaim->manager;
+	IdleIMManagerPrivate *priv = IDLE_IM_MANAGER_GET_PRIVATE(manager);
+	TpHandle handle = reclaim->handle;
+	IdleIMChannel *chan;
+
+	reclaim->timeout_id = 0;
+	g_hash_table_remove(priv->reclaim, GUINT_TO_POINTER(handle));
+
+	chan = g_hash_table_lookup(priv->channels, GUINT_TO_POINTER(handle));
+
+	if (chan != NULL && idle_text_has_pending_messages((GObject *) chan)) {
+		IDLE_DEBUG("nobody read the messages from %u, discarding their channel", handle);
+		idle_im_channel_discard(chan);
+	}
+
+	return FALSE;
+}
+
+/* (Re)starts the countdown to discarding @handle's channel, if it's unread */
+static void _reclaim_schedule(IdleIMManager *manager, TpHandle handle) {
+	IdleIMManagerPrivate *priv = IDLE_IM_MANAGER_GET_PRIVATE(manager);
+	IdleIMReclaim *reclaim;
+
+	if (idle_connection_get_im_channel_threshold(priv->conn) <= 1 || priv->reclaim == NULL)
+		return;
+
+	reclaim = g_hash_table_lookup(priv->reclaim, GUINT_TO_POINTER(handle));
+
+	if (reclaim == NULL) {
+		reclaim = g_slice_new0(IdleIMReclaim);
+		reclaim->manager = manager;
+		reclaim->handle = handle;
+		g_hash_table_insert(priv->reclaim, GUINT_TO_POINTER(handle), reclaim);
+	} else {
+		g_source_remove(reclaim->timeout_id);
+	}
+
+	reclaim->timeout_id = g_timeout_add_seconds(idle_connection_get_unread_timeout(priv->conn), _reclaim_timeout_cb, reclaim);
+}
+
+static void _reclaim_cancel(IdleIMManager *manager, TpHandle handle) {
+	IdleIMManagerPrivate *priv = IDLE_IM_MANAGER_GET_PRIVATE(manager);
+
+	if (priv->reclaim != NULL)
+		g_hash_table_remove(priv->reclaim, GUINT_TO_POINTER(handle));
+}
+
 static void idle_im_manager_init(IdleIMManager *obj) {
 	IdleIMManagerPrivate *priv = IDLE_IM_MANAGER_GET_PRIVATE(obj);
 	priv->channels = g_hash_table_new_full(g_direct_hash, g_direct_equal, NULL, g_object_unref);
+	priv->deferred = g_hash_table_new_full(g_direct_hash, g_direct_equal, NULL, _deferred_free);
+	priv->reclaim = g_hash_table_new_full(g_direct_hash, g_direct_equal, NULL, _reclaim_free);
 	priv->status_changed_id = 0;
 	priv->dispose_has_run = FALSE;
 }
@@ -179,8 +359,16 @@ static IdleParserHandlerResult _notice_privmsg_handler(IdleParser *parser, IdleP
 		return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
 	}
 
-	if (!(chan = g_hash_table_lookup(priv->channels, GUINT_TO_POINTER(handle))))
+	if (!(chan = g_hash_table_lookup(priv->channels, GUINT_TO_POINTER(handle)))) {
+		if (_defer_message(manager, handle, type, body)) {
+			g_free(body);
+			return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+		}
+
 		chan = _im_manager_new_channel(manager, handle, handle, NULL);
+	} else if (priv->reclaim != NULL && g_hash_table_lookup(priv->reclaim, GUINT_TO_POINTER(handle)) != NULL) {
+		_reclaim_schedule(manager, handle);
+	}
 
 	idle_im_channel_receive(chan, type, handle, body);
 
@@ -197,6 +385,8 @@ static void _im_manager_close_all(IdleIMManager *manager) {
 		priv->channels = NULL;
 		g_hash_table_destroy(tmp);
 	}
+	tp_clear_pointer(&priv->deferred, g_hash_table_destroy);
+	tp_clear_pointer(&priv->reclaim, g_hash_table_destroy);
 	if (priv->status_changed_id != 0) {
 		g_signal_handler_disconnect (priv->conn, priv->status_changed_id);
 		priv->status_changed_id = 0;
@@ -370,6 +560,7 @@ _im_manager_requestotron (IdleIMManager *self,
 		goto error;
 	}
 
+	_reclaim_cancel (self, handle);
 	tp_channel_manager_emit_request_already_satisfied (self, request_token,
 													   channel);
 	return TRUE;
@@ -400,12 +591,14 @@ _im_channel_closed_cb (IdleIMChannel *chan,
 		if (tp_base_channel_is_destroyed (base))
 		{
 			IDLE_DEBUG ("removing channel with handle %u", handle);
+			_reclaim_cancel (self, handle);
 			g_hash_table_remove (priv->channels, GUINT_TO_POINTER (handle));
 		} else {
 			IDLE_DEBUG ("reopening channel with handle %u due to pending messages",
 				handle);
 			tp_channel_manager_emit_new_channel (self,
 				(TpExportableChannel *) chan, NULL);
+			_reclaim_schedule (self, handle);
 		}
 	}
 }
@@ -450,6 +643,8 @@ _im_manager_new_channel (IdleIMManager *mgr,
 
 	g_signal_connect (chan, "closed", G_CALLBACK (_im_channel_closed_cb), mgr);
 
+	_deliver_deferred (mgr, chan, handle);
+
 	return chan;
 }
 
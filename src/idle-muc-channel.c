@@ -48,8 +48,8 @@ static void idle_muc_channel_close (TpBaseChannel *base);
 G_DEFINE_TYPE_WITH_CODE(IdleMUCChannel, idle_muc_channel, TP_TYPE_BASE_CHANNEL,
 		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CHANNEL_INTERFACE_GROUP, tp_group_mixin_iface_init);
 		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CHANNEL_INTERFACE_PASSWORD, _password_iface_init);
-		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CHANNEL_TYPE_TEXT, tp_message_mixin_text_iface_init);
-		G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CHANNEL_INTERFACE_MESSAGES, tp_message_mixin_messages_iface_init);
+		G_IMPLEMENT_INTERFACE(TP_TYPE_SVC_CHANNEL_TYPE_TEXT, idle_text_text_iface_init);
+		G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CHANNEL_INTERFACE_MESSAGES, idle_text_messages_iface_init);
 		G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CHANNEL_INTERFACE_ROOM, NULL);
 		G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CHANNEL_INTERFACE_SUBJECT, subject_iface_init);
 		G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CHANNEL_INTERFACE_ROOM_CONFIG,
@@ -162,6 +162,9 @@ struct _IdleMUCChannelPrivate {
 	/* NAMEREPLY MembersChanged aggregation */
 	TpHandleSet *namereply_set;
 
+	/* we joined and still do not know the channel modes */
+	gboolean mode_query_pending;
+
 	gboolean join_ready;
 
 	gboolean dispose_has_run;
@@ -396,7 +399,7 @@ static void idle_muc_channel_class_init (IdleMUCChannelClass *idle_muc_channel_c
 	signals[JOIN_READY] = g_signal_new("join-ready", G_OBJECT_CLASS_TYPE(idle_muc_channel_class), G_SIGNAL_RUN_LAST | G_SIGNAL_DETAILED, 0, NULL, NULL, g_cclosure_marshal_VOID__UINT, G_TYPE_NONE, 1, G_TYPE_UINT);
 
 	tp_group_mixin_class_init(object_class, G_STRUCT_OFFSET(IdleMUCChannelClass, group_class), add_member, remove_member);
-	tp_message_mixin_init_dbus_properties (object_class);
+	idle_text_init_dbus_properties (object_class);
 
 	tp_group_mixin_init_dbus_properties (object_class);
 	tp_group_mixin_class_allow_self_removal (object_class);
@@ -423,6 +426,7 @@ void idle_muc_channel_dispose (GObject *object) {
 	priv->dispose_has_run = TRUE;
 
         tp_clear_object (&priv->room_config);
+	idle_text_clear (object);
 
 	if (G_OBJECT_CLASS (idle_muc_channel_parent_class)->dispose)
 		G_OBJECT_CLASS (idle_muc_channel_parent_class)->dispose (object);
@@ -716,7 +720,9 @@ send_command (
   idle_connection_send (IDLE_CONNECTION (base_conn), cmd);
 }
 
-static void send_mode_query_request(IdleMUCChannel *chan) {
+/* Sends the MODE query deferred by idle_muc_channel_join(), unless the
+ * server has told us the channel modes in the meantime. */
+void idle_muc_channel_send_mode_query(IdleMUCChannel *chan) {
 	IdleMUCChannelPrivate *priv;
 	gchar cmd[IRC_MSG_MAXLEN + 2];
 
@@ -725,11 +731,38 @@ static void send_mode_query_request(IdleMUCChannel *chan) {
 
 	priv = chan->priv;
 
+	if (!priv->mode_query_pending)
+		return;
+
+	priv->mode_query_pending = FALSE;
+
+	if (priv->state != MUC_STATE_JOINED)
+		return;
+
 	g_snprintf(cmd, IRC_MSG_MAXLEN + 2, "MODE %s", priv->channel_name);
 
 	send_command (chan, cmd);
 }
 
+/* RFC 2811 gives '+' channels no modes but +t, where the server has them at
+ * all; if it doesn't say which channel types it has, it has the RFC's */
+static gboolean _has_fixed_modes(IdleMUCChannel *chan, IdleConnection *conn) {
+	const gchar *chantypes = idle_connection_get_isupport(conn, "CHANTYPES");
+
+	if (chan->priv->channel_name[0] != '+')
+		return FALSE;
+
+	return chantypes == NULL || strchr(chantypes, '+') != NULL;
+}
+
+/* A server which advertises CHANMODES with no modes in it has no channel
+ * modes to tell us about */
+static gboolean _server_has_channel_modes(IdleConnection *conn) {
+	const gchar *chanmodes = idle_connection_get_isupport(conn, "CHANMODES");
+
+	return chanmodes == NULL || chanmodes[strspn(chanmodes, ",")] != '\0';
+}
+
 void idle_muc_channel_join(IdleMUCChannel *chan, TpHandle joiner) {
 	IdleMUCChannelPrivate *priv = chan->priv;
 	TpBaseConnection *base_conn = tp_base_channel_get_connection (
@@ -748,11 +781,17 @@ void idle_muc_channel_join(IdleMUCChannel *chan, TpHandle joiner) {
 			TP_CHANNEL_GROUP_FLAG_MESSAGE_DEPART,
 			0);
 
-		send_mode_query_request(chan);
-
-		if (priv->channel_name[0] == '+')
+		if (_has_fixed_modes(chan, IDLE_CONNECTION (base_conn))) {
 			/* according to IRC specs, PLUS channels do not support channel modes and alway have only +t set, so we work with that. */
 			change_mode_state(chan, MODE_FLAG_TOPIC_ONLY_SETTABLE_BY_OPS, 0);
+			tp_base_room_config_set_retrieved (priv->room_config);
+		} else if (!_server_has_channel_modes(IDLE_CONNECTION (base_conn))) {
+			/* there is nothing to ask about */
+			tp_base_room_config_set_retrieved (priv->room_config);
+		} else {
+			/* the MUC manager sends this once the join burst is over */
+			priv->mode_query_pending = TRUE;
+		}
 	} else {
 		tp_group_mixin_change_members((GObject *)(chan), NULL, set, NULL, NULL, NULL, joiner, TP_CHANNEL_GROUP_CHANGE_REASON_NONE);
 	}
@@ -812,6 +851,7 @@ void idle_muc_channel_namereply(IdleMUCChannel *chan, GValueArray *args) {
 	IdleMUCChannelPrivate *priv = chan->priv;
 	TpBaseChannel *base = TP_BASE_CHANNEL (chan);
 	TpBaseConnection *base_conn = tp_base_channel_get_connection (base);
+	TpHandle self = tp_base_connection_get_self_handle (base_conn);
 
 	if (!priv->namereply_set)
 		priv->namereply_set = tp_handle_set_new(tp_base_connection_get_handles(base_conn, TP_HANDLE_TYPE_CONTACT));
@@ -820,29 +860,30 @@ void idle_muc_channel_namereply(IdleMUCChannel *chan, GValueArray *args) {
 		TpHandle handle = g_value_get_uint(g_value_array_get_nth(args, i));
 		gchar modechar = g_value_get_schar(g_value_array_get_nth(args, i + 1));
 
-		if (handle == tp_base_connection_get_self_handle (base_conn)) {
+		if (handle == self) {
 			guint remove = MODE_FLAG_OPERATOR_PRIVILEGE | MODE_FLAG_VOICE_PRIVILEGE | MODE_FLAG_HALFOP_PRIVILEGE;
 			guint add = 0;
 
 			switch (modechar) {
+				case '~':
+				case '&':
 				case '@':
-					add |= MODE_FLAG_OPERATOR_PRIVILEGE;
+					add = MODE_FLAG_OPERATOR_PRIVILEGE;
 					break;
 
-				case '&':
-					add |= MODE_FLAG_OPERATOR_PRIVILEGE;
+				case '%':
+					add = MODE_FLAG_HALFOP_PRIVILEGE;
 					break;
 
 				case '+':
-					add |= MODE_FLAG_VOICE_PRIVILEGE;
+					add = MODE_FLAG_VOICE_PRIVILEGE;
 					break;
 
 				default:
 					break;
 			}
 
-			remove &= ~add;
-			change_mode_state(chan, add, remove);
+			change_mode_state(chan, add, remove & ~add);
 		}
 
 		tp_handle_set_add(priv->namereply_set, handle);
@@ -867,7 +908,8 @@ void idle_muc_channel_namereply_end(IdleMUCChannel *chan) {
 	priv->namereply_set = NULL;
 }
 
-static guint _modechar_to_modeflag(gchar modechar) {
+/* The mode flag for a member privilege, for when it is ours */
+static guint _modechar_to_privilege(gchar modechar) {
 	switch (modechar) {
 		case 'o':
 			return MODE_FLAG_OPERATOR_PRIVILEGE;
@@ -880,39 +922,71 @@ static guint _modechar_to_modeflag(gchar modechar) {
 	}
 }
 
+static guint _modechar_to_modeflag(gchar modechar) {
+	switch (modechar) {
+		case 'l':
+			return MODE_FLAG_USER_LIMIT;
+		case 'k':
+			return MODE_FLAG_KEY;
+		case 'a':
+			return MODE_FLAG_ANONYMOUS;
+		case 'i':
+			return MODE_FLAG_INVITE_ONLY;
+		case 'm':
+			return MODE_FLAG_MODERATED;
+		case 'n':
+			return MODE_FLAG_NO_OUTSIDE_MESSAGES;
+		case 'q':
+			return MODE_FLAG_QUIET;
+		case 'p':
+			return MODE_FLAG_PRIVATE;
+		case 's':
+			return MODE_FLAG_SECRET;
+		case 'r':
+			return MODE_FLAG_SERVER_REOP;
+		case 't':
+			return MODE_FLAG_TOPIC_ONLY_SETTABLE_BY_OPS;
+		default:
+			return 0;
+	}
+}
+
+/* Applies a whole MODE line, however many changes it carries, with a single
+ * change_mode_state() at the end. Member privileges only matter when they are
+ * ours, so changes to anybody else's are skipped over. */
 void idle_muc_channel_mode(IdleMUCChannel *chan, GValueArray *args) {
 	IdleMUCChannelPrivate *priv = chan->priv;
 	TpBaseChannel *base = TP_BASE_CHANNEL (chan);
 	TpBaseConnection *base_conn = tp_base_channel_get_connection (base);
 	TpHandleRepoIface *handles = tp_base_connection_get_handles(base_conn, TP_HANDLE_TYPE_CONTACT);
+	TpHandle self = tp_base_connection_get_self_handle (base_conn);
+	guint add = 0, remove = 0;
+	guint limit = 0;
+	gchar *key = NULL;
 
         tp_base_room_config_set_retrieved (priv->room_config);
 
 	for (guint i = 1; i < args->n_values; i++) {
 		const gchar *modes = g_value_get_string(g_value_array_get_nth(args, i));
 		gchar operation = modes[0];
-		guint mode_accum = 0;
-		guint limit = 0;
-		gchar *key = NULL;
 
 		if ((operation != '+') && (operation != '-'))
 			continue;
 
 		for (; *modes != '\0'; modes++) {
-			switch (*modes) {
-				case 'o':
-				case 'h':
-				case 'v':
-					if ((i + 1) < args->n_values) {
-						TpHandle handle = tp_handle_ensure(handles, g_value_get_string(g_value_array_get_nth(args, ++i)), NULL, NULL);
-
-						if (handle == tp_base_connection_get_self_handle (base_conn)) {
-							IDLE_DEBUG("got MODE '%c' concerning us", *modes);
-							mode_accum |= _modechar_to_modeflag(*modes);
-						}
-					}
-					break;
+			guint flag = _modechar_to_modeflag(*modes);
+			guint privilege = _modechar_to_privilege(*modes);
+
+			if (privilege != 0) {
+				/* a nick nobody has a handle for yet can't be ours */
+				if ((i + 1) < args->n_values &&
+				    tp_handle_lookup(handles, g_value_get_string(g_value_array_get_nth(args, ++i)), NULL, NULL) == self) {
+					IDLE_DEBUG("got MODE '%c' concerning us", *modes);
+					flag = privilege;
+				}
+			}
 
+			switch (*modes) {
 				case 'l':
 					if (operation == '+') {
 						if ((i + 1) < args->n_values) {
@@ -924,8 +998,6 @@ void idle_muc_channel_mode(IdleMUCChannel *chan, GValueArray *args) {
 								limit = maybe_limit;
 						}
 					}
-
-					mode_accum |= MODE_FLAG_USER_LIMIT;
 					break;
 
 				case 'k':
@@ -935,87 +1007,50 @@ void idle_muc_channel_mode(IdleMUCChannel *chan, GValueArray *args) {
 							key = g_strdup(g_value_get_string(g_value_array_get_nth(args, ++i)));
 						}
 					}
-
-					mode_accum |= MODE_FLAG_KEY;
-					break;
-
-				case 'a':
-					mode_accum |= MODE_FLAG_ANONYMOUS;
-					break;
-
-				case 'i':
-					mode_accum |= MODE_FLAG_INVITE_ONLY;
-					break;
-
-				case 'm':
-					mode_accum |= MODE_FLAG_MODERATED;
-					break;
-
-				case 'n':
-					mode_accum |= MODE_FLAG_NO_OUTSIDE_MESSAGES;
-					break;
-
-				case 'q':
-					mode_accum |= MODE_FLAG_QUIET;
-					break;
-
-				case 'p':
-					mode_accum |= MODE_FLAG_PRIVATE;
-					break;
-
-				case 's':
-					mode_accum |= MODE_FLAG_SECRET;
-					break;
-
-				case 'r':
-					mode_accum |= MODE_FLAG_SERVER_REOP;
-					break;
-
-				case 't':
-					mode_accum |= MODE_FLAG_TOPIC_ONLY_SETTABLE_BY_OPS;
 					break;
 
 				case '+':
 				case '-':
-					if (operation != *modes) {
-						if (mode_accum & MODE_FLAG_KEY) {
-							g_free(priv->mode_state.key);
-							priv->mode_state.key = key;
-						}
-
-						if (mode_accum & MODE_FLAG_USER_LIMIT)
-							priv->mode_state.limit = limit;
-
-						if (operation == '+')
-							change_mode_state(chan, mode_accum, 0);
-						else
-							change_mode_state(chan, 0, mode_accum);
-
-						operation = *modes;
-						mode_accum = 0;
-					}
-
+					operation = *modes;
 					break;
 
 				default:
-					IDLE_DEBUG("did not understand mode identifier %c", *modes);
+					if (flag == 0 && privilege == 0)
+						IDLE_DEBUG("did not understand mode identifier %c", *modes);
 					break;
 			}
-		}
 
-		if (mode_accum & MODE_FLAG_KEY) {
-			g_free(priv->mode_state.key);
-			priv->mode_state.key = key;
+			/* later changes in the line win over earlier ones */
+			if (operation == '+') {
+				add |= flag;
+				remove &= ~flag;
+			} else {
+				remove |= flag;
+				add &= ~flag;
+			}
 		}
+	}
 
-		if (mode_accum & MODE_FLAG_USER_LIMIT)
-			priv->mode_state.limit = limit;
-
-		if (operation == '+')
-			change_mode_state(chan, mode_accum, 0);
-		else
-			change_mode_state(chan, 0, mode_accum);
+	if ((add | remove) & MODE_FLAG_KEY) {
+		g_free(priv->mode_state.key);
+		priv->mode_state.key = (add & MODE_FLAG_KEY) ? key : NULL;
+		key = NULL;
 	}
+
+	g_free(key);
+
+	if ((add | remove) & MODE_FLAG_USER_LIMIT)
+		priv->mode_state.limit = (add & MODE_FLAG_USER_LIMIT) ? limit : 0;
+
+	if (add | remove)
+		change_mode_state(chan, add, remove);
+}
+
+/* RPL_CHANNELMODEIS carries the full set of modes, so answers our query
+ * whether we sent it yet or not. */
+void idle_muc_channel_mode_reply(IdleMUCChannel *chan, GValueArray *args) {
+	chan->priv->mode_query_pending = FALSE;
+	idle_muc_channel_mode(chan, args);
 }
 
 void
@@ -1335,10 +1370,11 @@ idle_muc_channel_close (
 	IDLE_DEBUG ("called on %p", self);
 
 	if (priv->state == MUC_STATE_JOINED) {
-		tp_message_mixin_set_rescued (G_OBJECT (self));
+		idle_text_set_rescued (G_OBJECT (self));
 		tp_base_channel_reopened (base, 0);
 	} else {
 	/* FIXME: this is wrong if called while JOIN is in flight. */
+		idle_text_clear (G_OBJECT (self));
 		tp_base_channel_destroyed (base);
 	}
 }
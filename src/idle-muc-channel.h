@@ -83,6 +83,8 @@ void idle_muc_channel_join_attempt(IdleMUCChannel *chan);
 void idle_muc_channel_join_error(IdleMUCChannel *chan, IdleMUCChannelJoinError err);
 void idle_muc_channel_kick(IdleMUCChannel *chan, TpHandle kicked, TpHandle kicker, const gchar *message);
 void idle_muc_channel_mode(IdleMUCChannel *chan, GValueArray *args);
+void idle_muc_channel_mode_reply(IdleMUCChannel *chan, GValueArray *args);
+void idle_muc_channel_send_mode_query(IdleMUCChannel *chan);
 void idle_muc_channel_namereply(IdleMUCChannel *chan, GValueArray *args);
 void idle_muc_channel_namereply_end(IdleMUCChannel *chan);
 void idle_muc_channel_part(IdleMUCChannel *chan, TpHandle leaver, const gchar *message);
@@ -29,10 +29,12 @@
 
 #define IDLE_DEBUG_FLAG IDLE_DEBUG_MUC
 #include "idle-connection.h"
+#include "idle-contact-info.h"
 #include "idle-ctcp.h"
 #include "idle-debug.h"
 #include "idle-muc-channel.h"
 #include "idle-parser.h"
+#include "idle-presence.h"
 #include "idle-text.h"
 
 static void _muc_manager_iface_init(gpointer, gpointer);
@@ -56,10 +58,18 @@ struct _IdleMUCManagerPrivate {
 	 * request tokens. */
 	GHashTable *queued_requests;
 
+	/* Rooms we joined during the current join burst, by handle */
+	GArray *joined_rooms;
+	guint post_join_id;
+
 	gulong status_changed_id;
 	gboolean dispose_has_run;
 };
 
+/* How long the server has to stay quiet about our joins before we ask it for
+ * the modes and members of the channels we joined, in milliseconds */
+#define POST_JOIN_DELAY 1000
+
 #define IDLE_MUC_MANAGER_GET_PRIVATE(obj) (G_TYPE_INSTANCE_GET_PRIVATE((obj), IDLE_TYPE_MUC_MANAGER, IdleMUCManagerPrivate))
 
 static IdleParserHandlerResult _numeric_error_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data);
@@ -136,6 +146,7 @@ static void idle_muc_manager_init(IdleMUCManager *obj) {
 
 	priv->channels = g_hash_table_new_full(g_direct_hash, g_direct_equal, NULL, g_object_unref);
 	priv->queued_requests = g_hash_table_new(NULL, NULL);
+	priv->joined_rooms = g_array_new(FALSE, FALSE, sizeof(TpHandle));
 }
 
 static void idle_muc_manager_get_property(GObject *object, guint property_id, GValue *value, GParamSpec *pspec) {
@@ -292,6 +303,45 @@ static IdleParserHandlerResult _invite_handler(IdleParser *parser, IdleParserMes
 	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
 }
 
+static gboolean _send_post_join_queries(gpointer user_data) {
+	IdleMUCManagerPrivate *priv = IDLE_MUC_MANAGER_GET_PRIVATE(user_data);
+	TpHandleRepoIface *room_handles = tp_base_connection_get_handles(TP_BASE_CONNECTION(priv->conn), TP_HANDLE_TYPE_ROOM);
+
+	priv->post_join_id = 0;
+
+	for (guint i = 0; i < priv->joined_rooms->len; i++) {
+		TpHandle room_handle = g_array_index(priv->joined_rooms, TpHandle, i);
+		IdleMUCChannel *chan = NULL;
+
+		if (priv->channels)
+			chan = g_hash_table_lookup(priv->channels, GUINT_TO_POINTER(room_handle));
+
+		if (!chan)
+			continue;
+
+		/* does nothing if a 324 beat us to it */
+		idle_muc_channel_send_mode_query(chan);
+		idle_contact_info_request_members(priv->conn, tp_handle_inspect(room_handles, room_handle));
+	}
+
+	g_array_set_size(priv->joined_rooms, 0);
+
+	return FALSE;
+}
+
+static void _queue_post_join_queries(IdleMUCManager *manager, TpHandle room_handle) {
+	IdleMUCManagerPrivate *priv = IDLE_MUC_MANAGER_GET_PRIVATE(manager);
+
+	g_array_append_val(priv->joined_rooms, room_handle);
+
+	/* on reconnect the server confirms dozens of joins in a row; only ask
+	 * about any of them once it has finished */
+	if (priv->post_join_id)
+		g_source_remove(priv->post_join_id);
+
+	priv->post_join_id = g_timeout_add(POST_JOIN_DELAY, _send_post_join_queries, manager);
+}
+
 static IdleParserHandlerResult _join_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
 	IdleMUCManager *manager = IDLE_MUC_MANAGER(user_data);
 	IdleMUCManagerPrivate *priv = IDLE_MUC_MANAGER_GET_PRIVATE(manager);
@@ -316,9 +366,30 @@ static IdleParserHandlerResult _join_handler(IdleParser *parser, IdleParserMessa
 
 	idle_muc_channel_join(chan, joiner_handle);
 
+	if (joiner_handle == tp_base_connection_get_self_handle(TP_BASE_CONNECTION(priv->conn)))
+		_queue_post_join_queries(manager, room_handle);
+
 	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
 }
 
+/* Once somebody has left the last channel we share with them, their presence
+ * is no longer worth watching */
+static void _member_left(IdleMUCManagerPrivate *priv, TpHandle handle) {
+	GHashTableIter iter;
+	gpointer chan;
+
+	if (handle == tp_base_connection_get_self_handle(TP_BASE_CONNECTION(priv->conn)))
+		return;
+
+	g_hash_table_iter_init(&iter, priv->channels);
+	while (g_hash_table_iter_next(&iter, NULL, &chan)) {
+		if (tp_handle_set_is_member(IDLE_MUC_CHANNEL(chan)->group.members, handle))
+			return;
+	}
+
+	idle_presence_unwatch(priv->conn, handle);
+}
+
 static IdleParserHandlerResult _kick_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
 	IdleMUCManagerPrivate *priv = IDLE_MUC_MANAGER_GET_PRIVATE(user_data);
 	TpHandle kicker_handle = g_value_get_uint(g_value_array_get_nth(args, 0));
@@ -334,8 +405,10 @@ static IdleParserHandlerResult _kick_handler(IdleParser *parser, IdleParserMessa
 
 	chan = g_hash_table_lookup(priv->channels, GUINT_TO_POINTER(room_handle));
 
-	if (chan)
+	if (chan) {
 		idle_muc_channel_kick(chan, kicked_handle, kicker_handle, message);
+		_member_left(priv, kicked_handle);
+	}
 
 	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
 }
@@ -388,7 +461,12 @@ static IdleParserHandlerResult _mode_handler(IdleParser *parser, IdleParserMessa
 
 	chan = g_hash_table_lookup(priv->channels, GUINT_TO_POINTER(room_handle));
 
-	if (chan)
+	if (!chan)
+		return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+
+	if (code == IDLE_PARSER_NUMERIC_MODEREPLY)
+		idle_muc_channel_mode_reply(chan, args);
+	else
 		idle_muc_channel_mode(chan, args);
 
 	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
@@ -473,8 +551,10 @@ static IdleParserHandlerResult _part_handler(IdleParser *parser, IdleParserMessa
 
 	chan = g_hash_table_lookup(priv->channels, GUINT_TO_POINTER(room_handle));
 
-	if (chan)
+	if (chan) {
 		idle_muc_channel_part(chan, leaver_handle, message);
+		_member_left(priv, leaver_handle);
+	}
 
 	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
 }
@@ -537,6 +617,13 @@ static void _muc_manager_close_all(IdleMUCManager *manager)
 		priv->status_changed_id = 0;
 	}
 
+	if (priv->post_join_id) {
+		g_source_remove(priv->post_join_id);
+		priv->post_join_id = 0;
+	}
+
+	tp_clear_pointer (&priv->joined_rooms, g_array_unref);
+
 	if (!priv->channels) {
 		IDLE_DEBUG("Channels already closed, ignoring...");
 		return;
@@ -32,6 +32,7 @@
 
 #include <string.h>
 #include <stdio.h>
+#include <stdlib.h>
 
 #define IDLE_DEBUG_FLAG IDLE_DEBUG_PARSER
 #include "idle-debug.h"
@@ -123,27 +124,72 @@ static const MessageSpec message_specs[] = {
 	{"322", "IIIrd.", IDLE_PARSER_NUMERIC_LIST},
 	{"323", "I", IDLE_PARSER_NUMERIC_LISTEND},
 	{"421", "IIIs:", IDLE_PARSER_NUMERIC_UNKNOWNCOMMAND},
+	{"005", "IIIvs", IDLE_PARSER_NUMERIC_ISUPPORT},
+	/* WHOX reply to WHO <mask> %tnuhraf,<querytype> */
+	{"354", "IIIssscss:", IDLE_PARSER_NUMERIC_WHOSPCRPL},
+	{"303", "III.", IDLE_PARSER_NUMERIC_ISON},
+	{"730", "III:", IDLE_PARSER_NUMERIC_MONONLINE},
+	{"731", "III:", IDLE_PARSER_NUMERIC_MONOFFLINE},
+	{"734", "IIIds.", IDLE_PARSER_NUMERIC_MONLISTFULL},
 
 	{NULL, NULL, IDLE_PARSER_LAST_MESSAGE_CODE}
 };
 
+/* If IDLE_PARSER_STATS is set, every message code and every handler gets a
+ * count of calls and a histogram of how long they took, which are dumped to
+ * the debug log every IDLE_PARSER_STATS seconds and when the parser goes away.
+ * Durations are in microseconds, in power-of-two buckets: bucket 0 is under
+ * 1us, bucket i under 2^i us, and the last bucket holds everything longer. */
+#define STATS_BUCKETS 16
+
+typedef struct _TimingStats TimingStats;
+struct _TimingStats {
+	guint64 calls;
+	gint64 total;
+	gint64 max;
+	guint64 buckets[STATS_BUCKETS];
+};
+
+static void _timing_stats_add(TimingStats *stats, gint64 elapsed) {
+	guint bucket = (elapsed > 0) ? g_bit_storage((gulong) elapsed) : 0;
+
+	stats->calls++;
+	stats->total += elapsed;
+	stats->max = MAX(stats->max, elapsed);
+	stats->buckets[MIN(bucket, STATS_BUCKETS - 1)]++;
+}
+
 typedef struct _MessageHandlerClosure MessageHandlerClosure;
 struct _MessageHandlerClosure {
 	IdleParserMessageHandler handler;
 	gpointer user_data;
 	guint priority;
+	IdleParserMessageCode code;
+
+	/* 0 once the handler has been removed */
+	guint id;
+
+	/* owned by the parser's handler_stats, if it is collecting them */
+	TimingStats *stats;
 };
 
-static MessageHandlerClosure *_message_handler_closure_new(IdleParserMessageHandler handler, gpointer user_data, IdleParserHandlerPriority priority) {
+static MessageHandlerClosure *_message_handler_closure_new(IdleParserMessageHandler handler, gpointer user_data, IdleParserHandlerPriority priority, IdleParserMessageCode code, guint id) {
 	MessageHandlerClosure *closure = g_slice_new(MessageHandlerClosure);
 
 	closure->handler = handler;
 	closure->user_data = user_data;
 	closure->priority = priority;
+	closure->code = code;
+	closure->id = id;
+	closure->stats = NULL;
 
 	return closure;
 }
 
+static void _message_handler_closure_free(gpointer data) {
+	g_slice_free(MessageHandlerClosure, data);
+}
+
 typedef struct _IdleParserPrivate IdleParserPrivate;
 struct _IdleParserPrivate {
 	/* connection object (for handle repos) */
@@ -152,11 +198,56 @@ struct _IdleParserPrivate {
 	/* continuation line buffer */
 	gchar split_buf[IRC_MSG_MAXLEN + 3];
 
-	/* message handlers */
-	GSList *handlers[IDLE_PARSER_LAST_MESSAGE_CODE];
+	/* message handlers: for each code, an array of closures in the order
+	 * they are called, made when the first handler is added */
+	GPtrArray *handlers[IDLE_PARSER_LAST_MESSAGE_CODE];
+
+	/* handler ID => closure, and user_data => GPtrArray of its closures, so
+	 * that removing a handler, or all of an owner's, doesn't search every
+	 * code */
+	GHashTable *handlers_by_id;
+	GHashTable *handlers_by_owner;
+	guint last_handler_id;
+
+	/* While handlers are being called the arrays stay as they are: removed
+	 * closures are only marked, and new ones wait in added_while_dispatching,
+	 * until the outermost dispatch is over. Only the codes listed in
+	 * removed_while_dispatching have their arrays compacted then. */
+	guint dispatching;
+	GArray *removed_while_dispatching;
+	gboolean removed_from[IDLE_PARSER_LAST_MESSAGE_CODE];
+	GPtrArray *added_while_dispatching;
+
+	/* only if IDLE_PARSER_STATS is set: TimingStats per message code, and
+	 * per handler keyed by "owner/handler", so that a handler's numbers add
+	 * up across channels adding and removing it */
+	TimingStats *code_stats;
+	GHashTable *handler_stats;
+	guint stats_dump_id;
 };
 
+static gboolean _dump_stats_cb(gpointer user_data);
+
 static void idle_parser_init(IdleParser *obj) {
+	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(obj);
+	const gchar *interval = g_getenv("IDLE_PARSER_STATS");
+	gint seconds;
+
+	priv->handlers_by_id = g_hash_table_new(NULL, NULL);
+	priv->handlers_by_owner = g_hash_table_new_full(NULL, NULL, NULL, (GDestroyNotify) g_ptr_array_unref);
+	priv->removed_while_dispatching = g_array_new(FALSE, FALSE, sizeof(IdleParserMessageCode));
+	priv->added_while_dispatching = g_ptr_array_new_with_free_func(_message_handler_closure_free);
+
+	if (tp_str_empty(interval))
+		return;
+
+	priv->code_stats = g_new0(TimingStats, IDLE_PARSER_LAST_MESSAGE_CODE);
+	priv->handler_stats = g_hash_table_new_full(g_str_hash, g_str_equal, g_free, g_free);
+
+	seconds = atoi(interval);
+
+	if (seconds > 0)
+		priv->stats_dump_id = g_timeout_add_seconds(seconds, _dump_stats_cb, obj);
 }
 
 static void idle_parser_set_property(GObject *obj, guint prop_id, const GValue *value, GParamSpec *pspec) {
@@ -179,18 +270,31 @@ static void idle_parser_get_property(GObject *obj, guint prop_id, GValue *value,
 	}
 }
 
+static void _dump_stats(IdleParser *parser);
+
 static void idle_parser_finalize(GObject *obj) {
 	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(obj);
 	int i;
 
-	for (i = 0; i < IDLE_PARSER_LAST_MESSAGE_CODE; i++) {
-		GSList *link_;
+	if (priv->code_stats != NULL) {
+		_dump_stats(IDLE_PARSER(obj));
 
-		for (link_ = priv->handlers[i]; link_ != NULL; link_ = link_->next)
-			g_slice_free(MessageHandlerClosure, link_->data);
+		if (priv->stats_dump_id != 0)
+			g_source_remove(priv->stats_dump_id);
 
-		g_slist_free(priv->handlers[i]);
+		g_free(priv->code_stats);
+		g_hash_table_destroy(priv->handler_stats);
 	}
+
+	for (i = 0; i < IDLE_PARSER_LAST_MESSAGE_CODE; i++) {
+		if (priv->handlers[i] != NULL)
+			g_ptr_array_unref(priv->handlers[i]);
+	}
+
+	g_array_unref(priv->removed_while_dispatching);
+	g_ptr_array_unref(priv->added_while_dispatching);
+	g_hash_table_destroy(priv->handlers_by_id);
+	g_hash_table_destroy(priv->handlers_by_owner);
 }
 
 static void idle_parser_class_init(IdleParserClass *klass) {
@@ -210,7 +314,7 @@ static void idle_parser_class_init(IdleParserClass *klass) {
 
 static void _parse_message(IdleParser *parser, const gchar *split_msg);
 static void _parse_and_forward_one(IdleParser *parser, gchar **tokens, IdleParserMessageCode code, const gchar *format);
-static gboolean _parse_atom(IdleParser *parser, GValueArray *arr, char atom, const gchar *token, TpHandleSet *contact_reffed, TpHandleSet *room_reffed);
+static gboolean _parse_atom(IdleParser *parser, GValueArray *arr, char atom, const gchar *token, TpHandleSet **contact_reffed, TpHandleSet **room_reffed);
 
 #ifndef HAVE_STRNLEN
 static size_t
@@ -250,7 +354,11 @@ void idle_parser_receive(IdleParser *parser, const gchar *msg) {
 					tmp = g_strndup(msg + lasti, i - lasti);
 				}
 
-				g_signal_emit(parser, signals[SIGNAL_MSG_SPLIT], 0, tmp);
+				/* Nothing inside Idle listens to this, so don't pay for
+				 * marshalling every line unless somebody does */
+				if (g_signal_has_handler_pending(parser, signals[SIGNAL_MSG_SPLIT], 0, TRUE))
+					g_signal_emit(parser, signals[SIGNAL_MSG_SPLIT], 0, tmp);
+
 				_parse_message(parser, tmp);
 
 				if (tmp != concat_buf)
@@ -270,42 +378,242 @@ void idle_parser_receive(IdleParser *parser, const gchar *msg) {
 		memset(priv->split_buf, '\0', IRC_MSG_MAXLEN + 3);
 }
 
-void idle_parser_add_handler(IdleParser *parser, IdleParserMessageCode code, IdleParserMessageHandler handler, gpointer user_data) {
-	idle_parser_add_handler_with_priority(parser, code, handler, user_data, IDLE_PARSER_HANDLER_PRIORITY_DEFAULT);
-	return;
+static gchar *_stats_line(const gchar *name, const TimingStats *stats) {
+	GString *line = g_string_new(NULL);
+	guint last = STATS_BUCKETS;
+	guint i;
+
+	g_string_printf(line, "%s: %" G_GUINT64_FORMAT " calls, %" G_GINT64_FORMAT "us total, %" G_GINT64_FORMAT "us max; histogram",
+		name, stats->calls, stats->total, stats->max);
+
+	while (last > 0 && stats->buckets[last - 1] == 0)
+		last--;
+
+	for (i = 0; i < last; i++)
+		g_string_append_printf(line, " %" G_GUINT64_FORMAT, stats->buckets[i]);
+
+	return g_string_free(line, FALSE);
+}
+
+static gint _stats_compare_total(gconstpointer a, gconstpointer b, gpointer user_data) {
+	GHashTable *handler_stats = user_data;
+	const TimingStats *_a = g_hash_table_lookup(handler_stats, *(const gchar * const *) a);
+	const TimingStats *_b = g_hash_table_lookup(handler_stats, *(const gchar * const *) b);
+
+	return (_a->total == _b->total) ? 0 : (_a->total > _b->total) ? -1 : 1;
+}
+
+static void _dump_stats(IdleParser *parser) {
+	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(parser);
+	GPtrArray *names = g_ptr_array_new();
+	GHashTableIter iter;
+	gpointer name;
+	guint i;
+
+	IDLE_DEBUG("message codes (histogram buckets are <1us, <2us, <4us, ...):");
+
+	for (i = 0; i < IDLE_PARSER_LAST_MESSAGE_CODE; i++) {
+		gchar *line;
+
+		if (priv->code_stats[i].calls == 0)
+			continue;
+
+		line = _stats_line(message_specs[i].str, &priv->code_stats[i]);
+		IDLE_DEBUG("  %s", line);
+		g_free(line);
+	}
+
+	g_hash_table_iter_init(&iter, priv->handler_stats);
+
+	while (g_hash_table_iter_next(&iter, &name, NULL))
+		g_ptr_array_add(names, name);
+
+	g_ptr_array_sort_with_data(names, _stats_compare_total, priv->handler_stats);
+
+	IDLE_DEBUG("handlers, most expensive first:");
+
+	for (i = 0; i < names->len; i++) {
+		gchar *line = _stats_line(g_ptr_array_index(names, i), g_hash_table_lookup(priv->handler_stats, g_ptr_array_index(names, i)));
+
+		IDLE_DEBUG("  %s", line);
+		g_free(line);
+	}
+
+	g_ptr_array_free(names, TRUE);
+}
+
+static gboolean _dump_stats_cb(gpointer user_data) {
+	_dump_stats(IDLE_PARSER(user_data));
+
+	return TRUE;
+}
+
+/* Finds or makes the stats for a handler, named after the source file it was
+ * added from and its function, eg. "idle-muc-manager/_namereply_handler". */
+static TimingStats *_handler_stats(IdleParserPrivate *priv, const gchar *name, const gchar *owner) {
+	gchar *basename = g_path_get_basename(owner);
+	gchar *dot = strrchr(basename, '.');
+	gchar *key;
+	TimingStats *stats;
+
+	if (dot != NULL)
+		*dot = '\0';
+
+	key = g_strdup_printf("%s/%s", basename, name);
+	g_free(basename);
+
+	stats = g_hash_table_lookup(priv->handler_stats, key);
+
+	if (stats == NULL) {
+		stats = g_new0(TimingStats, 1);
+		g_hash_table_insert(priv->handler_stats, key, stats);
+	} else {
+		g_free(key);
+	}
+
+	return stats;
 }
 
-static gint _message_handler_closure_priority_compare(gconstpointer a, gconstpointer b) {
-	const MessageHandlerClosure *_a = a, *_b = b;
+/* Before the first handler of the same or a later priority, as
+ * g_slist_insert_sorted() used to put it. */
+static void _insert_closure(IdleParserPrivate *priv, MessageHandlerClosure *closure) {
+	GPtrArray *handlers = priv->handlers[closure->code];
+	guint i;
+
+	if (handlers == NULL)
+		handlers = priv->handlers[closure->code] = g_ptr_array_new_with_free_func(_message_handler_closure_free);
+
+	for (i = 0; i < handlers->len; i++) {
+		const MessageHandlerClosure *other = g_ptr_array_index(handlers, i);
 
-	return (_a->priority == _b->priority) ? 0 : (_a->priority < _b->priority) ? -1 : 1;
+		if (other->priority >= closure->priority)
+			break;
+	}
+
+	g_ptr_array_add(handlers, NULL);
+	memmove(handlers->pdata + i + 1, handlers->pdata + i, (handlers->len - 1 - i) * sizeof(gpointer));
+	handlers->pdata[i] = closure;
 }
 
-void idle_parser_add_handler_with_priority(IdleParser *parser, IdleParserMessageCode code, IdleParserMessageHandler handler, gpointer user_data, IdleParserHandlerPriority priority) {
+guint idle_parser_add_named_handler(IdleParser *parser, IdleParserMessageCode code, IdleParserMessageHandler handler, gpointer user_data, IdleParserHandlerPriority priority, const gchar *name, const gchar *owner) {
 	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(parser);
+	MessageHandlerClosure *closure;
+	GPtrArray *owned;
 
 	if (code >= IDLE_PARSER_LAST_MESSAGE_CODE)
+		return 0;
+
+	closure = _message_handler_closure_new(handler, user_data, priority, code, ++priv->last_handler_id);
+
+	if (priv->handler_stats != NULL)
+		closure->stats = _handler_stats(priv, name, owner);
+
+	g_hash_table_insert(priv->handlers_by_id, GUINT_TO_POINTER(closure->id), closure);
+
+	owned = g_hash_table_lookup(priv->handlers_by_owner, user_data);
+
+	if (owned == NULL) {
+		owned = g_ptr_array_new();
+		g_hash_table_insert(priv->handlers_by_owner, user_data, owned);
+	}
+
+	g_ptr_array_add(owned, closure);
+
+	if (priv->dispatching > 0)
+		g_ptr_array_add(priv->added_while_dispatching, closure);
+	else
+		_insert_closure(priv, closure);
+
+	return closure->id;
+}
+
+static void _remove_closure(IdleParserPrivate *priv, MessageHandlerClosure *closure, gboolean from_owner) {
+	g_hash_table_remove(priv->handlers_by_id, GUINT_TO_POINTER(closure->id));
+	closure->id = 0;
+
+	if (from_owner) {
+		GPtrArray *owned = g_hash_table_lookup(priv->handlers_by_owner, closure->user_data);
+
+		g_ptr_array_remove_fast(owned, closure);
+
+		if (owned->len == 0)
+			g_hash_table_remove(priv->handlers_by_owner, closure->user_data);
+	}
+
+	/* it is either in its code's array or waiting to be added; either way,
+	 * _dispatch_done() deals with it */
+	if (priv->dispatching > 0) {
+		if (!priv->removed_from[closure->code]) {
+			priv->removed_from[closure->code] = TRUE;
+			g_array_append_val(priv->removed_while_dispatching, closure->code);
+		}
+
 		return;
+	}
 
-	priv->handlers[code] = g_slist_insert_sorted(priv->handlers[code], _message_handler_closure_new(handler, user_data, priority), _message_handler_closure_priority_compare);
+	g_ptr_array_remove(priv->handlers[closure->code], closure);
 }
 
-static gint _message_handler_closure_user_data_compare(gconstpointer a, gconstpointer b) {
-	const MessageHandlerClosure *_a = a, *_b = b;
+void idle_parser_remove_handler(IdleParser *parser, guint id) {
+	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(parser);
+	MessageHandlerClosure *closure = g_hash_table_lookup(priv->handlers_by_id, GUINT_TO_POINTER(id));
 
-	return (_a->user_data == _b->user_data) ? 0 : 1;
+	if (closure != NULL)
+		_remove_closure(priv, closure, TRUE);
 }
 
 void idle_parser_remove_handlers_by_data(IdleParser *parser, gpointer user_data) {
 	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(parser);
-	int i;
+	GPtrArray *owned = g_hash_table_lookup(priv->handlers_by_owner, user_data);
+	guint i;
 
-	for (i = 0; i < IDLE_PARSER_LAST_MESSAGE_CODE; i++) {
-		GSList *link_;
+	if (owned == NULL)
+		return;
+
+	g_hash_table_steal(priv->handlers_by_owner, user_data);
+
+	for (i = 0; i < owned->len; i++)
+		_remove_closure(priv, g_ptr_array_index(owned, i), FALSE);
+
+	g_ptr_array_unref(owned);
+}
+
+/* Catches the handler arrays up with whatever was added or removed while
+ * handlers were being called. */
+static void _dispatch_done(IdleParserPrivate *priv) {
+	guint i;
+
+	for (i = 0; i < priv->removed_while_dispatching->len; i++) {
+		IdleParserMessageCode code = g_array_index(priv->removed_while_dispatching, IdleParserMessageCode, i);
+		GPtrArray *handlers = priv->handlers[code];
+		guint j = 0;
+
+		priv->removed_from[code] = FALSE;
+
+		while (handlers != NULL && j < handlers->len) {
+			const MessageHandlerClosure *closure = g_ptr_array_index(handlers, j);
+
+			if (closure->id == 0)
+				g_ptr_array_remove_index(handlers, j);
+			else
+				j++;
+		}
+	}
+
+	g_array_set_size(priv->removed_while_dispatching, 0);
+
+	for (i = 0; i < priv->added_while_dispatching->len; i++) {
+		MessageHandlerClosure *closure = g_ptr_array_index(priv->added_while_dispatching, i);
+
+		if (closure->id == 0)
+			continue;
 
-		while ((link_ = g_slist_find_custom(priv->handlers[i], user_data, _message_handler_closure_user_data_compare)))
-			priv->handlers[i] = g_slist_remove_link(priv->handlers[i], link_);
+		/* the array's free function mustn't have this one */
+		priv->added_while_dispatching->pdata[i] = NULL;
+		_insert_closure(priv, closure);
 	}
+
+	g_ptr_array_set_size(priv->added_while_dispatching, 0);
 }
 
 static gchar **_tokenize(const gchar *str) {
@@ -369,23 +677,29 @@ static void _parse_message(IdleParser *parser, const gchar *split_msg) {
 static void _parse_and_forward_one(IdleParser *parser, gchar **tokens, IdleParserMessageCode code, const gchar *format) {
 	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(parser);
 	GValueArray *args = g_value_array_new(3);
-	GSList *link_ = priv->handlers[code];
+	GPtrArray *handlers = priv->handlers[code];
+	guint i;
 	IdleParserHandlerResult result = IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
 	gboolean success = TRUE;
 	gchar **iter = tokens;
-	/* We keep a ref to each unique handle in a message so that we can unref them after calling all handlers */
-	TpHandleSet *contact_reffed = tp_handle_set_new(tp_base_connection_get_handles(TP_BASE_CONNECTION(priv->conn), TP_HANDLE_TYPE_CONTACT));
-	TpHandleSet *room_reffed = tp_handle_set_new(tp_base_connection_get_handles(TP_BASE_CONNECTION(priv->conn), TP_HANDLE_TYPE_ROOM));
+	/* We keep a ref to each unique handle in a message so that we can unref them after calling all handlers;
+	 * the sets are only made for messages which name contacts or rooms */
+	TpHandleSet *contact_reffed = NULL;
+	TpHandleSet *room_reffed = NULL;
+	gint64 started = 0;
 
 	IDLE_DEBUG("message code %u", code);
 
+	if (G_UNLIKELY(priv->code_stats != NULL))
+		started = g_get_monotonic_time();
+
 	while ((*format != '\0') && success && (*iter != NULL)) {
 		GValue val = {0};
 
 		if (*format == 'v') {
 			format++;
 			while (*iter != NULL) {
-				if (!_parse_atom(parser, args, *format, iter[0], contact_reffed, room_reffed)) {
+				if (!_parse_atom(parser, args, *format, iter[0], &contact_reffed, &room_reffed)) {
 					success = FALSE;
 					break;
 				}
@@ -429,7 +743,7 @@ static void _parse_and_forward_one(IdleParser *parser, gchar **tokens, IdleParse
 
 			IDLE_DEBUG("set string \"%s\"", trailing);
 		} else {
-			if (!_parse_atom(parser, args, *format, iter[0], contact_reffed, room_reffed)) {
+			if (!_parse_atom(parser, args, *format, iter[0], &contact_reffed, &room_reffed)) {
 				success = FALSE;
 				break;
 			}
@@ -453,37 +767,54 @@ static void _parse_and_forward_one(IdleParser *parser, gchar **tokens, IdleParse
 
 	IDLE_DEBUG("successfully parsed");
 
-	while (link_) {
-		MessageHandlerClosure *closure = link_->data;
+	priv->dispatching++;
+
+	for (i = 0; handlers != NULL && i < handlers->len; i++) {
+		MessageHandlerClosure *closure = g_ptr_array_index(handlers, i);
+		gint64 handler_started = 0;
+
+		/* removed by an earlier handler for this message */
+		if (closure->id == 0)
+			continue;
+
+		if (G_UNLIKELY(closure->stats != NULL))
+			handler_started = g_get_monotonic_time();
+
 		result = closure->handler(parser, code, args, closure->user_data);
+
+		if (G_UNLIKELY(closure->stats != NULL))
+			_timing_stats_add(closure->stats, g_get_monotonic_time() - handler_started);
+
 		if (result == IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED) {
-			link_ = link_->next;
+			continue;
 		} else if (result == IDLE_PARSER_HANDLER_RESULT_HANDLED) {
 			break;
 		} else if (result == IDLE_PARSER_HANDLER_RESULT_NO_MORE_PLEASE) {
-			GSList *tmp = link_->next;
-			g_free(closure);
-			priv->handlers[code] = g_slist_remove_link(priv->handlers[code], link_);
-			link_ = tmp;
+			if (closure->id != 0)
+				_remove_closure(priv, closure, TRUE);
 		} else {
 			g_assert_not_reached();
 		}
 	}
 
+	if (--priv->dispatching == 0)
+		_dispatch_done(priv);
+
 cleanup:
 
 	g_value_array_free(args);
 
-	tp_handle_set_destroy(contact_reffed);
-	tp_handle_set_destroy(room_reffed);
+	tp_clear_pointer(&contact_reffed, tp_handle_set_destroy);
+	tp_clear_pointer(&room_reffed, tp_handle_set_destroy);
+
+	if (G_UNLIKELY(priv->code_stats != NULL))
+		_timing_stats_add(&priv->code_stats[code], g_get_monotonic_time() - started);
 }
 
-static gboolean _parse_atom(IdleParser *parser, GValueArray *arr, char atom, const gchar *token, TpHandleSet *contact_reffed, TpHandleSet *room_reffed) {
+static gboolean _parse_atom(IdleParser *parser, GValueArray *arr, char atom, const gchar *token, TpHandleSet **contact_reffed, TpHandleSet **room_reffed) {
 	IdleParserPrivate *priv = IDLE_PARSER_GET_PRIVATE(parser);
 	TpHandle handle;
 	GValue val = {0};
-	TpHandleRepoIface *contact_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(priv->conn), TP_HANDLE_TYPE_CONTACT);
-	TpHandleRepoIface *room_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(priv->conn), TP_HANDLE_TYPE_ROOM);
 
 	if (token[0] == ':')
 		token++;
@@ -516,12 +847,22 @@ static gboolean _parse_atom(IdleParser *parser, GValueArray *arr, char atom, con
 			}
 
 			if (atom == 'r') {
+				TpHandleRepoIface *room_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(priv->conn), TP_HANDLE_TYPE_ROOM);
+
 				if ((handle = tp_handle_ensure(room_repo, id, NULL, NULL))) {
-					tp_handle_set_add(room_reffed, handle);
+					if (*room_reffed == NULL)
+						*room_reffed = tp_handle_set_new(room_repo);
+
+					tp_handle_set_add(*room_reffed, handle);
 				}
 			} else {
+				TpHandleRepoIface *contact_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(priv->conn), TP_HANDLE_TYPE_CONTACT);
+
 				if ((handle = tp_handle_ensure(contact_repo, id, NULL, NULL))) {
-					tp_handle_set_add(contact_reffed, handle);
+					if (*contact_reffed == NULL)
+						*contact_reffed = tp_handle_set_new(contact_repo);
+
+					tp_handle_set_add(*contact_reffed, handle);
 
 					idle_connection_canon_nick_receive(priv->conn, handle, id);
 				}
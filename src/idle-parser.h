@@ -98,6 +98,12 @@ typedef enum {
 	IDLE_PARSER_NUMERIC_LIST,
 	IDLE_PARSER_NUMERIC_LISTEND,
 	IDLE_PARSER_NUMERIC_UNKNOWNCOMMAND,
+	IDLE_PARSER_NUMERIC_ISUPPORT,
+	IDLE_PARSER_NUMERIC_WHOSPCRPL,
+	IDLE_PARSER_NUMERIC_ISON,
+	IDLE_PARSER_NUMERIC_MONONLINE,
+	IDLE_PARSER_NUMERIC_MONOFFLINE,
+	IDLE_PARSER_NUMERIC_MONLISTFULL,
 
 	IDLE_PARSER_LAST_MESSAGE_CODE
 } IdleParserMessageCode;
@@ -131,8 +137,17 @@ typedef IdleParserHandlerResult (*IdleParserMessageHandler)(IdleParser *parser,
 GType idle_parser_get_type(void);
 
 void idle_parser_receive(IdleParser *parser, const gchar *raw_msg);
-void idle_parser_add_handler(IdleParser *parser, IdleParserMessageCode code, IdleParserMessageHandler handler, gpointer user_data);
-void idle_parser_add_handler_with_priority(IdleParser *parser, IdleParserMessageCode code, IdleParserMessageHandler handler, gpointer user_data, IdleParserHandlerPriority priority);
+guint idle_parser_add_named_handler(IdleParser *parser, IdleParserMessageCode code, IdleParserMessageHandler handler, gpointer user_data, IdleParserHandlerPriority priority, const gchar *name, const gchar *owner);
+
+/* These name the handler after its function and the file adding it, for the
+ * timings collected with IDLE_PARSER_STATS. They return an ID which can be
+ * passed to idle_parser_remove_handler(). */
+#define idle_parser_add_handler(parser, code, handler, user_data) \
+	idle_parser_add_named_handler(parser, code, handler, user_data, IDLE_PARSER_HANDLER_PRIORITY_DEFAULT, #handler, __FILE__)
+
+#define idle_parser_add_handler_with_priority(parser, code, handler, user_data, priority) \
+	idle_parser_add_named_handler(parser, code, handler, user_data, priority, #handler, __FILE__)
+void idle_parser_remove_handler(IdleParser *parser, guint id);
 void idle_parser_remove_handlers_by_data(IdleParser *parser, gpointer user_data);
 
 G_END_DECLS
@@ -0,0 +1,599 @@
+/*
+ * This file is part of telepathy-idle
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public License
+ * version 2.1 as published by the Free Software Foundation.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#include "config.h"
+#include "idle-presence.h"
+
+#include <stdlib.h>
+#include <string.h>
+
+#include <telepathy-glib/telepathy-glib-dbus.h>
+
+#define IDLE_DEBUG_FLAG IDLE_DEBUG_CONNECTION
+#include "idle-debug.h"
+#include "idle-parser.h"
+
+/* How long to wait for more contacts to be asked about before telling the
+ * server to watch them, in milliseconds */
+#define PRESENCE_FLUSH_DELAY 500
+
+/* How often contacts who do not fit in the MONITOR list are polled with ISON,
+ * in seconds */
+#define ISON_POLL_INTERVAL 60
+
+/* How many contacts are polled with ISON at most; any more wait, with their
+ * presence unknown, until others are no longer watched */
+#define ISON_POLL_MAX 100
+
+typedef enum {
+	IDLE_PRESENCE_AVAILABLE,
+	IDLE_PRESENCE_AWAY,
+	IDLE_PRESENCE_OFFLINE,
+	IDLE_PRESENCE_UNKNOWN,
+	LAST_IDLE_PRESENCE_ENUM
+} IdlePresenceIndex;
+
+static const TpPresenceStatusOptionalArgumentSpec message_args[] = {
+	{"message", "s"},
+	{NULL, NULL}
+};
+
+static const TpPresenceStatusSpec presence_statuses[] = {
+	{"available", TP_CONNECTION_PRESENCE_TYPE_AVAILABLE, TRUE, message_args},
+	{"away", TP_CONNECTION_PRESENCE_TYPE_AWAY, TRUE, message_args},
+	{"offline", TP_CONNECTION_PRESENCE_TYPE_OFFLINE, FALSE, NULL},
+	{"unknown", TP_CONNECTION_PRESENCE_TYPE_UNKNOWN, FALSE, NULL},
+	{NULL}
+};
+
+struct _IdlePresenceTracker {
+	/* TpHandle -> IdlePresenceIndex of every contact a client asked about */
+	GHashTable *statuses;
+
+	/* watched contacts the server has not been told about yet, and those it
+	 * is to stop telling us about */
+	TpHandleSet *unsent;
+	TpHandleSet *unmonitor;
+
+	/* contacts on the server's MONITOR list, and those polled with ISON */
+	TpHandleSet *monitored;
+	TpHandleSet *polled;
+
+	/* a GArray of the TpHandles in each ISON we are awaiting a reply to;
+	 * each ISON also asks about us, to tell its reply from those to
+	 * anyone else's */
+	GQueue ison_batches;
+
+	guint flush_id;
+	guint poll_id;
+
+	IdlePresenceIndex self_status;
+	gchar *self_message;
+};
+
+static gboolean _is_connected(IdleConnection *conn) {
+	return tp_base_connection_get_status(TP_BASE_CONNECTION(conn)) == TP_CONNECTION_STATUS_CONNECTED;
+}
+
+static void _set_contact_status(IdleConnection *conn, TpHandle handle, IdlePresenceIndex which) {
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	gpointer old;
+	TpPresenceStatus *status;
+
+	if (g_hash_table_lookup_extended(tracker->statuses, GUINT_TO_POINTER(handle), NULL, &old) &&
+	    GPOINTER_TO_UINT(old) == which)
+		return;
+
+	g_hash_table_insert(tracker->statuses, GUINT_TO_POINTER(handle), GUINT_TO_POINTER(which));
+
+	status = tp_presence_status_new(which, NULL);
+	tp_presence_mixin_emit_one_presence_update((GObject *) conn, handle, status);
+	tp_presence_status_free(status);
+}
+
+/* Sends "<prefix><nick><sep><nick>..." in as few lines as fit, recording the
+ * handles in each line in @batches if it is not NULL */
+static void _send_packed(IdleConnection *conn, const gchar *prefix, gchar sep, TpIntset *handles, GQueue *batches) {
+	TpHandleRepoIface *contact_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(conn), TP_HANDLE_TYPE_CONTACT);
+	gsize prefix_len = strlen(prefix);
+	GString *line = g_string_new(prefix);
+	GArray *batch = NULL;
+	TpIntsetFastIter iter;
+	TpHandle handle;
+
+	tp_intset_fast_iter_init(&iter, handles);
+	while (tp_intset_fast_iter_next(&iter, &handle)) {
+		const gchar *nick = tp_handle_inspect(contact_repo, handle);
+
+		if (line->len > prefix_len && line->len + 1 + strlen(nick) > IRC_MSG_MAXLEN) {
+			idle_connection_send(conn, line->str);
+			g_string_assign(line, prefix);
+
+			if (batches != NULL) {
+				g_queue_push_tail(batches, batch);
+				batch = NULL;
+			}
+		}
+
+		if (line->len > prefix_len)
+			g_string_append_c(line, sep);
+
+		g_string_append(line, nick);
+
+		if (batches != NULL) {
+			if (batch == NULL)
+				batch = g_array_new(FALSE, FALSE, sizeof(TpHandle));
+
+			g_array_append_val(batch, handle);
+		}
+	}
+
+	if (line->len > prefix_len) {
+		idle_connection_send(conn, line->str);
+
+		if (batches != NULL)
+			g_queue_push_tail(batches, batch);
+	}
+
+	g_string_free(line, TRUE);
+}
+
+static void _send_ison(IdleConnection *conn, TpIntset *handles) {
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	TpBaseConnection *base_conn = TP_BASE_CONNECTION(conn);
+	TpHandleRepoIface *contact_repo = tp_base_connection_get_handles(base_conn, TP_HANDLE_TYPE_CONTACT);
+	gchar *prefix = g_strdup_printf("ISON %s ", tp_handle_inspect(contact_repo, tp_base_connection_get_self_handle(base_conn)));
+
+	_send_packed(conn, prefix, ' ', handles, &tracker->ison_batches);
+	g_free(prefix);
+}
+
+static gboolean _poll_cb(gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+
+	if (!_is_connected(conn) || tp_handle_set_size(tracker->polled) == 0) {
+		tracker->poll_id = 0;
+		return FALSE;
+	}
+
+	/* a slow server has not answered the last round yet */
+	if (!g_queue_is_empty(&tracker->ison_batches))
+		return TRUE;
+
+	_send_ison(conn, tp_handle_set_peek(tracker->polled));
+
+	return TRUE;
+}
+
+static void _poll(IdleConnection *conn, TpIntset *handles) {
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+
+	_send_ison(conn, handles);
+
+	if (tracker->poll_id == 0)
+		tracker->poll_id = g_timeout_add_seconds(ISON_POLL_INTERVAL, _poll_cb, conn);
+}
+
+static gboolean _flush_cb(gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	TpHandleRepoIface *contact_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(conn), TP_HANDLE_TYPE_CONTACT);
+	const gchar *monitor = idle_connection_get_isupport(conn, "MONITOR");
+	guint monitor_limit = (monitor != NULL) ? (guint) strtoul(monitor, NULL, 10) : 0;
+	TpHandleSet *unsent = tracker->unsent;
+	TpIntset *to_monitor = tp_intset_new();
+	TpIntset *to_poll = tp_intset_new();
+	TpIntsetFastIter iter;
+	TpHandle handle;
+
+	tracker->flush_id = 0;
+
+	if (!_is_connected(conn))
+		goto cleanup;
+
+	tracker->unsent = tp_handle_set_new(contact_repo);
+
+	tp_intset_fast_iter_init(&iter, tp_handle_set_peek(unsent));
+	while (tp_intset_fast_iter_next(&iter, &handle)) {
+		if (monitor != NULL && (monitor_limit == 0 || tp_handle_set_size(tracker->monitored) < monitor_limit)) {
+			tp_handle_set_add(tracker->monitored, handle);
+			tp_intset_add(to_monitor, handle);
+		} else if (tp_handle_set_size(tracker->polled) < ISON_POLL_MAX) {
+			tp_handle_set_add(tracker->polled, handle);
+			tp_intset_add(to_poll, handle);
+		} else {
+			tp_handle_set_add(tracker->unsent, handle);
+		}
+	}
+
+	tp_handle_set_destroy(unsent);
+
+	IDLE_DEBUG("watching %u contacts with MONITOR and %u with ISON, %u waiting", tp_intset_size(to_monitor), tp_intset_size(to_poll), tp_handle_set_size(tracker->unsent));
+
+	/* before any MONITOR +, in case some of them are coming straight back */
+	if (tp_handle_set_size(tracker->unmonitor) > 0) {
+		_send_packed(conn, "MONITOR - ", ',', tp_handle_set_peek(tracker->unmonitor), NULL);
+		tp_handle_set_destroy(tracker->unmonitor);
+		tracker->unmonitor = tp_handle_set_new(contact_repo);
+	}
+
+	/* the server answers MONITOR + with 730/731 for each target right away */
+	if (!tp_intset_is_empty(to_monitor))
+		_send_packed(conn, "MONITOR + ", ',', to_monitor, NULL);
+
+	if (!tp_intset_is_empty(to_poll))
+		_poll(conn, to_poll);
+
+cleanup:
+	tp_intset_destroy(to_monitor);
+	tp_intset_destroy(to_poll);
+
+	return FALSE;
+}
+
+static void _schedule_flush(IdleConnection *conn) {
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+
+	if (tracker->flush_id == 0)
+		tracker->flush_id = g_timeout_add(PRESENCE_FLUSH_DELAY, _flush_cb, conn);
+}
+
+static void _watch(IdleConnection *conn, TpHandle handle) {
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+
+	g_hash_table_insert(tracker->statuses, GUINT_TO_POINTER(handle), GUINT_TO_POINTER(IDLE_PRESENCE_UNKNOWN));
+	tp_handle_set_add(tracker->unsent, handle);
+	_schedule_flush(conn);
+}
+
+/* Stops tracking @handle, leaving it with the presence @which */
+static void _unwatch(IdleConnection *conn, TpHandle handle, IdlePresenceIndex which) {
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	gboolean was_polled;
+
+	if (!g_hash_table_contains(tracker->statuses, GUINT_TO_POINTER(handle)))
+		return;
+
+	_set_contact_status(conn, handle, which);
+	g_hash_table_remove(tracker->statuses, GUINT_TO_POINTER(handle));
+
+	tp_handle_set_remove(tracker->unsent, handle);
+	was_polled = tp_handle_set_remove(tracker->polled, handle);
+
+	if (tp_handle_set_remove(tracker->monitored, handle)) {
+		tp_handle_set_add(tracker->unmonitor, handle);
+		_schedule_flush(conn);
+	}
+
+	/* somebody waiting can be polled in its place */
+	if (was_polled && tp_handle_set_size(tracker->unsent) > 0)
+		_schedule_flush(conn);
+}
+
+/**
+ * idle_presence_unwatch:
+ * @conn: the connection
+ * @handle: a contact who is no longer in any channel we are in
+ *
+ * Stops tracking @handle's presence, which becomes unknown, until a client
+ * asks about it again.
+ */
+void idle_presence_unwatch(IdleConnection *conn, TpHandle handle) {
+	_unwatch(conn, handle, IDLE_PRESENCE_UNKNOWN);
+}
+
+static gboolean _status_available(GObject *obj, guint which) {
+	return presence_statuses[which].self;
+}
+
+static GHashTable *_get_contact_statuses(GObject *obj, const GArray *contacts, GError **error) {
+	IdleConnection *conn = IDLE_CONNECTION(obj);
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	TpHandle self_handle = tp_base_connection_get_self_handle(TP_BASE_CONNECTION(conn));
+	GHashTable *result = g_hash_table_new_full(NULL, NULL, NULL, (GDestroyNotify) tp_presence_status_free);
+
+	for (guint i = 0; i < contacts->len; i++) {
+		TpHandle handle = g_array_index(contacts, TpHandle, i);
+		TpPresenceStatus *status;
+		gpointer which;
+
+		if (handle == self_handle) {
+			GHashTable *args = NULL;
+
+			if (tracker->self_message != NULL) {
+				args = tp_asv_new("message", G_TYPE_STRING, tracker->self_message, NULL);
+			}
+
+			status = tp_presence_status_new(tracker->self_status, args);
+
+			if (args != NULL)
+				g_hash_table_unref(args);
+		} else {
+			if (!g_hash_table_lookup_extended(tracker->statuses, GUINT_TO_POINTER(handle), NULL, &which)) {
+				/* asking about a contact is how clients tell us to track them */
+				_watch(conn, handle);
+				which = GUINT_TO_POINTER(IDLE_PRESENCE_UNKNOWN);
+			}
+
+			status = tp_presence_status_new(GPOINTER_TO_UINT(which), NULL);
+		}
+
+		g_hash_table_insert(result, GUINT_TO_POINTER(handle), status);
+	}
+
+	return result;
+}
+
+static gboolean _set_own_status(GObject *obj, const TpPresenceStatus *status, GError **error) {
+	IdleConnection *conn = IDLE_CONNECTION(obj);
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	const gchar *message = NULL;
+	gchar cmd[IRC_MSG_MAXLEN + 1];
+
+	if (status->optional_arguments != NULL)
+		message = tp_asv_get_string(status->optional_arguments, "message");
+
+	if (message != NULL && *message == '\0')
+		message = NULL;
+
+	if (status->index == IDLE_PRESENCE_AWAY) {
+		/* AWAY without a message means "back" */
+		g_snprintf(cmd, IRC_MSG_MAXLEN + 1, "AWAY :%s", (message != NULL) ? message : "away");
+	} else {
+		g_strlcpy(cmd, "AWAY", sizeof(cmd));
+	}
+
+	idle_connection_send(conn, cmd);
+
+	tracker->self_status = status->index;
+	g_free(tracker->self_message);
+	tracker->self_message = g_strdup(message);
+
+	tp_presence_mixin_emit_one_presence_update(obj, tp_base_connection_get_self_handle(TP_BASE_CONNECTION(conn)), status);
+
+	return TRUE;
+}
+
+/* Calls @func for the handle of each nick in the comma-separated @targets,
+ * which may carry a !user@host */
+static void _foreach_target(IdleConnection *conn, const gchar *targets, const gchar *separators, void (*func)(IdleConnection *, TpHandle, gpointer), gpointer user_data) {
+	TpHandleRepoIface *contact_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(conn), TP_HANDLE_TYPE_CONTACT);
+	gchar **targetv = g_strsplit_set(targets, separators, -1);
+
+	for (guint i = 0; targetv[i] != NULL; i++) {
+		gchar *bang = strchr(targetv[i], '!');
+		TpHandle handle;
+
+		if (bang != NULL)
+			*bang = '\0';
+
+		if (targetv[i][0] == '\0')
+			continue;
+
+		handle = tp_handle_ensure(contact_repo, targetv[i], NULL, NULL);
+		if (handle != 0)
+			func(conn, handle, user_data);
+	}
+
+	g_strfreev(targetv);
+}
+
+static void _mark_status(IdleConnection *conn, TpHandle handle, gpointer user_data) {
+	if (g_hash_table_lookup_extended(conn->presence_tracker->statuses, GUINT_TO_POINTER(handle), NULL, NULL))
+		_set_contact_status(conn, handle, GPOINTER_TO_UINT(user_data));
+}
+
+static void _add_to_set(IdleConnection *conn, TpHandle handle, gpointer user_data) {
+	tp_intset_add(user_data, handle);
+}
+
+static IdleParserHandlerResult _mon_online_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+
+	_foreach_target(conn, g_value_get_string(g_value_array_get_nth(args, 0)), ",", _mark_status, GUINT_TO_POINTER(IDLE_PRESENCE_AVAILABLE));
+
+	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+}
+
+static IdleParserHandlerResult _mon_offline_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+
+	_foreach_target(conn, g_value_get_string(g_value_array_get_nth(args, 0)), ",", _mark_status, GUINT_TO_POINTER(IDLE_PRESENCE_OFFLINE));
+
+	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+}
+
+static IdleParserHandlerResult _mon_list_full_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	TpIntset *refused = tp_intset_new();
+	TpIntset *to_poll = tp_intset_new();
+	TpIntsetFastIter iter;
+	TpHandle handle;
+
+	_foreach_target(conn, g_value_get_string(g_value_array_get_nth(args, 1)), ",", _add_to_set, refused);
+
+	tp_intset_fast_iter_init(&iter, refused);
+	while (tp_intset_fast_iter_next(&iter, &handle)) {
+		/* not one of ours, or not watched any more */
+		if (!tp_handle_set_remove(tracker->monitored, handle))
+			continue;
+
+		if (tp_handle_set_size(tracker->polled) < ISON_POLL_MAX) {
+			tp_handle_set_add(tracker->polled, handle);
+			tp_intset_add(to_poll, handle);
+		} else {
+			tp_handle_set_add(tracker->unsent, handle);
+		}
+	}
+
+	IDLE_DEBUG("MONITOR list is full, polling %u contacts instead", tp_intset_size(to_poll));
+
+	if (!tp_intset_is_empty(to_poll))
+		_poll(conn, to_poll);
+
+	tp_intset_destroy(refused);
+	tp_intset_destroy(to_poll);
+
+	return IDLE_PARSER_HANDLER_RESULT_HANDLED;
+}
+
+/* Whether @online, the nicks in an ISON reply other than ours, were all
+ * asked about in @batch */
+static gboolean _batch_covers(GArray *batch, TpIntset *online, TpHandle self) {
+	TpIntsetFastIter iter;
+	TpHandle handle;
+
+	tp_intset_fast_iter_init(&iter, online);
+	while (tp_intset_fast_iter_next(&iter, &handle)) {
+		guint i;
+
+		if (handle == self)
+			continue;
+
+		for (i = 0; i < batch->len; i++) {
+			if (g_array_index(batch, TpHandle, i) == handle)
+				break;
+		}
+
+		if (i == batch->len)
+			return FALSE;
+	}
+
+	return TRUE;
+}
+
+static IdleParserHandlerResult _ison_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	TpHandle self = tp_base_connection_get_self_handle(TP_BASE_CONNECTION(conn));
+	IdleParserHandlerResult result = IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+	GArray *batch;
+	TpIntset *online = tp_intset_new();
+
+	if (args->n_values > 0)
+		_foreach_target(conn, g_value_get_string(g_value_array_get_nth(args, 0)), " ", _add_to_set, online);
+
+	/* Without us in it, it's somebody else's ISON, perhaps through the IRC
+	 * command interface. Otherwise it answers the first of ours it fits;
+	 * any before that went unanswered. */
+	if (!tp_intset_is_member(online, self))
+		goto out;
+
+	while ((batch = g_queue_peek_head(&tracker->ison_batches)) != NULL && !_batch_covers(batch, online, self)) {
+		IDLE_DEBUG("no reply to an ISON of %u contacts", batch->len);
+		g_array_unref(g_queue_pop_head(&tracker->ison_batches));
+	}
+
+	batch = g_queue_pop_head(&tracker->ison_batches);
+	if (batch == NULL)
+		goto out;
+
+	for (guint i = 0; i < batch->len; i++) {
+		TpHandle handle = g_array_index(batch, TpHandle, i);
+
+		/* no longer watched since we asked */
+		if (!tp_handle_set_is_member(tracker->polled, handle))
+			continue;
+
+		_set_contact_status(conn, handle, tp_intset_is_member(online, handle) ? IDLE_PRESENCE_AVAILABLE : IDLE_PRESENCE_OFFLINE);
+	}
+
+	g_array_unref(batch);
+	result = IDLE_PARSER_HANDLER_RESULT_HANDLED;
+
+out:
+	tp_intset_destroy(online);
+
+	return result;
+}
+
+static IdleParserHandlerResult _quit_handler(IdleParser *parser, IdleParserMessageCode code, GValueArray *args, gpointer user_data) {
+	IdleConnection *conn = IDLE_CONNECTION(user_data);
+	TpHandle handle = g_value_get_uint(g_value_array_get_nth(args, 0));
+
+	/* they have left every channel, and the network */
+	_unwatch(conn, handle, IDLE_PRESENCE_OFFLINE);
+
+	return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+void idle_presence_finalize (GObject *object) {
+	IdleConnection *conn = IDLE_CONNECTION(object);
+	IdlePresenceTracker *tracker = conn->presence_tracker;
+	GArray *batch;
+
+	if (tracker->flush_id != 0)
+		g_source_remove(tracker->flush_id);
+
+	if (tracker->poll_id != 0)
+		g_source_remove(tracker->poll_id);
+
+	while ((batch = g_queue_pop_head(&tracker->ison_batches)) != NULL)
+		g_array_unref(batch);
+
+	g_hash_table_unref(tracker->statuses);
+	tp_handle_set_destroy(tracker->unsent);
+	tp_handle_set_destroy(tracker->unmonitor);
+	tp_handle_set_destroy(tracker->monitored);
+	tp_handle_set_destroy(tracker->polled);
+	g_free(tracker->self_message);
+	g_slice_free(IdlePresenceTracker, tracker);
+
+	tp_presence_mixin_finalize(object);
+}
+
+void idle_presence_class_init (IdleConnectionClass *klass) {
+	GObjectClass *object_class = G_OBJECT_CLASS(klass);
+
+	tp_presence_mixin_class_init(object_class,
+		G_STRUCT_OFFSET(IdleConnectionClass, presence),
+		_status_available,
+		_get_contact_statuses,
+		_set_own_status,
+		presence_statuses);
+
+	tp_presence_mixin_simple_presence_init_dbus_properties(object_class);
+}
+
+void idle_presence_init (IdleConnection *conn) {
+	TpHandleRepoIface *contact_repo = tp_base_connection_get_handles(TP_BASE_CONNECTION(conn), TP_HANDLE_TYPE_CONTACT);
+	IdlePresenceTracker *tracker = g_slice_new0(IdlePresenceTracker);
+
+	tracker->statuses = g_hash_table_new(NULL, NULL);
+	tracker->unsent = tp_handle_set_new(contact_repo);
+	tracker->unmonitor = tp_handle_set_new(contact_repo);
+	tracker->monitored = tp_handle_set_new(contact_repo);
+	tracker->polled = tp_handle_set_new(contact_repo);
+	g_queue_init(&tracker->ison_batches);
+	tracker->self_status = IDLE_PRESENCE_AVAILABLE;
+	conn->presence_tracker = tracker;
+
+	tp_presence_mixin_init((GObject *) conn, G_STRUCT_OFFSET(IdleConnection, presence));
+	tp_presence_mixin_simple_presence_register_with_contacts_mixin((GObject *) conn);
+
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_MONONLINE, _mon_online_handler, conn);
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_MONOFFLINE, _mon_offline_handler, conn);
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_MONLISTFULL, _mon_list_full_handler, conn);
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_NUMERIC_ISON, _ison_handler, conn);
+	idle_parser_add_handler(conn->parser, IDLE_PARSER_PREFIXCMD_QUIT, _quit_handler, conn);
+}
+
+void idle_presence_iface_init(gpointer g_iface, gpointer iface_data) {
+	tp_presence_mixin_simple_presence_iface_init(g_iface, iface_data);
+}
@@ -22,11 +22,16 @@
 #include "config.h"
 #include "idle-server-connection.h"
 
+#include <errno.h>
+#include <fcntl.h>
+#include <stdio.h>
 #include <string.h>
+#include <unistd.h>
 #include <netinet/in.h>
 #include <netinet/tcp.h>
 #include <sys/socket.h>
 
+#include <glib/gstdio.h>
 #include <telepathy-glib/telepathy-glib.h>
 
 #define IDLE_DEBUG_FLAG IDLE_DEBUG_NETWORK
@@ -42,13 +47,13 @@ G_DEFINE_TYPE(IdleServerConnection, idle_server_connection, G_TYPE_OBJECT)
 
 enum {
 	DISCONNECTED,
-	RECEIVED,
 	LAST_SIGNAL
 };
 
 enum {
 	PROP_HOST = 1,
 	PROP_PORT,
+	PROP_FALLBACK_SERVERS,
 	PROP_TLS_MANAGER
 };
 
@@ -61,9 +66,11 @@ typedef enum {
 struct _IdleServerConnectionPrivate {
 	gchar *host;
 	guint16 port;
+	gchar **fallback_servers;
+	gboolean tls;
 
 	gchar input_buffer[IRC_MSG_MAXLEN + 3];
-	gchar output_buffer[IRC_MSG_MAXLEN + 2]; /* No need for a trailing '\0' */
+	GBytes *output_bytes;
 	gsize count;
 	gsize nwritten;
 
@@ -76,11 +83,29 @@ struct _IdleServerConnectionPrivate {
 
 	IdleServerConnectionState state;
 	IdleServerTLSManager *tls_manager;
-	GAsyncQueue *certificate_queue;
+
+	/* called with every chunk read; this is the hottest path we have, so it
+	 * is a plain function pointer rather than a signal */
+	IdleServerConnectionReceivedFunc received_func;
+	gpointer received_data;
+
+	/* set by idle_server_connection_pause_reading(); the read loop stops at
+	 * the next chunk, and read_stopped says it has done so */
+	gboolean read_paused;
+	gboolean read_stopped;
+
+	/* where the traffic is recorded to, if IDLE_RECORD_TRAFFIC is set, and
+	 * when the last chunk was */
+	FILE *record;
+	gint64 record_last;
 };
 
 static GObject *idle_server_connection_constructor(GType type, guint n_props, GObjectConstructParam *props);
 
+static void _record_open(IdleServerConnectionPrivate *priv);
+static void _record_chunk(IdleServerConnectionPrivate *priv, gchar direction, const gchar *data, gsize len);
+static void _record_close(IdleServerConnectionPrivate *priv);
+
 static guint signals[LAST_SIGNAL] = {0};
 
 static void idle_server_connection_init(IdleServerConnection *conn) {
@@ -92,7 +117,6 @@ static void idle_server_connection_init(IdleServerConnection *conn) {
 	priv->socket_client = g_socket_client_new();
 
 	priv->state = SERVER_CONNECTION_STATE_NOT_CONNECTED;
-	priv->certificate_queue = g_async_queue_new ();
 }
 
 static GObject *idle_server_connection_constructor(GType type, guint n_props, GObjectConstructParam *props) {
@@ -111,14 +135,16 @@ static void idle_server_connection_dispose(GObject *obj) {
         g_clear_object (&priv->io_stream);
         g_clear_object (&priv->tls_manager);
         g_clear_object (&priv->read_cancellable);
+        tp_clear_pointer (&priv->output_bytes, g_bytes_unref);
+        _record_close (priv);
 }
 
 static void idle_server_connection_finalize(GObject *obj) {
 	IdleServerConnection *conn = IDLE_SERVER_CONNECTION(obj);
 	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
 
-	g_async_queue_unref (priv->certificate_queue);
 	g_free(priv->host);
+	g_strfreev(priv->fallback_servers);
 }
 
 static void idle_server_connection_get_property(GObject 	*obj, guint prop_id, GValue *value, GParamSpec *pspec) {
@@ -134,6 +160,10 @@ static void idle_server_connection_get_property(GObject 	*obj, guint prop_id, GV
 			g_value_set_uint(value, priv->port);
 			break;
 
+		case PROP_FALLBACK_SERVERS:
+			g_value_set_boxed(value, priv->fallback_servers);
+			break;
+
 		case PROP_TLS_MANAGER:
 			g_value_set_object(value, priv->tls_manager);
 			break;
@@ -161,6 +191,11 @@ static void idle_server_connection_set_property(GObject 	*obj,
 			priv->port = (guint16) g_value_get_uint(value);
 			break;
 
+		case PROP_FALLBACK_SERVERS:
+			g_strfreev(priv->fallback_servers);
+			priv->fallback_servers = g_value_dup_boxed(value);
+			break;
+
 		case PROP_TLS_MANAGER:
 			priv->tls_manager = g_value_dup_object(value);
 			break;
@@ -204,6 +239,14 @@ static void idle_server_connection_class_init(IdleServerConnectionClass *klass)
 
 	g_object_class_install_property(object_class, PROP_PORT, pspec);
 
+	pspec = g_param_spec_boxed("fallback-servers", "Fallback servers",
+							  "Servers to try alongside the remote host, as \"host[:port]\" strings.",
+							  G_TYPE_STRV,
+							  G_PARAM_READWRITE|
+							  G_PARAM_STATIC_STRINGS);
+
+	g_object_class_install_property(object_class, PROP_FALLBACK_SERVERS, pspec);
+
 	pspec = g_param_spec_object("tls-manager", "TLS Manager",
 							  "TLS manager for interactive certificate checking",
 							  IDLE_TYPE_SERVER_TLS_MANAGER,
@@ -220,14 +263,81 @@ static void idle_server_connection_class_init(IdleServerConnectionClass *klass)
 						g_cclosure_marshal_generic,
 						G_TYPE_NONE, 1, G_TYPE_UINT);
 
-	signals[RECEIVED] = g_signal_new("received",
-						G_OBJECT_CLASS_TYPE(klass),
-						G_SIGNAL_RUN_LAST | G_SIGNAL_DETAILED,
-						0,
-						NULL, NULL,
-						g_cclosure_marshal_VOID__STRING,
-						G_TYPE_NONE, 1, G_TYPE_STRING);
+}
+
+/* If IDLE_RECORD_TRAFFIC names a directory, each connection writes every chunk
+ * it receives and sends to a file there, for tests/twisted/replay.py to play
+ * back. That is everything, passwords included.
+ *
+ * The file starts with RECORD_MAGIC; each chunk is then a direction byte, the
+ * microseconds since the previous chunk and the chunk's length (both 32-bit
+ * big-endian), followed by the chunk itself. */
+#define RECORD_MAGIC "IDLEREC1"
+#define RECORD_RECEIVED '<'
+#define RECORD_SENT '>'
+
+static void _record_open(IdleServerConnectionPrivate *priv) {
+	static guint serial = 0;
+	const gchar *dir = g_getenv("IDLE_RECORD_TRAFFIC");
+	gchar *filename, *path;
+	int fd;
+
+	if (tp_str_empty(dir))
+		return;
+
+	filename = g_strdup_printf("idle-%d-%u.irclog", (int) getpid(), serial++);
+	path = g_build_filename(dir, filename, NULL);
+
+	/* the log has the password and every private message in it, so nobody
+	 * else gets to read it */
+	fd = g_open(path, O_WRONLY | O_CREAT | O_TRUNC, 0600);
+
+	if (fd >= 0) {
+		priv->record = fdopen(fd, "wb");
+
+		if (priv->record == NULL) {
+			int saved = errno;
+
+			close(fd);
+			errno = saved;
+		}
+	}
+
+	if (priv->record != NULL) {
+		IDLE_DEBUG("recording traffic to %s", path);
+		fwrite(RECORD_MAGIC, 1, strlen(RECORD_MAGIC), priv->record);
+		priv->record_last = g_get_monotonic_time();
+	} else {
+		IDLE_DEBUG("can't record traffic to %s: %s", path, g_strerror(errno));
+	}
+
+	g_free(path);
+	g_free(filename);
+}
+
+static void _record_chunk(IdleServerConnectionPrivate *priv, gchar direction, const gchar *data, gsize len) {
+	gint64 now;
+	guint32 header[2];
+
+	if (G_LIKELY(priv->record == NULL))
+		return;
+
+	now = g_get_monotonic_time();
+	header[0] = GUINT32_TO_BE((guint32) MIN(now - priv->record_last, G_MAXUINT32));
+	header[1] = GUINT32_TO_BE((guint32) len);
+	priv->record_last = now;
 
+	fputc(direction, priv->record);
+	fwrite(header, sizeof(header), 1, priv->record);
+	fwrite(data, 1, len, priv->record);
+}
+
+static void _record_close(IdleServerConnectionPrivate *priv) {
+	if (priv->record == NULL)
+		return;
+
+	fclose(priv->record);
+	priv->record = NULL;
 }
 
 static void change_state(IdleServerConnection *conn, IdleServerConnectionState state, guint reason) {
@@ -275,7 +385,18 @@ static void _input_stream_read_ready(GObject *source_object, GAsyncResult *res,
 		goto disconnect;
 	}
 
-	g_signal_emit(conn, signals[RECEIVED], 0, priv->input_buffer);
+	_record_chunk(priv, RECORD_RECEIVED, priv->input_buffer, ret);
+
+	if (priv->received_func != NULL)
+		priv->received_func(conn, priv->input_buffer, priv->received_data);
+
+	if (priv->read_paused && priv->io_stream != NULL) {
+		/* Leave the data in the kernel's buffers, so that TCP pushes back on
+		 * the server until we are told to resume. */
+		IDLE_DEBUG("reading paused");
+		priv->read_stopped = TRUE;
+		goto cleanup;
+	}
 
 	_input_stream_read(conn, input_stream, _input_stream_read_ready);
 	return;
@@ -287,28 +408,223 @@ cleanup:
 	g_object_unref(conn);
 }
 
-static void _connect_to_host_ready(GObject *source_object, GAsyncResult *res, gpointer user_data) {
-	GSimpleAsyncResult *task = G_SIMPLE_ASYNC_RESULT (res);
-	GSimpleAsyncResult *result = G_SIMPLE_ASYNC_RESULT(user_data);
-	IdleServerConnection *conn = IDLE_SERVER_CONNECTION(g_async_result_get_source_object(G_ASYNC_RESULT(result)));
-	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
-	GInputStream *input_stream;
-	GSocket *socket_;
-	GSocketConnection *socket_connection;
-	gint nodelay = 1;
-	gint socket_fd;
+/* Connection attempts are started this far apart, unless the previous one
+ * fails first; the first attempt to succeed wins and the rest are dropped.
+ */
+#define CONNECT_ATTEMPT_DELAY 250 /* msec */
+
+/* The address each server was last reached on, keyed by "host:port". It is
+ * tried before anything else when reconnecting, which skips waiting for DNS
+ * and, since the TLS backend keys its session cache on the remote address,
+ * lets the previous TLS session be resumed. */
+static GHashTable *last_addresses = NULL;
+
+typedef struct _ConnectData ConnectData;
+typedef struct _ConnectCandidate ConnectCandidate;
+
+struct _ConnectCandidate {
+	ConnectData *data;
+	GSocketAddress *address;
+	GNetworkAddress *server;
+};
+
+struct _ConnectData {
+	guint refcount;
+
+	IdleServerConnection *conn;
+	GSimpleAsyncResult *result;
+
+	/* cancels all outstanding lookups and attempts; it is triggered both by
+	 * the caller's cancellable and by the winning attempt */
+	GCancellable *cancellable;
+	GCancellable *caller_cancellable;
+	gulong caller_cancelled_id;
+
+	/* GNetworkAddress for the primary server, then each fallback server */
+	GPtrArray *servers;
+	guint next_server;
+	GSocketAddressEnumerator *enumerator;
+
+	/* resolved addresses not yet tried, kept per family so that we can
+	 * alternate between IPv6 and IPv4 */
+	GQueue ipv6_candidates;
+	GQueue ipv4_candidates;
+	GSocketFamily last_family;
+	GHashTable *queued_addresses;
+
+	guint attempts_pending;
+	guint attempt_timeout;
+	GError *last_error;
+
+	GIOStream *io_stream;
+	GNetworkAddress *server;
+	GTlsCertificate *peer_certificate;
+	gboolean completed;
+};
+
+static ConnectData *_connect_data_ref(ConnectData *data) {
+	data->refcount++;
+	return data;
+}
+
+static void _connect_candidate_free(gpointer data, gpointer user_data) {
+	ConnectCandidate *candidate = data;
+
+	g_object_unref(candidate->address);
+	g_object_unref(candidate->server);
+	g_slice_free(ConnectCandidate, candidate);
+}
+
+static void _connect_data_unref(gpointer user_data) {
+	ConnectData *data = user_data;
+
+	if (--data->refcount > 0)
+		return;
+
+	if (data->caller_cancellable != NULL) {
+		g_cancellable_disconnect(data->caller_cancellable, data->caller_cancelled_id);
+		g_object_unref(data->caller_cancellable);
+	}
+
+	g_queue_foreach(&data->ipv6_candidates, _connect_candidate_free, NULL);
+	g_queue_clear(&data->ipv6_candidates);
+	g_queue_foreach(&data->ipv4_candidates, _connect_candidate_free, NULL);
+	g_queue_clear(&data->ipv4_candidates);
+	g_hash_table_unref(data->queued_addresses);
+
+	g_ptr_array_unref(data->servers);
+	g_clear_object(&data->enumerator);
+	g_clear_object(&data->io_stream);
+	g_clear_object(&data->server);
+	g_clear_object(&data->peer_certificate);
+	g_clear_error(&data->last_error);
+	g_object_unref(data->cancellable);
+	g_object_unref(data->result);
+	g_object_unref(data->conn);
+
+	g_slice_free(ConnectData, data);
+}
+
+static void _connect_caller_cancelled_cb(GCancellable *caller_cancellable, gpointer user_data) {
+	g_cancellable_cancel(G_CANCELLABLE(user_data));
+}
+
+static gchar *_server_key(GNetworkAddress *server) {
+	return g_strdup_printf("%s:%u", g_network_address_get_hostname(server), g_network_address_get_port(server));
+}
+
+static gchar *_address_to_string(GSocketAddress *address) {
+	GInetSocketAddress *inet_address = G_INET_SOCKET_ADDRESS(address);
+	gchar *host = g_inet_address_to_string(g_inet_socket_address_get_address(inet_address));
+	gchar *ret = g_strdup_printf("%s port %u", host, g_inet_socket_address_get_port(inet_address));
+
+	g_free(host);
+	return ret;
+}
+
+/* Queues an attempt on @address, unless it is already queued or was tried */
+static gboolean _connect_add_candidate(ConnectData *data, GNetworkAddress *server, GSocketAddress *address) {
+	ConnectCandidate *candidate;
+	gchar *address_string = _address_to_string(address);
+
+	if (g_hash_table_contains(data->queued_addresses, address_string)) {
+		g_free(address_string);
+		return FALSE;
+	}
+
+	g_hash_table_add(data->queued_addresses, address_string);
+
+	candidate = g_slice_new0(ConnectCandidate);
+	candidate->address = g_object_ref(address);
+	candidate->server = g_object_ref(server);
+
+	if (g_socket_address_get_family(address) == G_SOCKET_FAMILY_IPV6)
+		g_queue_push_tail(&data->ipv6_candidates, candidate);
+	else
+		g_queue_push_tail(&data->ipv4_candidates, candidate);
+
+	return TRUE;
+}
+
+static void _connect_add_server(ConnectData *data, const gchar *server, guint16 default_port) {
+	GSocketConnectable *address;
 	GError *error = NULL;
 
-	if (g_simple_async_result_propagate_error (task, &error)) {
-		IDLE_DEBUG("g_socket_client_connect_to_host failed: %s", error->message);
-		g_simple_async_result_set_error(result, TP_ERROR, TP_ERROR_NETWORK_ERROR, "%s", error->message);
+	address = g_network_address_parse(server, default_port, &error);
+	if (address == NULL) {
+		IDLE_DEBUG("ignoring server \"%s\": %s", server, error->message);
 		g_error_free(error);
-		change_state(conn, SERVER_CONNECTION_STATE_NOT_CONNECTED, SERVER_CONNECTION_STATE_REASON_ERROR);
-		g_object_unref(conn);
-		goto cleanup;
+		return;
 	}
 
-	socket_connection = g_object_ref (g_simple_async_result_get_op_res_gpointer (task));
+	g_ptr_array_add(data->servers, address);
+}
+
+static void _connect_add_last_addresses(ConnectData *data) {
+	guint i;
+
+	if (last_addresses == NULL)
+		return;
+
+	for (i = 0; i < data->servers->len; i++) {
+		GNetworkAddress *server = g_ptr_array_index(data->servers, i);
+		gchar *key = _server_key(server);
+		GSocketAddress *address = g_hash_table_lookup(last_addresses, key);
+
+		if (address != NULL)
+			_connect_add_candidate(data, server, address);
+
+		g_free(key);
+	}
+}
+
+static void _connect_remember_address(GNetworkAddress *server, GSocketAddress *address) {
+	if (last_addresses == NULL)
+		last_addresses = g_hash_table_new_full(g_str_hash, g_str_equal, g_free, g_object_unref);
+
+	g_hash_table_replace(last_addresses, _server_key(server), g_object_ref(address));
+}
+
+static ConnectData *_connect_data_new(IdleServerConnection *conn, GSimpleAsyncResult *result, GCancellable *cancellable) {
+	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
+	ConnectData *data = g_slice_new0(ConnectData);
+	gchar **server;
+
+	data->refcount = 1;
+	data->conn = g_object_ref(conn);
+	data->result = g_object_ref(result);
+	data->cancellable = g_cancellable_new();
+	data->last_family = G_SOCKET_FAMILY_INVALID;
+	data->queued_addresses = g_hash_table_new_full(g_str_hash, g_str_equal, g_free, NULL);
+
+	data->servers = g_ptr_array_new_with_free_func(g_object_unref);
+	g_ptr_array_add(data->servers, g_network_address_new(priv->host, priv->port));
+
+	for (server = priv->fallback_servers; server != NULL && *server != NULL; server++)
+		_connect_add_server(data, *server, priv->port);
+
+	_connect_add_last_addresses(data);
+
+	if (cancellable != NULL) {
+		data->caller_cancellable = g_object_ref(cancellable);
+		data->caller_cancelled_id = g_cancellable_connect(cancellable,
+			G_CALLBACK(_connect_caller_cancelled_cb),
+			g_object_ref(data->cancellable), g_object_unref);
+	}
+
+	return data;
+}
+
+/* TRUE once an attempt has won, or the whole operation is over */
+static gboolean _connect_is_settled(ConnectData *data) {
+	return data->completed || data->server != NULL;
+}
+
+static void _connect_set_up_socket(GSocketConnection *socket_connection) {
+	GSocket *socket_;
+	gint nodelay = 1;
+	gint socket_fd;
+
 	socket_ = g_socket_connection_get_socket(socket_connection);
 	g_socket_set_keepalive(socket_, TRUE);
 
@@ -316,97 +632,332 @@ static void _connect_to_host_ready(GObject *source_object, GAsyncResult *res, gp
 	setsockopt(socket_fd, IPPROTO_TCP, TCP_NODELAY, &nodelay, sizeof(nodelay));
 
 	g_tcp_connection_set_graceful_disconnect(G_TCP_CONNECTION(socket_connection), TRUE);
+}
+
+static void _connect_stop(ConnectData *data) {
+	data->completed = TRUE;
+
+	if (data->attempt_timeout != 0) {
+		g_source_remove(data->attempt_timeout);
+		data->attempt_timeout = 0;
+	}
+
+	g_cancellable_cancel(data->cancellable);
+}
 
-	priv->io_stream = G_IO_STREAM(socket_connection);
+static void _connect_fail(ConnectData *data, const GError *error) {
+	if (data->completed)
+		return;
+
+	IDLE_DEBUG("connecting failed: %s", error->message);
+	_connect_stop(data);
+	g_clear_object(&data->io_stream);
+
+	g_simple_async_result_set_error(data->result, TP_ERROR, TP_ERROR_NETWORK_ERROR, "%s", error->message);
+	change_state(data->conn, SERVER_CONNECTION_STATE_NOT_CONNECTED, SERVER_CONNECTION_STATE_REASON_ERROR);
+	g_simple_async_result_complete(data->result);
+	_connect_data_unref(data);
+}
+
+static void _connect_succeed(ConnectData *data) {
+	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(data->conn);
+	GInputStream *input_stream;
+
+	if (data->completed)
+		return;
+
+	IDLE_DEBUG("connected to %s", g_network_address_get_hostname(data->server));
+	_connect_stop(data);
+
+	priv->io_stream = data->io_stream;
+	data->io_stream = NULL;
+	_record_open(priv);
 
 	input_stream = g_io_stream_get_input_stream(priv->io_stream);
-	_input_stream_read(conn, input_stream, _input_stream_read_ready);
-	change_state(conn, SERVER_CONNECTION_STATE_CONNECTED, SERVER_CONNECTION_STATE_REASON_REQUESTED);
+	priv->read_stopped = FALSE;
+	_input_stream_read(g_object_ref(data->conn), input_stream, _input_stream_read_ready);
+	change_state(data->conn, SERVER_CONNECTION_STATE_CONNECTED, SERVER_CONNECTION_STATE_REASON_REQUESTED);
 
-cleanup:
-	g_simple_async_result_complete(result);
-	g_object_unref(result);
-	g_object_unref(task);
+	g_simple_async_result_complete(data->result);
+	_connect_data_unref(data);
 }
 
+static void _connect_fail_if_exhausted(ConnectData *data) {
+	if (_connect_is_settled(data))
+		return;
 
-#define CERT_ACCEPTED 1
-#define CERT_REJECTED 2
-struct CertData {
-	IdleServerConnection *self;
-	GTlsCertificate *certificate;
-};
+	if (data->enumerator != NULL || data->attempts_pending > 0)
+		return;
 
-static void _certificate_verified (GObject *source, GAsyncResult *res, gpointer user_data)
-{
-	IdleServerConnection *self = user_data;
-	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(self);
-	gboolean ret;
+	if (!g_queue_is_empty(&data->ipv6_candidates) || !g_queue_is_empty(&data->ipv4_candidates))
+		return;
+
+	if (data->last_error == NULL)
+		data->last_error = g_error_new_literal(TP_ERROR, TP_ERROR_NETWORK_ERROR, "no usable address found");
 
-	ret = idle_server_tls_manager_verify_finish (IDLE_SERVER_TLS_MANAGER (source), res, NULL);
-	g_async_queue_push (priv->certificate_queue, GINT_TO_POINTER (ret ?  CERT_ACCEPTED : CERT_REJECTED));
+	_connect_fail(data, data->last_error);
 }
 
-static gboolean
-_check_certificate_interactively (gpointer data) {
-	struct CertData *d = data;
-	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(d->self);
+static void _certificate_verified(GObject *source, GAsyncResult *res, gpointer user_data) {
+	ConnectData *data = user_data;
+	GError *error = NULL;
 
-	idle_server_tls_manager_verify_async (priv->tls_manager, d->certificate, priv->host, _certificate_verified, d->self);
-	return FALSE;
+	if (!idle_server_tls_manager_verify_finish(IDLE_SERVER_TLS_MANAGER(source), res, &error)) {
+		_connect_fail(data, error);
+		g_error_free(error);
+	} else if (g_cancellable_set_error_if_cancelled(data->caller_cancellable, &error)) {
+		_connect_fail(data, error);
+		g_error_free(error);
+	} else {
+		_connect_succeed(data);
+	}
+
+	_connect_data_unref(data);
 }
 
-static gboolean _accept_certificate_request (GTlsConnection *tls_connection, GTlsCertificate *peer_cert, GTlsCertificateFlags errors, IdleServerConnection *conn)
-{
-	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
-	struct CertData d;
-	gpointer result;
+static gboolean _accept_certificate_request(GTlsConnection *tls_connection, GTlsCertificate *peer_cert, GTlsCertificateFlags errors, gpointer user_data) {
+	ConnectData *data = user_data;
 
-	/* Requested to check the extra errors from an ssl certificate,
-	 * Need to bounce this back into the main thread so we can ask the UI
-	 * on dbus */
-	IDLE_DEBUG ("Requested to validate certificate");
+	/* The certificate has problems which the user needs to decide on, and
+	 * that means a round trip over D-Bus. Let the handshake finish and ask
+	 * once it is done; nothing is read or written before the answer. */
+	IDLE_DEBUG("Requested to validate certificate");
 
-	d.self = conn;
-	d.certificate = peer_cert;
+	g_clear_object(&data->peer_certificate);
+	data->peer_certificate = g_object_ref(peer_cert);
 
-	g_idle_add (_check_certificate_interactively, &d);
-	result = g_async_queue_pop (priv->certificate_queue);
+	return TRUE;
+}
+
+static void _handshake_ready(GObject *source_object, GAsyncResult *res, gpointer user_data) {
+	ConnectData *data = user_data;
+	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(data->conn);
+	GError *error = NULL;
+
+	if (!g_tls_connection_handshake_finish(G_TLS_CONNECTION(source_object), res, &error)) {
+		IDLE_DEBUG("TLS handshake failed: %s", error->message);
+		_connect_fail(data, error);
+		g_error_free(error);
+	} else if (data->peer_certificate == NULL) {
+		_connect_succeed(data);
+	} else if (!data->completed) {
+		idle_server_tls_manager_verify_async(priv->tls_manager, data->peer_certificate, g_network_address_get_hostname(data->server), _certificate_verified, _connect_data_ref(data));
+	}
 
-	return GPOINTER_TO_INT (result) == CERT_ACCEPTED;
+	_connect_data_unref(data);
 }
 
-static void _connect_event_cb (GSocketClient *client, GSocketClientEvent event, GSocketConnectable *connectable, GIOStream *connection, gpointer user_data)
-{
-	if (event != G_SOCKET_CLIENT_TLS_HANDSHAKING)
+static void _connect_start_tls(ConnectData *data, GSocketConnection *socket_connection) {
+	GIOStream *tls_connection;
+	GError *error = NULL;
+
+	tls_connection = g_tls_client_connection_new(G_IO_STREAM(socket_connection), G_SOCKET_CONNECTABLE(data->server), &error);
+	if (tls_connection == NULL) {
+		_connect_fail(data, error);
+		g_error_free(error);
 		return;
+	}
+
+	g_signal_connect(tls_connection, "accept-certificate", G_CALLBACK(_accept_certificate_request), data);
+	data->io_stream = tls_connection;
 
-	g_signal_connect (connection, "accept-certificate", G_CALLBACK (_accept_certificate_request), user_data);
+	g_tls_connection_handshake_async(G_TLS_CONNECTION(tls_connection), G_PRIORITY_DEFAULT, data->caller_cancellable, _handshake_ready, _connect_data_ref(data));
 }
 
-static void _connect_in_thread (GSimpleAsyncResult *task, GObject *source_object, GCancellable *cancellable)
-{
-	IdleServerConnection *conn = IDLE_SERVER_CONNECTION (source_object);
-	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
-	GError *error = NULL;
+static ConnectCandidate *_connect_next_candidate(ConnectData *data) {
+	ConnectCandidate *candidate;
+
+	/* Alternate between the families, starting with whatever came first */
+	if (data->last_family == G_SOCKET_FAMILY_IPV6)
+		candidate = g_queue_pop_head(&data->ipv4_candidates);
+	else
+		candidate = g_queue_pop_head(&data->ipv6_candidates);
+
+	if (candidate == NULL)
+		candidate = g_queue_pop_head(&data->ipv6_candidates);
+
+	if (candidate == NULL)
+		candidate = g_queue_pop_head(&data->ipv4_candidates);
+
+	if (candidate != NULL)
+		data->last_family = g_socket_address_get_family(candidate->address);
+
+	return candidate;
+}
+
+static gboolean _connect_start_attempt(ConnectData *data);
+
+static gboolean _connect_attempt_timeout_cb(gpointer user_data) {
+	ConnectData *data = user_data;
+
+	data->attempt_timeout = 0;
+	_connect_start_attempt(data);
+
+	return FALSE;
+}
+
+static void _connect_attempt_ready(GObject *source_object, GAsyncResult *res, gpointer user_data) {
+	ConnectCandidate *candidate = user_data;
+	ConnectData *data = candidate->data;
 	GSocketConnection *socket_connection;
-	gulong event_id;
+	GError *error = NULL;
 
-	event_id = g_signal_connect (priv->socket_client, "event",
-		G_CALLBACK (_connect_event_cb), conn);
-	socket_connection = g_socket_client_connect_to_host (priv->socket_client, priv->host, priv->port, cancellable, &error);
-	g_signal_handler_disconnect (priv->socket_client, event_id);
+	socket_connection = g_socket_client_connect_finish(G_SOCKET_CLIENT(source_object), res, &error);
+	data->attempts_pending--;
 
-	if (socket_connection != NULL)
-		g_simple_async_result_set_op_res_gpointer (task, socket_connection, g_object_unref);
-	else
-		g_simple_async_result_take_error (task, error);
+	if (_connect_is_settled(data)) {
+		/* somebody else won, or we gave up */
+		if (socket_connection != NULL)
+			g_object_unref(socket_connection);
+		else
+			g_error_free(error);
+
+		goto cleanup;
+	}
+
+	if (socket_connection == NULL) {
+		IDLE_DEBUG("connection attempt failed: %s", error->message);
+
+		if (g_cancellable_is_cancelled(data->cancellable)) {
+			_connect_fail(data, error);
+			g_error_free(error);
+			goto cleanup;
+		}
+
+		g_clear_error(&data->last_error);
+		data->last_error = error;
+
+		/* no point waiting any longer before trying the next address */
+		if (data->attempt_timeout != 0) {
+			g_source_remove(data->attempt_timeout);
+			data->attempt_timeout = 0;
+		}
+
+		if (!_connect_start_attempt(data))
+			_connect_fail_if_exhausted(data);
+
+		goto cleanup;
+	}
+
+	data->server = g_object_ref(candidate->server);
+	_connect_remember_address(candidate->server, candidate->address);
+
+	/* Drop the other attempts and lookups, but leave the caller's
+	 * cancellable for the TLS handshake. */
+	if (data->attempt_timeout != 0) {
+		g_source_remove(data->attempt_timeout);
+		data->attempt_timeout = 0;
+	}
+	g_cancellable_cancel(data->cancellable);
+
+	_connect_set_up_socket(socket_connection);
+
+	if (IDLE_SERVER_CONNECTION_GET_PRIVATE(data->conn)->tls) {
+		_connect_start_tls(data, socket_connection);
+		g_object_unref(socket_connection);
+	} else {
+		data->io_stream = G_IO_STREAM(socket_connection);
+		_connect_succeed(data);
+	}
+
+cleanup:
+	_connect_candidate_free(candidate, NULL);
+	_connect_data_unref(data);
+}
+
+static gboolean _connect_start_attempt(ConnectData *data) {
+	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(data->conn);
+	ConnectCandidate *candidate;
+	gchar *address_string;
+
+	if (_connect_is_settled(data))
+		return FALSE;
+
+	candidate = _connect_next_candidate(data);
+	if (candidate == NULL)
+		return FALSE;
+
+	address_string = _address_to_string(candidate->address);
+	IDLE_DEBUG("trying %s (%s)", g_network_address_get_hostname(candidate->server), address_string);
+	g_free(address_string);
+
+	data->attempts_pending++;
+	candidate->data = _connect_data_ref(data);
+	g_socket_client_connect_async(priv->socket_client, G_SOCKET_CONNECTABLE(candidate->address), data->cancellable, _connect_attempt_ready, candidate);
+
+	data->attempt_timeout = g_timeout_add_full(G_PRIORITY_DEFAULT, CONNECT_ATTEMPT_DELAY, _connect_attempt_timeout_cb, _connect_data_ref(data), _connect_data_unref);
+
+	return TRUE;
+}
+
+static void _connect_resolve_next_server(ConnectData *data);
+
+static void _connect_resolve_ready(GObject *source_object, GAsyncResult *res, gpointer user_data) {
+	ConnectData *data = user_data;
+	GNetworkAddress *server = g_ptr_array_index(data->servers, data->next_server - 1);
+	GSocketAddress *address;
+	GError *error = NULL;
+
+	address = g_socket_address_enumerator_next_finish(G_SOCKET_ADDRESS_ENUMERATOR(source_object), res, &error);
+
+	if (_connect_is_settled(data)) {
+		if (address != NULL)
+			g_object_unref(address);
+		g_clear_error(&error);
+		goto cleanup;
+	}
+
+	if (address == NULL) {
+		g_clear_object(&data->enumerator);
+
+		if (error != NULL) {
+			IDLE_DEBUG("resolving %s failed: %s", g_network_address_get_hostname(server), error->message);
+
+			if (g_cancellable_is_cancelled(data->cancellable)) {
+				_connect_fail(data, error);
+				g_error_free(error);
+				goto cleanup;
+			}
+
+			g_clear_error(&data->last_error);
+			data->last_error = error;
+		}
+
+		_connect_resolve_next_server(data);
+		goto cleanup;
+	}
+
+	/* Start right away unless an attempt is still within its head start */
+	if (G_IS_INET_SOCKET_ADDRESS(address) && _connect_add_candidate(data, server, address) && data->attempt_timeout == 0)
+		_connect_start_attempt(data);
+
+	g_object_unref(address);
+
+	g_socket_address_enumerator_next_async(data->enumerator, data->cancellable, _connect_resolve_ready, _connect_data_ref(data));
+
+cleanup:
+	_connect_data_unref(data);
+}
+
+static void _connect_resolve_next_server(ConnectData *data) {
+	GNetworkAddress *server;
+
+	if (data->next_server >= data->servers->len) {
+		_connect_fail_if_exhausted(data);
+		return;
+	}
+
+	server = g_ptr_array_index(data->servers, data->next_server++);
+	IDLE_DEBUG("resolving %s", g_network_address_get_hostname(server));
+
+	data->enumerator = g_socket_connectable_enumerate(G_SOCKET_CONNECTABLE(server));
+	g_socket_address_enumerator_next_async(data->enumerator, data->cancellable, _connect_resolve_ready, _connect_data_ref(data));
 }
 
 void idle_server_connection_connect_async(IdleServerConnection *conn, GCancellable *cancellable, GAsyncReadyCallback callback, gpointer user_data) {
 	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
 	GSimpleAsyncResult *result;
-	GSimpleAsyncResult *task;
+	ConnectData *data;
 
 	if (priv->state != SERVER_CONNECTION_STATE_NOT_CONNECTED) {
 		IDLE_DEBUG("already connecting or connected!");
@@ -436,11 +987,18 @@ void idle_server_connection_connect_async(IdleServerConnection *conn, GCancellab
 	}
 
 	result = g_simple_async_result_new(G_OBJECT(conn), callback, user_data, idle_server_connection_connect_async);
-
-	task = g_simple_async_result_new (G_OBJECT (conn), _connect_to_host_ready, result, NULL);
-	g_simple_async_result_run_in_thread (task, _connect_in_thread, G_PRIORITY_DEFAULT, cancellable);
+	data = _connect_data_new(conn, result, cancellable);
+	g_object_unref(result);
 
 	change_state(conn, SERVER_CONNECTION_STATE_CONNECTING, SERVER_CONNECTION_STATE_REASON_REQUESTED);
+
+	/* If we have been connected before, the address that worked last
+	 * gets a head start on the lookups. */
+	_connect_start_attempt(data);
+
+	/* Servers are looked up one after the other, and every address is
+	 * queued for an attempt as soon as it is known. */
+	_connect_resolve_next_server(data);
 }
 
 gboolean idle_server_connection_connect_finish(IdleServerConnection *conn, GAsyncResult *result, GError **error) {
@@ -526,6 +1084,7 @@ void idle_server_connection_disconnect_full_async(IdleServerConnection *conn, gu
 	g_io_stream_close_async(priv->io_stream, G_PRIORITY_DEFAULT, cancellable, _close_ready, result);
 	g_object_unref(priv->io_stream);
 	priv->io_stream = NULL;
+	_record_close(priv);
 }
 
 gboolean idle_server_connection_disconnect_finish(IdleServerConnection *conn, GAsyncResult *result, GError **error) {
@@ -553,7 +1112,9 @@ static void _write_ready(GObject *source_object, GAsyncResult *res, gpointer use
 
 	priv->nwritten += nwrite;
 	if (priv->nwritten < priv->count) {
-		g_output_stream_write_async(output_stream, priv->output_buffer + priv->nwritten, priv->count - priv->nwritten, G_PRIORITY_DEFAULT, priv->cancellable, _write_ready, result);
+		const gchar *data = g_bytes_get_data(priv->output_bytes, NULL);
+
+		g_output_stream_write_async(output_stream, data + priv->nwritten, priv->count - priv->nwritten, G_PRIORITY_DEFAULT, priv->cancellable, _write_ready, result);
 		return;
 	}
 
@@ -562,15 +1123,18 @@ cleanup:
 		g_object_unref(priv->cancellable);
 		priv->cancellable = NULL;
 	}
+	tp_clear_pointer(&priv->output_bytes, g_bytes_unref);
 	g_simple_async_result_complete(result);
 	g_object_unref(result);
 }
 
-void idle_server_connection_send_async(IdleServerConnection *conn, const gchar *cmd, GCancellable *cancellable, GAsyncReadyCallback callback, gpointer user_data) {
+/* @cmd is written out as it is, without being copied; it must already end
+ * with <CR><LF>. */
+void idle_server_connection_send_async(IdleServerConnection *conn, GBytes *cmd, GCancellable *cancellable, GAsyncReadyCallback callback, gpointer user_data) {
 	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
 	GOutputStream *output_stream;
 	GSimpleAsyncResult *result;
-	gsize output_buffer_size = sizeof(priv->output_buffer);
+	const gchar *data;
 
 	if (priv->state != SERVER_CONNECTION_STATE_CONNECTED
             || priv->io_stream == NULL) {
@@ -582,17 +1146,10 @@ void idle_server_connection_send_async(IdleServerConnection *conn, const gchar *
 		return;
 	}
 
-	priv->count = strlen(cmd);
-	if (priv->count > output_buffer_size)
-		priv->count = output_buffer_size;
-
-	/* We only need to copy priv->count bytes, but padding the rest
-         * with null bytes gives us cleaner debug messages, without
-         * affecting the readability of the code.
-         */
-	strncpy(priv->output_buffer, cmd, output_buffer_size);
-
+	priv->output_bytes = g_bytes_ref(cmd);
+	data = g_bytes_get_data(cmd, &priv->count);
 	priv->nwritten = 0;
+	_record_chunk(priv, RECORD_SENT, data, priv->count);
 
 	if (cancellable != NULL) {
 		priv->cancellable = cancellable;
@@ -601,9 +1158,9 @@ void idle_server_connection_send_async(IdleServerConnection *conn, const gchar *
 
 	output_stream = g_io_stream_get_output_stream(priv->io_stream);
 	result = g_simple_async_result_new(G_OBJECT(conn), callback, user_data, idle_server_connection_send_async);
-	g_output_stream_write_async(output_stream, priv->output_buffer, priv->count, G_PRIORITY_DEFAULT, cancellable, _write_ready, result);
+	g_output_stream_write_async(output_stream, data, priv->count, G_PRIORITY_DEFAULT, cancellable, _write_ready, result);
 
-	IDLE_DEBUG("sending \"%s\" to OutputStream %p", priv->output_buffer, output_stream);
+	IDLE_DEBUG("sending \"%.*s\" to OutputStream %p", (int) priv->count, data, output_stream);
 }
 
 gboolean idle_server_connection_send_finish(IdleServerConnection *conn, GAsyncResult *result, GError **error) {
@@ -621,5 +1178,37 @@ gboolean idle_server_connection_is_connected(IdleServerConnection *conn) {
 
 void idle_server_connection_set_tls(IdleServerConnection *conn, gboolean tls) {
 	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
-	g_socket_client_set_tls(priv->socket_client, tls);
+
+	/* The handshake is done by hand once a connection attempt has won */
+	priv->tls = tls;
+}
+
+void idle_server_connection_set_received_func(IdleServerConnection *conn, IdleServerConnectionReceivedFunc func, gpointer user_data) {
+	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
+
+	priv->received_func = func;
+	priv->received_data = user_data;
+}
+
+void idle_server_connection_pause_reading(IdleServerConnection *conn) {
+	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
+
+	priv->read_paused = TRUE;
+}
+
+void idle_server_connection_resume_reading(IdleServerConnection *conn) {
+	IdleServerConnectionPrivate *priv = IDLE_SERVER_CONNECTION_GET_PRIVATE(conn);
+
+	priv->read_paused = FALSE;
+
+	if (!priv->read_stopped)
+		return;
+
+	priv->read_stopped = FALSE;
+
+	if (priv->io_stream == NULL)
+		return;
+
+	IDLE_DEBUG("reading resumed");
+	_input_stream_read(g_object_ref(conn), g_io_stream_get_input_stream(priv->io_stream), _input_stream_read_ready);
 }
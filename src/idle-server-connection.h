@@ -43,6 +43,8 @@ struct _IdleServerConnectionClass {
 	GObjectClass parent;
 };
 
+typedef void (*IdleServerConnectionReceivedFunc)(IdleServerConnection *conn, const gchar *msg, gpointer user_data);
+
 GType idle_server_connection_get_type(void);
 
 #define IDLE_TYPE_SERVER_CONNECTION \
@@ -69,10 +71,13 @@ void idle_server_connection_disconnect_async(IdleServerConnection *conn, GCancel
 void idle_server_connection_disconnect_full_async(IdleServerConnection *conn, guint reason, GCancellable *cancellable, GAsyncReadyCallback callback, gpointer user_data);
 void idle_server_connection_force_disconnect(IdleServerConnection *conn);
 gboolean idle_server_connection_disconnect_finish(IdleServerConnection *conn, GAsyncResult *result, GError **error);
-void idle_server_connection_send_async(IdleServerConnection *conn, const gchar *cmd, GCancellable *cancellable, GAsyncReadyCallback callback, gpointer user_data);
+void idle_server_connection_send_async(IdleServerConnection *conn, GBytes *cmd, GCancellable *cancellable, GAsyncReadyCallback callback, gpointer user_data);
 gboolean idle_server_connection_send_finish(IdleServerConnection *conn, GAsyncResult *result, GError **error);
 gboolean idle_server_connection_is_connected(IdleServerConnection *conn);
 void idle_server_connection_set_tls(IdleServerConnection *conn, gboolean tls);
+void idle_server_connection_set_received_func(IdleServerConnection *conn, IdleServerConnectionReceivedFunc func, gpointer user_data);
+void idle_server_connection_pause_reading(IdleServerConnection *conn);
+void idle_server_connection_resume_reading(IdleServerConnection *conn);
 
 G_END_DECLS
 
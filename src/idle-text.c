@@ -21,35 +21,155 @@
 #include "config.h"
 #include "idle-text.h"
 
-#include <time.h>
+#include <errno.h>
+#include <stdio.h>
 #include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#include <glib/gstdio.h>
+
+#include <telepathy-glib/telepathy-glib-dbus.h>
 
 #define IDLE_DEBUG_FLAG IDLE_DEBUG_TEXT
 #include "idle-ctcp.h"
 #include "idle-debug.h"
 
 gboolean idle_text_decode(const gchar *text, TpChannelTextMessageType *type, gchar **body) {
-	gchar *tmp = NULL;
+	size_t actionlen = strlen("\001ACTION ");
+	size_t len;
 
 	if (text[0] != '\001') {
 		*type = TP_CHANNEL_TEXT_MESSAGE_TYPE_NORMAL;
-		tmp = g_strdup(text);
-	} else {
-		size_t actionlen = strlen("\001ACTION ");
-		if (!g_ascii_strncasecmp(text, "\001ACTION ", actionlen)) {
-			*type = TP_CHANNEL_TEXT_MESSAGE_TYPE_ACTION;
-			tmp = g_strndup(text + actionlen, strlen(text + actionlen) - 1);
-		} else {
-			*body = NULL;
-			return FALSE;
-		}
+		*body = idle_ctcp_kill_blingbling(text);
+		return TRUE;
+	}
+
+	if (g_ascii_strncasecmp(text, "\001ACTION ", actionlen)) {
+		*body = NULL;
+		return FALSE;
 	}
 
-	*body = idle_ctcp_kill_blingbling(tmp);
-	g_free(tmp);
+	*type = TP_CHANNEL_TEXT_MESSAGE_TYPE_ACTION;
+	text += actionlen;
+	len = strlen(text);
+
+	/* drop the closing \001, if the sender bothered with one */
+	if (len > 0 && text[len - 1] == '\001')
+		len--;
+
+	*body = idle_ctcp_kill_blingbling_len(text, len);
 	return TRUE;
 }
 
+/* Enough for any one character in any charset, shift sequences included */
+#define ENCODED_CHAR_MAX 16
+
+/* Room kept at the end of each line for a stateful charset such as
+ * ISO-2022-JP to get back to its initial state */
+#define SHIFT_RESERVE 8
+
+typedef struct {
+	/* (GIConv) -1 when the text goes out as UTF-8 */
+	GIConv conv;
+
+	/* the line being built: the encoded header, then the encoded body */
+	gchar line[IRC_MSG_MAXLEN + 3];
+	gsize len;
+	gsize header_len;
+	/* how long the line may get before the reset sequence and footer */
+	gsize max_len;
+	const gchar *footer;
+
+	/* where this line starts in the text */
+	const gchar *line_text;
+	/* where to go back to, in the line and in the text, to break it just
+	 * after its last space */
+	gsize break_len;
+	const gchar *break_text;
+
+	IdleTextLineFunc func;
+	gpointer user_data;
+} IdleTextSplitter;
+
+/* Encodes the UTF-8 character at @c into @out, returning its length there */
+static gsize
+_splitter_encode (IdleTextSplitter *splitter,
+	const gchar *c,
+	gchar *out)
+{
+	gchar *inbuf = (gchar *) c;
+	gchar *outbuf = out;
+	gsize inleft = g_utf8_next_char (c) - c;
+	gsize outleft = ENCODED_CHAR_MAX;
+
+	/* a stray <CR> would end the line early */
+	if (*c == '\r')
+		inbuf = (gchar *) " ";
+
+	if (splitter->conv == (GIConv) -1) {
+		memcpy (out, inbuf, inleft);
+		return inleft;
+	}
+
+	if (g_iconv (splitter->conv, &inbuf, &inleft, &outbuf, &outleft) == (gsize) -1) {
+		/* the charset has no way to say it */
+		inbuf = (gchar *) "?";
+		inleft = 1;
+		outbuf = out;
+		outleft = ENCODED_CHAR_MAX;
+		g_iconv (splitter->conv, &inbuf, &inleft, &outbuf, &outleft);
+	}
+
+	return outbuf - out;
+}
+
+/* Encodes the line again from the start of its text up to @end, for when a
+ * character which was encoded didn't fit after all: for a stateful charset,
+ * that has left the converter in the wrong state to end the line. */
+static void
+_splitter_reencode (IdleTextSplitter *splitter,
+	const gchar *end)
+{
+	const gchar *p;
+
+	g_iconv (splitter->conv, NULL, NULL, NULL, NULL);
+	splitter->len = splitter->header_len;
+
+	for (p = splitter->line_text; p < end; p = g_utf8_next_char (p))
+		splitter->len += _splitter_encode (splitter, p, splitter->line + splitter->len);
+}
+
+/* Sends the line built so far, if any, and starts the next one at @next */
+static void
+_splitter_finish_line (IdleTextSplitter *splitter,
+	const gchar *next)
+{
+	gsize footer_len = strlen (splitter->footer);
+
+	if (splitter->len > splitter->header_len) {
+		if (splitter->conv != (GIConv) -1) {
+			gchar *outbuf = splitter->line + splitter->len;
+			gsize outleft = SHIFT_RESERVE;
+
+			g_iconv (splitter->conv, NULL, NULL, &outbuf, &outleft);
+			splitter->len = outbuf - splitter->line;
+		}
+
+		memcpy (splitter->line + splitter->len, splitter->footer, footer_len);
+		splitter->len += footer_len;
+		splitter->line[splitter->len++] = '\r';
+		splitter->line[splitter->len++] = '\n';
+
+		splitter->func (splitter->line, splitter->len, splitter->user_data);
+	}
+
+	splitter->len = splitter->header_len;
+	splitter->line_text = next;
+	splitter->break_len = 0;
+	splitter->break_text = NULL;
+}
+
 /**
  * idle_text_encode_and_split:
  * @type: The type of message as per Telepathy
@@ -57,29 +177,36 @@ gboolean idle_text_decode(const gchar *text, TpChannelTextMessageType *type, gch
  * @text: The message body
  * @max_msg_len: The maximum length of the message on this server (see also
  *               idle_connection_get_max_message_length())
- * @bodies_out: Location at which to return the human-readable bodies of each
- *              part
+ * @charset: The charset to send in, or %NULL for UTF-8
+ * @func: Called with each line, encoded and ending with <CR><LF>
+ * @user_data: Passed to @func
  * @error: Location at which to store an error
  *
  * Splits @text as necessary to be able to send it over IRC. IRC messages
- * cannot contain newlines, and have a (server-determined) maximum length.
+ * cannot contain newlines, and have a (server-determined) maximum length,
+ * which is measured in bytes of @charset. Lines are broken after a space
+ * where that doesn't waste more than half of one, and between characters
+ * otherwise.
  *
- * Returns: A list of IRC protocol commands representing @text as best possible.
+ * Returns: %FALSE if @text can't be sent this way at all.
  */
-GStrv
+gboolean
 idle_text_encode_and_split(TpChannelTextMessageType type,
 		const gchar *recipient,
 		const gchar *text,
 		gsize max_msg_len,
-		GStrv *bodies_out,
+		const gchar *charset,
+		IdleTextLineFunc func,
+		gpointer user_data,
 		GError **error) {
-	GPtrArray *messages;
-	GPtrArray *bodies;
-	const gchar *remaining_text = text;
-	const gchar * const text_end =  text + strlen(text);
+	IdleTextSplitter *splitter;
 	gchar *header;
-	const gchar *footer = "";
-	gsize max_bytes;
+	gchar *encoded_header = NULL;
+	const gchar *header_out;
+	gsize header_len = 0;
+	gsize reserved;
+	const gchar *p = text;
+	gboolean ret = FALSE;
 
 	switch (type) {
 		case TP_CHANNEL_TEXT_MESSAGE_TYPE_NORMAL:
@@ -87,7 +214,6 @@ idle_text_encode_and_split(TpChannelTextMessageType type,
 			break;
 		case TP_CHANNEL_TEXT_MESSAGE_TYPE_ACTION:
 			header = g_strdup_printf("PRIVMSG %s :\001ACTION ", recipient);
-			footer = "\001";
 			break;
 		case TP_CHANNEL_TEXT_MESSAGE_TYPE_NOTICE:
 			header = g_strdup_printf("NOTICE %s :", recipient);
@@ -95,58 +221,121 @@ idle_text_encode_and_split(TpChannelTextMessageType type,
 		default:
 			IDLE_DEBUG("unsupported message type %u", type);
 			g_set_error(error, TP_ERROR, TP_ERROR_NOT_IMPLEMENTED, "unsupported message type %u", type);
-			return NULL;
-	}
-
-	messages = g_ptr_array_new();
-	bodies = g_ptr_array_new();
-	max_bytes = max_msg_len - (strlen(header) + strlen(footer));
-
-	while (remaining_text < text_end) {
-		char *newline = strchr(remaining_text, '\n');
-		const char *end_iter;
-		char *message;
-		int len;
-
-		if (newline != NULL && ((unsigned) (newline - remaining_text)) < max_bytes) {
-			/* String up to the next newline is short enough. */
-			end_iter = newline;
-
-		} else if ((text_end - remaining_text) > (gint) max_bytes) {
-			/* Remaining string is too long; take as many bytes as possible */
-			end_iter = remaining_text + max_bytes;
-			/* make sure we don't break a UTF-8 code point in half */
-			end_iter = g_utf8_find_prev_char (remaining_text, end_iter);
-		} else {
-			/* Just take it all. */
-			end_iter = text_end;
-		}
+			return FALSE;
+	}
+
+	splitter = g_slice_new0(IdleTextSplitter);
+	splitter->conv = (GIConv) -1;
+	splitter->footer = (type == TP_CHANNEL_TEXT_MESSAGE_TYPE_ACTION) ? "\001" : "";
+	splitter->func = func;
+	splitter->user_data = user_data;
+
+	/* Converting from UTF-8 to UTF-8 would only give us a copy */
+	if (charset != NULL && g_ascii_strcasecmp(charset, "UTF-8") != 0) {
+		splitter->conv = g_iconv_open(charset, "UTF-8");
+		encoded_header = g_convert(header, -1, charset, "UTF-8", NULL, &header_len, NULL);
+
+		if (splitter->conv == (GIConv) -1 || encoded_header == NULL) {
+			IDLE_DEBUG("can't send in %s, sending UTF-8 instead", charset);
 
-		len = (int)(end_iter - remaining_text);
-		message = g_strdup_printf("%s%.*s%s", header, len, remaining_text, footer);
-		g_ptr_array_add(messages, message);
-		g_ptr_array_add(bodies, g_strndup(remaining_text, len));
+			if (splitter->conv != (GIConv) -1)
+				g_iconv_close(splitter->conv);
 
-		remaining_text = end_iter;
-		if (*end_iter == '\n') {
-				/* advance over a newline */
-				remaining_text++;
+			splitter->conv = (GIConv) -1;
 		}
 	}
 
-	g_assert (remaining_text == text_end);
+	if (splitter->conv != (GIConv) -1) {
+		header_out = encoded_header;
+	} else {
+		header_out = header;
+		header_len = strlen(header);
+	}
 
-	g_ptr_array_add(messages, NULL);
-	g_ptr_array_add(bodies, NULL);
+	/* what has to fit after the body */
+	reserved = strlen(splitter->footer);
+	if (splitter->conv != (GIConv) -1)
+		reserved += SHIFT_RESERVE;
 
-	if (bodies_out != NULL) {
-		*bodies_out = (GStrv) g_ptr_array_free(bodies, FALSE);
-	} else {
-		g_ptr_array_free(bodies, TRUE);
+	max_msg_len = MIN(max_msg_len, IRC_MSG_MAXLEN);
+	if (header_len + ENCODED_CHAR_MAX + reserved > max_msg_len) {
+		IDLE_DEBUG("no room for a message to %s", recipient);
+		g_set_error(error, TP_ERROR, TP_ERROR_INVALID_ARGUMENT, "recipient name is too long: %s", recipient);
+		goto out;
+	}
+
+	splitter->max_len = max_msg_len - reserved;
+
+	memcpy(splitter->line, header_out, header_len);
+	splitter->header_len = header_len;
+	splitter->len = header_len;
+	splitter->line_text = p;
+
+	while (*p != '\0') {
+		gchar encoded[ENCODED_CHAR_MAX];
+		gsize len;
+
+		if (*p == '\n' || (*p == '\r' && p[1] == '\n')) {
+			p += (*p == '\r') ? 2 : 1;
+			_splitter_finish_line(splitter, p);
+			continue;
+		}
+
+		len = _splitter_encode(splitter, p, encoded);
+
+		if (splitter->len + len > splitter->max_len) {
+			/* Only break after a space if that leaves at least half a line;
+			 * what follows it is encoded again for the next line. */
+			if (splitter->break_len > splitter->header_len + (splitter->max_len - splitter->header_len) / 2) {
+				splitter->len = splitter->break_len;
+				p = splitter->break_text;
+			}
+
+			if (splitter->conv != (GIConv) -1)
+				_splitter_reencode(splitter, p);
+
+			_splitter_finish_line(splitter, p);
+			continue;
+		}
+
+		memcpy(splitter->line + splitter->len, encoded, len);
+		splitter->len += len;
+
+		if (*p == ' ') {
+			splitter->break_len = splitter->len;
+			splitter->break_text = p + 1;
+		}
+
+		p = g_utf8_next_char(p);
 	}
 
+	_splitter_finish_line(splitter, p);
+	ret = TRUE;
+
+out:
+	if (splitter->conv != (GIConv) -1)
+		g_iconv_close(splitter->conv);
+
+	g_slice_free(IdleTextSplitter, splitter);
+	g_free(encoded_header);
 	g_free(header);
-	return (GStrv) g_ptr_array_free(messages, FALSE);
+
+	return ret;
+}
+
+typedef struct {
+	IdleConnection *conn;
+	const gchar *recipient;
+} IdleTextSendData;
+
+static void
+_send_line (const gchar *line,
+	gsize len,
+	gpointer user_data)
+{
+	IdleTextSendData *data = user_data;
+
+	idle_connection_send_encoded (data->conn, data->recipient, line, len);
 }
 
 void idle_text_send(GObject *obj, TpMessage *message, TpMessageSendingFlags flags, const gchar *recipient, IdleConnection *conn) {
@@ -156,10 +345,8 @@ void idle_text_send(GObject *obj, TpMessage *message, TpMessageSendingFlags flag
 	gboolean result = TRUE;
 	const gchar *content_type, *text;
 	guint n_parts;
-	GStrv messages;
-	GStrv bodies;
+	IdleTextSendData data = { conn, recipient };
 	gsize msg_len;
-	guint i;
 
 	#define INVALID_ARGUMENT(msg, ...) \
 	G_STMT_START { \
@@ -200,18 +387,10 @@ void idle_text_send(GObject *obj, TpMessage *message, TpMessageSendingFlags flag
 	/* Okay, it's valid. Let's send it. */
 
 	msg_len = idle_connection_get_max_message_length(conn);
-	messages = idle_text_encode_and_split(type, recipient, text, msg_len, &bodies, &error);
-	if (messages == NULL)
+	if (!idle_text_encode_and_split(type, recipient, text, msg_len,
+			idle_connection_get_charset(conn), _send_line, &data, &error))
 		goto failed;
 
-	for(i = 0; messages[i] != NULL; i++) {
-		g_assert(bodies[i] != NULL);
-		idle_connection_send(conn, messages[i]);
-	}
-
-	g_strfreev(messages);
-	g_strfreev(bodies);
-
 	tp_message_mixin_sent (obj, message, flags, "", NULL);
 	return;
 
@@ -221,6 +400,777 @@ failed:
 	g_error_free (error);
 }
 
+/* The messages received in a channel which no client has acknowledged yet.
+ * They are kept here rather than in the channel's TpMessageMixin, which only
+ * handles sending, so that they needn't all be held in memory: the channel
+ * implements the D-Bus methods and property which list them using this.
+ *
+ * If the connection limits how many pending messages a channel may hold in
+ * memory, the oldest ones over that limit are appended to an unlinked file in
+ * the user cache dir, headers and all, and the TpMessage for one is only made
+ * again while answering a client asking for pending messages. */
+typedef struct {
+	IdleConnection *conn;
+	guint next_id;
+
+	/* IdleTextPendingMessage, oldest first: those on disk, then those in
+	 * memory */
+	GQueue messages;
+	/* pending message id => its link in messages */
+	GHashTable *links;
+	/* the oldest of those in memory, if any */
+	GList *first_in_memory;
+	guint in_memory;
+
+	guint memory_limit;
+	FILE *spill;
+} IdleTextPending;
+
+typedef struct {
+	guint id;
+	TpHandle sender;
+	/* length of its text */
+	gsize len;
+
+	/* NULL once it has been written to the spill file, at offset */
+	TpMessage *message;
+	long offset;
+	gboolean rescued;
+} IdleTextPendingMessage;
+
+/* What goes in the spill file for each message, followed by its text */
+typedef struct {
+	guint32 id;
+	guint32 sender;
+	guint32 type;
+	guint32 dropped;
+	gint64 received;
+	guint32 len;
+} IdleTextRecord;
+
+static GQuark
+_pending_quark (void)
+{
+	static GQuark quark = 0;
+
+	if (G_UNLIKELY (quark == 0))
+		quark = g_quark_from_static_string ("idle-text-pending");
+
+	return quark;
+}
+
+static TpMessage *
+_message_new (TpBaseConnection *base_conn,
+	guint id,
+	TpHandle sender,
+	TpChannelTextMessageType type,
+	const gchar *text,
+	gint64 timestamp,
+	guint dropped,
+	gboolean rescued)
+{
+	TpMessage *message = tp_cm_message_new_text (base_conn, sender, type, text);
+
+	tp_message_set_uint32 (message, 0, "pending-message-id", id);
+	tp_message_set_int64 (message, 0, "message-received", timestamp);
+
+	if (dropped > 0)
+		tp_message_set_uint32 (message, 0, IDLE_MESSAGE_HEADER_DROPPED, dropped);
+
+	if (rescued)
+		tp_message_set_boolean (message, 0, "rescued", TRUE);
+
+	return message;
+}
+
+/* Returns @message as the Text interface sees it */
+static GValueArray *
+_message_to_pending_text (TpMessage *message)
+{
+	const GHashTable *header = tp_message_peek (message, 0);
+	guint flags = 0;
+
+	if (tp_asv_get_boolean (header, "rescued", NULL))
+		flags |= TP_CHANNEL_TEXT_MESSAGE_FLAG_RESCUED;
+
+	return tp_value_array_build (6,
+		G_TYPE_UINT, tp_asv_get_uint32 (header, "pending-message-id", NULL),
+		G_TYPE_UINT, (guint) tp_asv_get_int64 (header, "message-received", NULL),
+		G_TYPE_UINT, tp_asv_get_uint32 (header, "message-sender", NULL),
+		G_TYPE_UINT, tp_asv_get_uint32 (header, "message-type", NULL),
+		G_TYPE_UINT, flags,
+		G_TYPE_STRING, tp_asv_get_string (tp_message_peek (message, 1), "content"),
+		G_TYPE_INVALID);
+}
+
+/* Returns @message as the Messages interface sees it */
+static GPtrArray *
+_message_dup_parts (TpMessage *message)
+{
+	guint n_parts = tp_message_count_parts (message);
+	GPtrArray *parts = g_ptr_array_sized_new (n_parts);
+	guint i;
+
+	for (i = 0; i < n_parts; i++)
+		g_ptr_array_add (parts, tp_message_dup_part (message, i));
+
+	return parts;
+}
+
+static void
+_spill_close (IdleTextPending *pending)
+{
+	if (pending->spill == NULL)
+		return;
+
+	fclose (pending->spill);
+	pending->spill = NULL;
+}
+
+static gboolean
+_spill_open (IdleTextPending *pending)
+{
+	gchar *dir = g_build_filename (g_get_user_cache_dir (), "telepathy-idle", NULL);
+	gchar *path = g_build_filename (dir, "pending-XXXXXX", NULL);
+	gint fd = -1;
+
+	if (g_mkdir_with_parents (dir, 0700) == 0)
+		fd = g_mkstemp (path);
+
+	if (fd == -1) {
+		IDLE_DEBUG ("couldn't create a file in %s: %s", dir, g_strerror (errno));
+	} else {
+		/* nobody else needs to see it, and it goes away with us */
+		g_unlink (path);
+		pending->spill = fdopen (fd, "w+b");
+
+		if (pending->spill == NULL)
+			close (fd);
+	}
+
+	g_free (path);
+	g_free (dir);
+	return pending->spill != NULL;
+}
+
+/* Appends @pending_message to the spill file */
+static gboolean
+_spill_write (IdleTextPending *pending,
+	IdleTextPendingMessage *pending_message)
+{
+	const GHashTable *header = tp_message_peek (pending_message->message, 0);
+	const gchar *text = tp_asv_get_string (
+		tp_message_peek (pending_message->message, 1), "content");
+	IdleTextRecord record = { 0, };
+	long offset;
+
+	if (pending->spill == NULL && !_spill_open (pending))
+		return FALSE;
+
+	record.id = pending_message->id;
+	record.sender = pending_message->sender;
+	record.type = tp_asv_get_uint32 (header, "message-type", NULL);
+	record.dropped = tp_asv_get_uint32 (header, IDLE_MESSAGE_HEADER_DROPPED, NULL);
+	record.received = tp_asv_get_int64 (header, "message-received", NULL);
+	record.len = pending_message->len;
+
+	if (fseek (pending->spill, 0, SEEK_END) != 0 ||
+	    (offset = ftell (pending->spill)) < 0 ||
+	    fwrite (&record, sizeof (record), 1, pending->spill) != 1 ||
+	    fwrite (text, 1, record.len, pending->spill) != record.len) {
+		IDLE_DEBUG ("couldn't write to the spill file: %s", g_strerror (errno));
+		return FALSE;
+	}
+
+	pending_message->offset = offset;
+	pending_message->rescued = tp_asv_get_boolean (header, "rescued", NULL);
+	return TRUE;
+}
+
+/* Makes the TpMessage for @pending_message again from the spill file, or
+ * returns NULL if it can't be read back */
+static TpMessage *
+_spill_read (IdleTextPending *pending,
+	TpBaseConnection *base_conn,
+	IdleTextPendingMessage *pending_message)
+{
+	IdleTextRecord record;
+	TpMessage *message;
+	gchar *text;
+
+	if (fflush (pending->spill) != 0 ||
+	    fseek (pending->spill, pending_message->offset, SEEK_SET) != 0 ||
+	    fread (&record, sizeof (record), 1, pending->spill) != 1) {
+		IDLE_DEBUG ("couldn't read from the spill file: %s", g_strerror (errno));
+		return NULL;
+	}
+
+	g_return_val_if_fail (record.id == pending_message->id, NULL);
+
+	text = g_malloc (record.len + 1);
+
+	if (fread (text, 1, record.len, pending->spill) != record.len) {
+		IDLE_DEBUG ("couldn't read from the spill file: %s", g_strerror (errno));
+		g_free (text);
+		return NULL;
+	}
+
+	text[record.len] = '\0';
+	message = _message_new (base_conn, record.id, record.sender, record.type,
+		text, record.received, record.dropped, pending_message->rescued);
+
+	g_free (text);
+	return message;
+}
+
+/* Moves the oldest message still in memory to the spill file */
+static void
+_spill_oldest (IdleTextPending *pending)
+{
+	IdleTextPendingMessage *pending_message = pending->first_in_memory->data;
+
+	if (!_spill_write (pending, pending_message))
+		return;
+
+	g_object_unref (pending_message->message);
+	pending_message->message = NULL;
+	pending->first_in_memory = pending->first_in_memory->next;
+	pending->in_memory--;
+}
+
+/* Forgets the message at @link, returning the length of its text */
+static gsize
+_pending_unlink (IdleTextPending *pending,
+	GList *link)
+{
+	IdleTextPendingMessage *pending_message = link->data;
+	gsize len = pending_message->len;
+
+	if (link == pending->first_in_memory)
+		pending->first_in_memory = link->next;
+
+	if (pending_message->message != NULL) {
+		g_object_unref (pending_message->message);
+		pending->in_memory--;
+	}
+
+	g_hash_table_remove (pending->links, GUINT_TO_POINTER (pending_message->id));
+	g_queue_delete_link (&pending->messages, link);
+	g_slice_free (IdleTextPendingMessage, pending_message);
+
+	/* Once nothing in it is needed, start again with an empty file */
+	if (pending->messages.length == pending->in_memory)
+		_spill_close (pending);
+
+	return len;
+}
+
+/* Forgets every pending message, without telling clients */
+static void
+_pending_clear (IdleTextPending *pending)
+{
+	gint messages = pending->messages.length;
+	gssize bytes = 0;
+
+	while (!g_queue_is_empty (&pending->messages))
+		bytes += _pending_unlink (pending, pending->messages.head);
+
+	if (pending->conn != NULL && messages > 0)
+		idle_connection_update_pending (pending->conn, -messages, -bytes);
+}
+
+static void
+_pending_free (gpointer data)
+{
+	IdleTextPending *pending = data;
+
+	/* Whatever is left was dropped along with the channel */
+	_pending_clear (pending);
+
+	if (pending->conn != NULL)
+		g_object_remove_weak_pointer (G_OBJECT (pending->conn),
+			(gpointer *) &pending->conn);
+
+	g_hash_table_unref (pending->links);
+	g_slice_free (IdleTextPending, pending);
+}
+
+static IdleTextPending *
+_pending_get (GObject *chan,
+	TpBaseConnection *base_conn)
+{
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+
+	if (pending != NULL)
+		return pending;
+
+	pending = g_slice_new0 (IdleTextPending);
+	pending->conn = IDLE_CONNECTION (base_conn);
+	g_object_add_weak_pointer (G_OBJECT (base_conn), (gpointer *) &pending->conn);
+	g_queue_init (&pending->messages);
+	pending->links = g_hash_table_new (NULL, NULL);
+	pending->memory_limit = idle_connection_get_max_pending_in_memory (pending->conn);
+
+	g_object_set_qdata_full (chan, _pending_quark (), pending, _pending_free);
+
+	return pending;
+}
+
+/* Returns @chan's pending messages, oldest first, reading back those which
+ * are on disk; free with g_list_free_full (list, g_object_unref) */
+static GList *
+_pending_dup_messages (GObject *chan)
+{
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+	TpBaseConnection *base_conn;
+	GList *messages = NULL;
+	GList *l;
+
+	if (pending == NULL)
+		return NULL;
+
+	base_conn = tp_base_channel_get_connection (TP_BASE_CHANNEL (chan));
+
+	for (l = pending->messages.head; l != NULL; l = l->next) {
+		IdleTextPendingMessage *pending_message = l->data;
+		TpMessage *message;
+
+		if (pending_message->message != NULL)
+			message = g_object_ref (pending_message->message);
+		else
+			message = _spill_read (pending, base_conn, pending_message);
+
+		if (message != NULL)
+			messages = g_list_prepend (messages, message);
+	}
+
+	return g_list_reverse (messages);
+}
+
+/* Forgets the pending messages @ids, all of which are pending, and tells
+ * clients so */
+static void
+_pending_acknowledge (GObject *chan,
+	IdleTextPending *pending,
+	const GArray *ids)
+{
+	gint messages = 0;
+	gssize bytes = 0;
+	guint i;
+
+	for (i = 0; i < ids->len; i++) {
+		GList *link = g_hash_table_lookup (pending->links,
+			GUINT_TO_POINTER (g_array_index (ids, guint, i)));
+
+		/* it might have been listed twice */
+		if (link == NULL)
+			continue;
+
+		bytes += _pending_unlink (pending, link);
+		messages++;
+	}
+
+	if (pending->conn != NULL && messages > 0)
+		idle_connection_update_pending (pending->conn, -messages, -bytes);
+
+	tp_svc_channel_interface_messages_emit_pending_messages_removed (chan, ids);
+}
+
+static void
+_text_deliver (GObject *chan,
+	TpBaseConnection *base_conn,
+	TpChannelTextMessageType type,
+	const gchar *text,
+	TpHandle sender,
+	gint64 timestamp,
+	guint dropped)
+{
+	IdleTextPending *pending = _pending_get (chan, base_conn);
+	IdleTextPendingMessage *pending_message = g_slice_new0 (IdleTextPendingMessage);
+	GPtrArray *parts;
+
+	pending_message->id = pending->next_id++;
+	pending_message->sender = sender;
+	pending_message->len = strlen (text);
+	pending_message->message = _message_new (base_conn, pending_message->id,
+		sender, type, text, timestamp, dropped, FALSE);
+
+	g_queue_push_tail (&pending->messages, pending_message);
+	g_hash_table_insert (pending->links, GUINT_TO_POINTER (pending_message->id),
+		pending->messages.tail);
+	if (pending->first_in_memory == NULL)
+		pending->first_in_memory = pending->messages.tail;
+	pending->in_memory++;
+
+	idle_connection_update_pending (pending->conn, 1, pending_message->len);
+
+	parts = _message_dup_parts (pending_message->message);
+	tp_svc_channel_interface_messages_emit_message_received (chan, parts);
+	g_boxed_free (TP_ARRAY_TYPE_MESSAGE_PART_LIST, parts);
+
+	tp_svc_channel_type_text_emit_received (chan, pending_message->id,
+		(guint) timestamp, sender, type, 0, text);
+
+	if (pending->memory_limit != 0 && pending->in_memory > pending->memory_limit)
+		_spill_oldest (pending);
+}
+
+static void
+_list_pending_messages (TpSvcChannelTypeText *iface,
+	gboolean clear,
+	DBusGMethodInvocation *context)
+{
+	GObject *chan = G_OBJECT (iface);
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+	GList *messages = _pending_dup_messages (chan);
+	GPtrArray *list = g_ptr_array_new ();
+	GList *l;
+
+	for (l = messages; l != NULL; l = l->next)
+		g_ptr_array_add (list, _message_to_pending_text (l->data));
+
+	if (clear && pending != NULL && !g_queue_is_empty (&pending->messages)) {
+		GArray *ids = g_array_sized_new (FALSE, FALSE, sizeof (guint),
+			pending->messages.length);
+
+		for (l = pending->messages.head; l != NULL; l = l->next)
+			g_array_append_val (ids, ((IdleTextPendingMessage *) l->data)->id);
+
+		_pending_acknowledge (chan, pending, ids);
+		g_array_unref (ids);
+	}
+
+	tp_svc_channel_type_text_return_from_list_pending_messages (context, list);
+
+	g_boxed_free (TP_ARRAY_TYPE_PENDING_TEXT_MESSAGE_LIST, list);
+	g_list_free_full (messages, g_object_unref);
+}
+
+static void
+_acknowledge_pending_messages (TpSvcChannelTypeText *iface,
+	const GArray *ids,
+	DBusGMethodInvocation *context)
+{
+	GObject *chan = G_OBJECT (iface);
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+	guint i;
+
+	for (i = 0; i < ids->len; i++) {
+		guint id = g_array_index (ids, guint, i);
+
+		if (pending == NULL ||
+		    !g_hash_table_contains (pending->links, GUINT_TO_POINTER (id))) {
+			GError *error = g_error_new (TP_ERROR, TP_ERROR_INVALID_ARGUMENT,
+				"invalid message id %u", id);
+
+			IDLE_DEBUG ("%s", error->message);
+			dbus_g_method_return_error (context, error);
+			g_error_free (error);
+			return;
+		}
+	}
+
+	if (ids->len > 0)
+		_pending_acknowledge (chan, pending, ids);
+
+	tp_svc_channel_type_text_return_from_acknowledge_pending_messages (context);
+}
+
+static void
+_get_pending_message_content (TpSvcChannelInterfaceMessages *iface,
+	guint message_id,
+	const GArray *part_numbers,
+	DBusGMethodInvocation *context)
+{
+	GObject *chan = G_OBJECT (iface);
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+	IdleTextPendingMessage *pending_message = NULL;
+	TpMessage *message = NULL;
+	GHashTable *content;
+	GError *error = NULL;
+	guint i;
+
+	if (pending != NULL) {
+		GList *link = g_hash_table_lookup (pending->links,
+			GUINT_TO_POINTER (message_id));
+
+		if (link != NULL)
+			pending_message = link->data;
+	}
+
+	if (pending_message == NULL) {
+		g_set_error (&error, TP_ERROR, TP_ERROR_INVALID_ARGUMENT,
+			"invalid message id %u", message_id);
+		goto failed;
+	}
+
+	if (pending_message->message != NULL)
+		message = g_object_ref (pending_message->message);
+	else
+		message = _spill_read (pending,
+			tp_base_channel_get_connection (TP_BASE_CHANNEL (chan)),
+			pending_message);
+
+	if (message == NULL) {
+		g_set_error (&error, TP_ERROR, TP_ERROR_NOT_AVAILABLE,
+			"message %u couldn't be read back from disk", message_id);
+		goto failed;
+	}
+
+	content = g_hash_table_new_full (NULL, NULL, NULL,
+		(GDestroyNotify) tp_g_value_slice_free);
+
+	for (i = 0; i < part_numbers->len; i++) {
+		guint part = g_array_index (part_numbers, guint, i);
+		GValue *value;
+
+		if (part == 0 || part >= tp_message_count_parts (message)) {
+			g_hash_table_unref (content);
+			g_set_error (&error, TP_ERROR, TP_ERROR_INVALID_ARGUMENT,
+				"part number %u out of range", part);
+			goto failed;
+		}
+
+		value = tp_asv_lookup (tp_message_peek (message, part), "content");
+
+		if (value != NULL)
+			g_hash_table_insert (content, GUINT_TO_POINTER (part),
+				tp_g_value_slice_dup (value));
+	}
+
+	tp_svc_channel_interface_messages_return_from_get_pending_message_content (
+		context, content);
+
+	g_hash_table_unref (content);
+	g_object_unref (message);
+	return;
+
+failed:
+	IDLE_DEBUG ("%s", error->message);
+	dbus_g_method_return_error (context, error);
+	g_error_free (error);
+
+	if (message != NULL)
+		g_object_unref (message);
+}
+
+static void
+_get_messages_property (GObject *object,
+	GQuark iface,
+	GQuark name,
+	GValue *value,
+	gpointer getter_data)
+{
+	GList *messages;
+	GPtrArray *list;
+	GList *l;
+
+	/* the message mixin knows everything else */
+	if (name != g_quark_from_static_string ("PendingMessages")) {
+		tp_message_mixin_get_dbus_property (object, iface, name, value, getter_data);
+		return;
+	}
+
+	messages = _pending_dup_messages (object);
+	list = g_ptr_array_new ();
+
+	for (l = messages; l != NULL; l = l->next)
+		g_ptr_array_add (list, _message_dup_parts (l->data));
+
+	g_value_take_boxed (value, list);
+	g_list_free_full (messages, g_object_unref);
+}
+
+/**
+ * idle_text_text_iface_init:
+ *
+ * Like tp_message_mixin_text_iface_init(), for a channel using
+ * idle_text_received(): the pending messages are listed and acknowledged
+ * here rather than by the mixin.
+ */
+void
+idle_text_text_iface_init (gpointer g_iface,
+	gpointer iface_data)
+{
+	TpSvcChannelTypeTextClass *klass = g_iface;
+
+	tp_message_mixin_text_iface_init (g_iface, iface_data);
+
+	tp_svc_channel_type_text_implement_list_pending_messages (klass,
+		_list_pending_messages);
+	tp_svc_channel_type_text_implement_acknowledge_pending_messages (klass,
+		_acknowledge_pending_messages);
+}
+
+/**
+ * idle_text_messages_iface_init:
+ *
+ * Like tp_message_mixin_messages_iface_init(), for a channel using
+ * idle_text_received().
+ */
+void
+idle_text_messages_iface_init (gpointer g_iface,
+	gpointer iface_data)
+{
+	TpSvcChannelInterfaceMessagesClass *klass = g_iface;
+
+	tp_message_mixin_messages_iface_init (g_iface, iface_data);
+
+	tp_svc_channel_interface_messages_implement_get_pending_message_content (
+		klass, _get_pending_message_content);
+}
+
+/**
+ * idle_text_init_dbus_properties:
+ *
+ * Like tp_message_mixin_init_dbus_properties(), for a channel using
+ * idle_text_received(): PendingMessages comes from here, and the rest from
+ * the mixin.
+ */
+void
+idle_text_init_dbus_properties (GObjectClass *cls)
+{
+	static TpDBusPropertiesMixinPropImpl props[] = {
+		{ "PendingMessages", NULL, NULL },
+		{ "SupportedContentTypes", NULL, NULL },
+		{ "MessageTypes", NULL, NULL },
+		{ "MessagePartSupportFlags", NULL, NULL },
+		{ "DeliveryReportingSupport", NULL, NULL },
+		{ NULL }
+	};
+
+	tp_dbus_properties_mixin_implement_interface (cls,
+		TP_IFACE_QUARK_CHANNEL_INTERFACE_MESSAGES,
+		_get_messages_property, NULL, props);
+}
+
+/* Once a contact has sent the connection's sender-flood-limit messages to a
+ * channel within FLOOD_WINDOW, the rest of what they send there is combined
+ * into one message which is delivered when the window ends, so that a flood
+ * costs clients one signal every FLOOD_WINDOW rather than one per line. */
+#define FLOOD_WINDOW 2000 /* msec */
+
+/* Beyond this much combined text, further messages are only counted */
+#define FLOOD_MAX_HELD 4096
+
+typedef struct {
+	GObject *chan;
+	TpHandle handle;
+
+	gint64 window_start;
+	guint count;
+
+	/* what's waiting for the end of the window, if anything */
+	GString *held;
+	TpChannelTextMessageType held_type;
+	gint64 held_timestamp;
+	guint dropped;
+	guint flush_id;
+} IdleTextSender;
+
+static GQuark
+_flood_quark (void)
+{
+	static GQuark quark = 0;
+
+	if (G_UNLIKELY (quark == 0))
+		quark = g_quark_from_static_string ("idle-text-flood");
+
+	return quark;
+}
+
+static void
+_sender_free (gpointer data)
+{
+	IdleTextSender *sender = data;
+
+	if (sender->flush_id != 0)
+		g_source_remove (sender->flush_id);
+
+	if (sender->held != NULL)
+		g_string_free (sender->held, TRUE);
+
+	g_slice_free (IdleTextSender, sender);
+}
+
+static void
+_sender_flush (IdleTextSender *sender)
+{
+	GString *held = sender->held;
+
+	if (held == NULL)
+		return;
+
+	sender->held = NULL;
+
+	IDLE_DEBUG ("delivering %" G_GSIZE_FORMAT " bytes held back from %u (%u dropped)",
+		held->len, sender->handle, sender->dropped);
+
+	_text_deliver (sender->chan,
+		tp_base_channel_get_connection (TP_BASE_CHANNEL (sender->chan)),
+		sender->held_type, held->str, sender->handle, sender->held_timestamp,
+		sender->dropped);
+	sender->dropped = 0;
+	g_string_free (held, TRUE);
+}
+
+static gboolean
+_sender_flush_cb (gpointer user_data)
+{
+	IdleTextSender *sender = user_data;
+	GHashTable *senders = g_object_get_qdata (sender->chan, _flood_quark ());
+
+	sender->flush_id = 0;
+	_sender_flush (sender);
+
+	/* its window is over, so it may as well start again from nothing */
+	g_hash_table_remove (senders, GUINT_TO_POINTER (sender->handle));
+	return FALSE;
+}
+
+static gboolean
+_sender_is_expired (gpointer key,
+	gpointer value,
+	gpointer user_data)
+{
+	IdleTextSender *sender = value;
+	gint64 now = *(gint64 *) user_data;
+
+	return sender->held == NULL && now - sender->window_start >= FLOOD_WINDOW * 1000;
+}
+
+static IdleTextSender *
+_sender_get (GObject *chan,
+	TpHandle handle,
+	gint64 now)
+{
+	GHashTable *senders = g_object_get_qdata (chan, _flood_quark ());
+	IdleTextSender *sender;
+
+	if (senders == NULL) {
+		senders = g_hash_table_new_full (NULL, NULL, NULL, _sender_free);
+		g_object_set_qdata_full (chan, _flood_quark (), senders,
+			(GDestroyNotify) g_hash_table_unref);
+	}
+
+	sender = g_hash_table_lookup (senders, GUINT_TO_POINTER (handle));
+
+	if (sender != NULL)
+		return sender;
+
+	/* don't keep everyone who ever spoke here */
+	if (g_hash_table_size (senders) >= 64)
+		g_hash_table_foreach_remove (senders, _sender_is_expired, &now);
+
+	sender = g_slice_new0 (IdleTextSender);
+	sender->chan = chan;
+	sender->handle = handle;
+	sender->window_start = now;
+	g_hash_table_insert (senders, GUINT_TO_POINTER (handle), sender);
+
+	return sender;
+}
+
 gboolean
 idle_text_received (GObject *chan,
 	TpBaseConnection *base_conn,
@@ -228,12 +1178,124 @@ idle_text_received (GObject *chan,
 	const gchar *text,
 	TpHandle sender)
 {
-	TpMessage *msg;
+	return idle_text_received_at (chan, base_conn, type, text, sender,
+		time (NULL));
+}
+
+/**
+ * idle_text_received_at:
+ * @timestamp: when the message reached us, as a UNIX timestamp
+ *
+ * Like idle_text_received(), for a message which was received earlier and
+ * kept back until now.
+ */
+gboolean
+idle_text_received_at (GObject *chan,
+	TpBaseConnection *base_conn,
+	TpChannelTextMessageType type,
+	const gchar *text,
+	TpHandle sender_handle,
+	gint64 timestamp)
+{
+	guint limit = idle_connection_get_sender_flood_limit (IDLE_CONNECTION (base_conn));
+	IdleTextSender *sender;
+	gint64 now;
+
+	if (limit == 0) {
+		_text_deliver (chan, base_conn, type, text, sender_handle, timestamp, 0);
+		return TRUE;
+	}
 
-	msg = tp_cm_message_new_text (base_conn, sender, type, text);
+	now = g_get_monotonic_time ();
+	sender = _sender_get (chan, sender_handle, now);
 
-	tp_message_set_int64 (msg, 0, "message-received", time (NULL));
+	if (sender->held == NULL && now - sender->window_start >= FLOOD_WINDOW * 1000) {
+		sender->window_start = now;
+		sender->count = 0;
+	}
+
+	if (++sender->count <= limit) {
+		_text_deliver (chan, base_conn, type, text, sender_handle, timestamp, 0);
+		return TRUE;
+	}
+
+	if (sender->held != NULL && sender->held_type != type)
+		_sender_flush (sender);
+
+	if (sender->held == NULL) {
+		sender->held = g_string_new (text);
+		sender->held_type = type;
+		sender->held_timestamp = timestamp;
+	} else if (sender->held->len + strlen (text) < FLOOD_MAX_HELD) {
+		g_string_append_c (sender->held, '\n');
+		g_string_append (sender->held, text);
+	} else {
+		sender->dropped++;
+	}
+
+	if (sender->flush_id == 0) {
+		gint64 remaining = sender->window_start + FLOOD_WINDOW * 1000 - now;
+
+		IDLE_DEBUG ("%u is flooding, holding messages back", sender_handle);
+		sender->flush_id = g_timeout_add (MAX (remaining / 1000, 0),
+			_sender_flush_cb, sender);
+	}
 
-	tp_message_mixin_take_received (chan, msg);
 	return TRUE;
 }
+
+/**
+ * idle_text_has_pending_messages:
+ * @chan: an IM or MUC channel
+ *
+ * Returns: whether any message received in @chan is yet to be acknowledged
+ */
+gboolean
+idle_text_has_pending_messages (GObject *chan)
+{
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+
+	return pending != NULL && !g_queue_is_empty (&pending->messages);
+}
+
+/**
+ * idle_text_set_rescued:
+ * @chan: an IM or MUC channel
+ *
+ * Like tp_message_mixin_set_rescued(): marks the messages pending in @chan as
+ * having been pending when the channel was closed and reopened.
+ */
+void
+idle_text_set_rescued (GObject *chan)
+{
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+	GList *l;
+
+	if (pending == NULL)
+		return;
+
+	for (l = pending->messages.head; l != NULL; l = l->next) {
+		IdleTextPendingMessage *pending_message = l->data;
+
+		if (pending_message->message != NULL)
+			tp_message_set_boolean (pending_message->message, 0, "rescued", TRUE);
+		else
+			pending_message->rescued = TRUE;
+	}
+}
+
+/**
+ * idle_text_clear:
+ * @chan: an IM or MUC channel
+ *
+ * Like tp_message_mixin_clear(): forgets the messages pending in @chan, for
+ * when the channel is about to go away.
+ */
+void
+idle_text_clear (GObject *chan)
+{
+	IdleTextPending *pending = g_object_get_qdata (chan, _pending_quark ());
+
+	if (pending != NULL)
+		_pending_clear (pending);
+}
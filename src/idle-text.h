@@ -31,8 +31,14 @@
 
 G_BEGIN_DECLS
 
+/* Header on a message combined by the sender flood limit: how many further
+ * messages arrived once the combined text was full, and were discarded. */
+#define IDLE_MESSAGE_HEADER_DROPPED "org.freedesktop.Telepathy.Idle.DroppedMessages"
+
 gboolean idle_text_decode(const gchar *text, TpChannelTextMessageType *type, gchar **body);
-GStrv idle_text_encode_and_split(TpChannelTextMessageType type, const gchar *recipient, const gchar *text, gsize max_msg_len, GStrv *bodies_out, GError **error);
+typedef void (*IdleTextLineFunc) (const gchar *line, gsize len, gpointer user_data);
+
+gboolean idle_text_encode_and_split(TpChannelTextMessageType type, const gchar *recipient, const gchar *text, gsize max_msg_len, const gchar *charset, IdleTextLineFunc func, gpointer user_data, GError **error);
 void idle_text_send(GObject *obj, TpMessage *message, TpMessageSendingFlags flags, const gchar *recipient, IdleConnection *conn);
 
 gboolean idle_text_received (GObject *chan,
@@ -40,6 +46,19 @@ gboolean idle_text_received (GObject *chan,
 	TpChannelTextMessageType type,
 	const gchar *text,
 	TpHandle sender);
+gboolean idle_text_received_at (GObject *chan,
+	TpBaseConnection *base_conn,
+	TpChannelTextMessageType type,
+	const gchar *text,
+	TpHandle sender,
+	gint64 timestamp);
+gboolean idle_text_has_pending_messages (GObject *chan);
+void idle_text_set_rescued (GObject *chan);
+void idle_text_clear (GObject *chan);
+
+void idle_text_text_iface_init (gpointer g_iface, gpointer iface_data);
+void idle_text_messages_iface_init (gpointer g_iface, gpointer iface_data);
+void idle_text_init_dbus_properties (GObjectClass *cls);
 
 G_END_DECLS
 
@@ -94,6 +94,7 @@ static const TpCMParamSpec idle_params[] = {
       TP_CONN_MGR_PARAM_FLAG_REQUIRED },
     { "port", DBUS_TYPE_UINT16_AS_STRING, G_TYPE_UINT,
       TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (DEFAULT_PORT) },
+    { "fallback-servers", "as", G_TYPE_STRV, 0 },
     { "password", DBUS_TYPE_STRING_AS_STRING, G_TYPE_STRING,
       TP_CONN_MGR_PARAM_FLAG_SECRET },
     { "fullname", DBUS_TYPE_STRING_AS_STRING, G_TYPE_STRING, 0 },
@@ -109,6 +110,20 @@ static const TpCMParamSpec idle_params[] = {
       TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GINT_TO_POINTER (FALSE) },
     { "password-prompt", DBUS_TYPE_BOOLEAN_AS_STRING, G_TYPE_BOOLEAN,
       TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GINT_TO_POINTER (FALSE) },
+    { "max-pending-messages", DBUS_TYPE_UINT32_AS_STRING, G_TYPE_UINT,
+      TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (0) },
+    { "max-pending-bytes", DBUS_TYPE_UINT32_AS_STRING, G_TYPE_UINT,
+      TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (0) },
+    { "pending-resume-percent", DBUS_TYPE_UINT32_AS_STRING, G_TYPE_UINT,
+      TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (50) },
+    { "max-pending-in-memory", DBUS_TYPE_UINT32_AS_STRING, G_TYPE_UINT,
+      TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (0) },
+    { "sender-flood-limit", DBUS_TYPE_UINT32_AS_STRING, G_TYPE_UINT,
+      TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (0) },
+    { "im-channel-threshold", DBUS_TYPE_UINT32_AS_STRING, G_TYPE_UINT,
+      TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (0) },
+    { "unread-timeout", DBUS_TYPE_UINT32_AS_STRING, G_TYPE_UINT,
+      TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (300) },
     { NULL, NULL, 0, 0, NULL, 0 }
 };
 
@@ -138,6 +153,7 @@ new_connection (TpBaseProtocol *protocol G_GNUC_UNUSED,
       "nickname", tp_asv_get_string (params, "account"),
       "server", tp_asv_get_string (params, "server"),
       "port", port,
+      "fallback-servers", tp_asv_get_strv (params, "fallback-servers"),
       "password", tp_asv_get_string (params, "password"),
       "realname", tp_asv_get_string (params, "fullname"),
       "username", tp_asv_get_string (params, "username"),
@@ -147,6 +163,20 @@ new_connection (TpBaseProtocol *protocol G_GNUC_UNUSED,
       "use-ssl", tp_asv_get_boolean (params, "use-ssl", NULL),
       "password-prompt", tp_asv_get_boolean (params, "password-prompt",
           NULL),
+      "max-pending-messages", tp_asv_get_uint32 (params,
+          "max-pending-messages", NULL),
+      "max-pending-bytes", tp_asv_get_uint32 (params, "max-pending-bytes",
+          NULL),
+      "pending-resume-percent", MIN (tp_asv_get_uint32 (params,
+          "pending-resume-percent", NULL), 100),
+      "max-pending-in-memory", tp_asv_get_uint32 (params,
+          "max-pending-in-memory", NULL),
+      "sender-flood-limit", tp_asv_get_uint32 (params,
+          "sender-flood-limit", NULL),
+      "im-channel-threshold", tp_asv_get_uint32 (params,
+          "im-channel-threshold", NULL),
+      "unread-timeout", MAX (tp_asv_get_uint32 (params,
+          "unread-timeout", NULL), 1),
       NULL);
 }
 
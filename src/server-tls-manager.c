@@ -50,6 +50,7 @@ struct _IdleServerTLSManagerPrivate {
   /* Current operation data */
   IdleServerTLSChannel *channel;
   GSimpleAsyncResult *async_result;
+  gchar *pin;
 
   /* List of owned TpBaseChannel not yet closed by the client */
   GList *completed_channels;
@@ -57,6 +58,11 @@ struct _IdleServerTLSManagerPrivate {
   gboolean dispose_has_run;
 };
 
+/* Certificates the user has accepted, as "peername fingerprint" strings.
+ * They are remembered for as long as the process lives, so that reconnecting
+ * to the same server doesn't ask again. */
+static GHashTable *accepted_certificates = NULL;
+
 #define chainup ((WockyTLSHandlerClass *) \
     idle_server_tls_manager_parent_class)
 
@@ -152,6 +158,30 @@ complete_verify (IdleServerTLSManager *self)
   /* Reset to initial state */
   g_clear_object (&self->priv->channel);
   g_clear_object (&self->priv->async_result);
+  tp_clear_pointer (&self->priv->pin, g_free);
+}
+
+static gchar *
+certificate_pin_new (GTlsCertificate *certificate,
+    const gchar *peername)
+{
+  GByteArray *der = NULL;
+  gchar *fingerprint;
+  gchar *pin;
+
+  g_object_get (certificate, "certificate", &der, NULL);
+
+  if (der == NULL)
+    return NULL;
+
+  fingerprint = g_compute_checksum_for_data (G_CHECKSUM_SHA256, der->data,
+      der->len);
+  pin = g_strdup_printf ("%s %s", peername, fingerprint);
+
+  g_free (fingerprint);
+  g_byte_array_unref (der);
+
+  return pin;
 }
 
 static void
@@ -207,6 +237,16 @@ tls_certificate_accepted_cb (IdleTLSCertificate *certificate,
 
   IDLE_DEBUG ("TLS certificate accepted");
 
+  if (self->priv->pin != NULL)
+    {
+      if (accepted_certificates == NULL)
+        accepted_certificates = g_hash_table_new_full (g_str_hash,
+            g_str_equal, g_free, NULL);
+
+      g_hash_table_add (accepted_certificates, self->priv->pin);
+      self->priv->pin = NULL;
+    }
+
   complete_verify (self);
 }
 
@@ -236,6 +276,7 @@ idle_server_tls_manager_verify_async (IdleServerTLSManager *self,
   IdleTLSCertificate *cert;
   GSimpleAsyncResult *result;
   const gchar *identities[] = { peername, NULL };
+  gchar *pin;
 
   g_return_if_fail (self->priv->async_result == NULL);
 
@@ -254,7 +295,21 @@ idle_server_tls_manager_verify_async (IdleServerTLSManager *self,
       return;
     }
 
+  pin = certificate_pin_new (certificate, peername);
+
+  if (pin != NULL && accepted_certificates != NULL &&
+      g_hash_table_contains (accepted_certificates, pin))
+    {
+      IDLE_DEBUG ("certificate for %s was accepted before; not asking again",
+          peername);
+      g_simple_async_result_complete_in_idle (result);
+      g_object_unref (result);
+      g_free (pin);
+      return;
+    }
+
   self->priv->async_result = result;
+  self->priv->pin = pin;
 
   self->priv->channel = g_object_new (IDLE_TYPE_SERVER_TLS_CHANNEL,
       "connection", self->priv->connection,
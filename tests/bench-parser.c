@@ -0,0 +1,96 @@
+#include "config.h"
+
+#include <idle-parser.h>
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define LINES_PER_CHUNK 8
+#define DEFAULT_ITERATIONS 100000
+
+/* Numerics the parser has no spec for: this measures splitting, tokenizing
+ * and dispatch, without needing a connection to look up handles. */
+static const gchar line[] = ":irc.example.com 372 bench :- Welcome to the benchmark server\r\n";
+
+static void
+_msg_split_cb (IdleParser *parser, const gchar *msg, gpointer user_data)
+{
+	guint *count = user_data;
+
+	(*count)++;
+}
+
+static gdouble
+_time_per_line (IdleParser *parser, const gchar *chunk, guint iterations)
+{
+	GTimer *timer = g_timer_new ();
+	gdouble elapsed;
+
+	for (guint i = 0; i < iterations; i++)
+		idle_parser_receive (parser, chunk);
+
+	elapsed = g_timer_elapsed (timer, NULL);
+	g_timer_destroy (timer);
+
+	return elapsed * 1e9 / (iterations * LINES_PER_CHUNK);
+}
+
+/* Lets "make check-perf" compare the result against its baseline. */
+static void
+_report_metric (const gchar *name, gdouble value)
+{
+	const gchar *results = g_getenv ("IDLE_PERF_RESULTS");
+	FILE *f;
+
+	if (results == NULL)
+		return;
+
+	f = fopen (results, "a");
+
+	if (f == NULL)
+		return;
+
+	fprintf (f, "%s %.1f\n", name, value);
+	fclose (f);
+}
+
+int
+main (int argc, char **argv)
+{
+	IdleParser *parser;
+	GString *chunk = g_string_new (NULL);
+	guint iterations = DEFAULT_ITERATIONS;
+	guint split_count = 0;
+	gulong id;
+	gdouble with_handler, without_handler;
+
+	g_type_init ();
+
+	if (argc > 1)
+		iterations = strtoul (argv[1], NULL, 10);
+
+	for (guint i = 0; i < LINES_PER_CHUNK; i++)
+		g_string_append (chunk, line);
+
+	parser = g_object_new (IDLE_TYPE_PARSER, NULL);
+
+	/* warm up */
+	_time_per_line (parser, chunk->str, iterations / 10 + 1);
+
+	/* every line used to go through signal emission like this */
+	id = g_signal_connect (parser, "msg-split", G_CALLBACK (_msg_split_cb), &split_count);
+	with_handler = _time_per_line (parser, chunk->str, iterations);
+	g_signal_handler_disconnect (parser, id);
+
+	without_handler = _time_per_line (parser, chunk->str, iterations);
+
+	printf ("msg-split handler connected: %.1f ns/line\n", with_handler);
+	printf ("no msg-split handler:        %.1f ns/line\n", without_handler);
+	_report_metric ("parser-ns-per-line", without_handler);
+
+	g_object_unref (parser);
+	g_string_free (chunk, TRUE);
+
+	return split_count == iterations * LINES_PER_CHUNK ? 0 : 1;
+}
@@ -13,6 +13,8 @@ main (void)
 	const gchar *test_strings[] = {
 		"foobar", "foobar",
 		"foo \x03\x31\x33<3", "foo <3",
+		"\x02" "bold\x0f and \x03" "4,12colour\x03", "bold and colour",
+		"\x1d\x1f", "",
 		NULL, NULL
 	};
 
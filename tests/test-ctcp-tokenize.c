@@ -24,6 +24,17 @@ main (void)
 		}
 	}
 
+	g_strfreev(tokens);
+
+	/* A backslash at the very end escapes nothing */
+	tokens = idle_ctcp_decode("\001PING 123\\");
+	if (tokens == NULL || tp_strdiff(tokens[0], "PING") || tp_strdiff(tokens[1], "123") || tokens[2] != NULL) {
+		fprintf(stderr, "Trailing backslash mangled the tokens\n");
+		fail = TRUE;
+	}
+
+	g_strfreev(tokens);
+
 	if (fail)
 		return 1;
 	else
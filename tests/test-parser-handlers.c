@@ -0,0 +1,264 @@
+#include "config.h"
+
+#include <stdio.h>
+
+#include <idle-parser.h>
+
+/* PING and ERROR name no contacts or rooms, so the parser can dispatch them
+ * without a connection to look up handles. */
+#define PING_LINE "PING :idle.test.server\r\n"
+#define ERROR_LINE "ERROR :Closing Link\r\n"
+
+static gboolean failed = FALSE;
+
+#define check(cond, message, ...) \
+  G_STMT_START \
+    { \
+      if (!(cond)) \
+        { \
+          fprintf (stderr, "%s: " message "\n", G_STRFUNC, ##__VA_ARGS__); \
+          failed = TRUE; \
+        } \
+    } \
+  G_STMT_END
+
+static IdleParserHandlerResult
+count_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  guint *calls = user_data;
+
+  (*calls)++;
+
+  return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+static IdleParserHandlerResult
+once_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  guint *calls = user_data;
+
+  (*calls)++;
+
+  return IDLE_PARSER_HANDLER_RESULT_NO_MORE_PLEASE;
+}
+
+static void
+test_remove (void)
+{
+  IdleParser *parser = g_object_new (IDLE_TYPE_PARSER, NULL);
+  guint calls = 0, once_calls = 0;
+  guint id;
+
+  id = idle_parser_add_handler (parser, IDLE_PARSER_CMD_PING, count_cb,
+      &calls);
+  idle_parser_add_handler (parser, IDLE_PARSER_CMD_PING, once_cb,
+      &once_calls);
+  check (id != 0, "no ID for a new handler");
+
+  idle_parser_receive (parser, PING_LINE);
+  check (calls == 1, "handler called %u times for one PING", calls);
+
+  idle_parser_remove_handler (parser, id);
+  idle_parser_receive (parser, PING_LINE);
+  check (calls == 1, "removed handler called again");
+  check (once_calls == 1, "handler asking to be removed called %u times",
+      once_calls);
+
+  /* an ID which has already gone, or never was, is ignored */
+  idle_parser_remove_handler (parser, id);
+  idle_parser_remove_handler (parser, id + 100);
+
+  g_object_unref (parser);
+}
+
+typedef struct {
+  IdleParser *parser;
+  guint first_id;
+  guint first_calls;
+  guint second_calls;
+  guint error_calls;
+} Owner;
+
+/* Removes itself, and then everything else its owner has */
+static IdleParserHandlerResult
+remove_all_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  Owner *owner = user_data;
+
+  owner->first_calls++;
+  idle_parser_remove_handler (parser, owner->first_id);
+  idle_parser_remove_handlers_by_data (parser, owner);
+
+  return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+static IdleParserHandlerResult
+second_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  Owner *owner = user_data;
+
+  owner->second_calls++;
+
+  return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+static IdleParserHandlerResult
+error_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  Owner *owner = user_data;
+
+  owner->error_calls++;
+
+  return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+static void
+test_remove_while_dispatching (void)
+{
+  IdleParser *parser = g_object_new (IDLE_TYPE_PARSER, NULL);
+  Owner owner = { parser, 0, };
+  guint bystander_calls = 0;
+
+  owner.first_id = idle_parser_add_handler_with_priority (parser,
+      IDLE_PARSER_CMD_PING, remove_all_cb, &owner,
+      IDLE_PARSER_HANDLER_PRIORITY_FIRST);
+  idle_parser_add_handler (parser, IDLE_PARSER_CMD_PING, second_cb, &owner);
+  idle_parser_add_handler (parser, IDLE_PARSER_CMD_ERROR, error_cb, &owner);
+  idle_parser_add_handler_with_priority (parser, IDLE_PARSER_CMD_PING,
+      count_cb, &bystander_calls, IDLE_PARSER_HANDLER_PRIORITY_LAST);
+
+  idle_parser_receive (parser, PING_LINE);
+  check (owner.first_calls == 1, "first handler called %u times",
+      owner.first_calls);
+  check (owner.second_calls == 0,
+      "handler removed earlier in the dispatch was still called");
+  check (bystander_calls == 1,
+      "somebody else's handler called %u times", bystander_calls);
+
+  idle_parser_receive (parser, PING_LINE);
+  idle_parser_receive (parser, ERROR_LINE);
+  check (owner.first_calls == 1 && owner.second_calls == 0 &&
+      owner.error_calls == 0, "removed handlers called afterwards");
+  check (bystander_calls == 2,
+      "somebody else's handler lost after the dispatch");
+
+  g_object_unref (parser);
+}
+
+typedef struct {
+  IdleParser *parser;
+  guint adder_calls;
+  guint added_calls;
+  guint dropped_calls;
+} Adder;
+
+static IdleParserHandlerResult
+added_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  Adder *adder = user_data;
+
+  adder->added_calls++;
+
+  return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+static IdleParserHandlerResult
+dropped_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  Adder *adder = user_data;
+
+  adder->dropped_calls++;
+
+  return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+/* The first time, adds a handler after itself, and another which it takes
+ * away again straight away */
+static IdleParserHandlerResult
+adder_cb (IdleParser *parser,
+    IdleParserMessageCode code,
+    GValueArray *args,
+    gpointer user_data)
+{
+  Adder *adder = user_data;
+
+  if (adder->adder_calls++ == 0)
+    {
+      guint id;
+
+      idle_parser_add_handler_with_priority (parser, IDLE_PARSER_CMD_PING,
+          added_cb, adder, IDLE_PARSER_HANDLER_PRIORITY_LAST);
+      id = idle_parser_add_handler (parser, IDLE_PARSER_CMD_PING, dropped_cb,
+          adder);
+      idle_parser_remove_handler (parser, id);
+    }
+
+  return IDLE_PARSER_HANDLER_RESULT_NOT_HANDLED;
+}
+
+static void
+test_add_while_dispatching (void)
+{
+  IdleParser *parser = g_object_new (IDLE_TYPE_PARSER, NULL);
+  Adder adder = { parser, 0, };
+
+  idle_parser_add_handler_with_priority (parser, IDLE_PARSER_CMD_PING,
+      adder_cb, &adder, IDLE_PARSER_HANDLER_PRIORITY_FIRST);
+
+  idle_parser_receive (parser, PING_LINE);
+  check (adder.adder_calls == 1, "adding handler called %u times",
+      adder.adder_calls);
+  check (adder.added_calls == 0,
+      "handler added during a dispatch was called in it");
+
+  idle_parser_receive (parser, PING_LINE);
+  check (adder.adder_calls == 2, "adding handler called %u times",
+      adder.adder_calls);
+  check (adder.added_calls == 1,
+      "handler added during a dispatch called %u times by the next",
+      adder.added_calls);
+  check (adder.dropped_calls == 0,
+      "handler added and removed during a dispatch was called");
+
+  g_object_unref (parser);
+}
+
+int
+main (int argc,
+      char **argv)
+{
+  g_type_init ();
+
+  test_remove ();
+  test_remove_while_dispatching ();
+  test_add_while_dispatching ();
+
+  if (failed)
+    {
+      fprintf (stderr, "  :'(\n");
+      return 1;
+    }
+
+  return 0;
+}
@@ -16,18 +16,30 @@
       if (i >= 0) \
         fprintf (stderr, "- line #%d: %s\n", i, g_strescape (line, "")); \
       fprintf (stderr, "- type: %d\n", type); \
+      fprintf (stderr, "- charset: %s\n", charset ? charset : "UTF-8"); \
       return FALSE; \
     } \
   G_STMT_END
 
+static void
+collect (const gchar *line,
+    gsize len,
+    gpointer user_data)
+{
+  GPtrArray *lines = user_data;
+
+  g_ptr_array_add (lines, g_strndup (line, len));
+}
+
 
 static gboolean
 test (TpChannelTextMessageType type,
-      gchar *msg)
+      gchar *msg,
+      const gchar *charset,
+      guint min_lines)
 {
   gchar *recipient = "ircuser";
-  gchar **bodies;
-  gchar **output = idle_text_encode_and_split (type, recipient, msg, 510, &bodies, NULL);
+  GPtrArray *output = g_ptr_array_new_with_free_func (g_free);
   GString *reconstituted_msg = g_string_sized_new (strlen (msg));
   int i = -1;
   char *line = NULL, *c = NULL;
@@ -50,21 +62,53 @@ test (TpChannelTextMessageType type,
     "",
   };
 
-  if (output == NULL)
+  if (!idle_text_encode_and_split (type, recipient, msg, 510, charset,
+          collect, output, NULL))
     {
-      fail ("total reality failure, idle_text_encode_and_split returned NULL");
+      fail ("total reality failure, idle_text_encode_and_split returned FALSE");
     }
 
-  for (i = 0; output[i] != NULL; i++)
+  if (output->len < min_lines)
     {
-      line = output[i];
-      c = line;
+      fail ("message split into %u lines, expected at least %u", output->len,
+          min_lines);
+    }
+
+  for (i = 0; i < (int) output->len; i++)
+    {
+      gchar *body, *converted = NULL;
 
-      if (strlen (line) > IRC_MSG_MAXLEN)
+      line = g_ptr_array_index (output, i);
+
+      if (strlen (line) > IRC_MSG_MAXLEN + 2)
         {
           fail ("resulting line longer than maximum length %d", IRC_MSG_MAXLEN);
         }
 
+      if (!g_str_has_suffix (line, "\r\n"))
+        {
+          fail ("resulting line doesn't end with <CR><LF>");
+        }
+
+      line[strlen (line) - 2] = '\0';
+
+      /* each line has to decode on its own: a stateful charset must be back
+       * in its initial state by the end of every line */
+      if (charset != NULL)
+        {
+          converted = g_convert (line, -1, "UTF-8", charset, NULL, NULL,
+              NULL);
+
+          if (converted == NULL)
+            {
+              fail ("resulting line isn't valid %s by itself", charset);
+            }
+
+          line = converted;
+        }
+
+      c = line;
+
       if (!g_str_has_prefix (c, expected_prefixes[type]))
         {
           fail ("resulting line missing prefix '%s'",
@@ -91,13 +135,19 @@ test (TpChannelTextMessageType type,
               g_strescape (expected_suffixes[type], ""));
         }
 
-      if (strncmp (c, bodies[i], strlen (c) - strlen (expected_suffixes[type])))
+      body = g_strndup (c, strlen (c) - strlen (expected_suffixes[type]));
+
+      /* none of the words in these messages are long enough to have to be
+       * split */
+      if (i + 1 < (int) output->len && strchr (msg, '\n') == NULL &&
+          strchr (msg, ' ') != NULL && !g_str_has_suffix (body, " "))
         {
-          fail ("body of '%s' doesn't match alleged body '%s'", c, bodies[i]);
+          fail ("line was split in the middle of a word");
         }
 
-      g_string_append_len (reconstituted_msg, c,
-          strlen (c) - strlen (expected_suffixes[type]));
+      g_string_append (reconstituted_msg, body);
+      g_free (body);
+      g_free (converted);
     }
 
   i = -1;
@@ -117,8 +167,12 @@ test (TpChannelTextMessageType type,
               "- result: \"%s\"\n- msg sans newlines: \"%s\"",
               reconstituted_msg->str, newlineless);
       }
+
+    g_free (newlineless);
   }
 
+  g_string_free (reconstituted_msg, TRUE);
+  g_ptr_array_unref (output);
   return TRUE;
 }
 
@@ -132,22 +186,49 @@ main (int argc,
       "This message\ncontains newlines.",
       "one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen seventeen eighteen nineteen twenty twenty-one twenty-two twenty-three twenty-four twenty-five twenty-six twenty-seven twenty-eight twenty-nine thirty thirty-one thirty-two thirty-three thirty-four thirty-five thirty-six thirty-seven thirty-eight thirty-nine forty forty-one forty-two forty-three forty-four forty-five forty-six forty-seven forty-eight forty-nine fifty fifty-one fifty-two fifty-three fifty-four fifty-five fifty-six fifty-seven fifty-eight fifty-nine sixty sixty-one sixty-two sixty-three sixty-four sixty-five sixty-six sixty-seven sixty-eight sixty-nine",
       "one two three four\nfive six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen seventeen eighteen nineteen twenty twenty-one twenty-two twenty-three twenty-four twenty-five twenty-six twenty-seven twenty-eight twenty-nine thirty thirty-one thirty-two thirty-three thirty-four thirty-five thirty-six thirty-seven thirty-eight thirty-nine forty forty-one forty-two forty-three forty-four forty-five forty-six forty-seven forty-eight forty-nine fifty fifty-one fifty-two fifty-three fifty-four fifty-five fifty-six fifty-seven fifty-eight fifty-nine sixty sixty-one sixty-two sixty-three sixty-four sixty-five sixty-six sixty-seven sixty-eight sixty-nine",
+      "Qu'est-ce que c'est que ça ? Éléphant, çà et là, à côté des théières. Qu'est-ce que c'est que ça ? Éléphant, çà et là, à côté des théières. Qu'est-ce que c'est que ça ? Éléphant, çà et là, à côté des théières. Qu'est-ce que c'est que ça ? Éléphant, çà et là, à côté des théières. Qu'est-ce que c'est que ça ? Éléphant, çà et là, à côté des théières. Qu'est-ce que c'est que ça ? Éléphant, çà et là, à côté des théières.",
+      "ééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééééé",
       NULL
   };
+  const gchar *charsets[] = { NULL, "ISO-8859-1" };
+  /* Latin-1 has no kanji, so this one is only tried in UTF-8 and in a
+   * stateful encoding, which has to shift back to ASCII at the end of each
+   * of the lines it is split into */
+  const gchar *cjk_charsets[] = { NULL, "ISO-2022-JP" };
+  GString *cjk_msg = g_string_new (NULL);
   gboolean sad_face = FALSE;
 
+  for (guint n = 0; n < 40; n++)
+    g_string_append (cjk_msg, "日本語のテキスト ");
+
   for (int i = 0; msgs[i] != NULL; i++)
     {
       for (TpChannelTextMessageType j = TP_CHANNEL_TEXT_MESSAGE_TYPE_NORMAL;
            j <= TP_CHANNEL_TEXT_MESSAGE_TYPE_NOTICE;
            j++)
         {
-          gboolean yay = test(j, msgs[i]);
-          if (!yay)
+          for (guint k = 0; k < G_N_ELEMENTS (charsets); k++)
+            {
+              gboolean yay = test(j, msgs[i], charsets[k], 1);
+              if (!yay)
+                sad_face = TRUE;
+            }
+        }
+    }
+
+  for (TpChannelTextMessageType j = TP_CHANNEL_TEXT_MESSAGE_TYPE_NORMAL;
+       j <= TP_CHANNEL_TEXT_MESSAGE_TYPE_NOTICE;
+       j++)
+    {
+      for (guint k = 0; k < G_N_ELEMENTS (cjk_charsets); k++)
+        {
+          if (!test (j, cjk_msg->str, cjk_charsets[k], 2))
             sad_face = TRUE;
         }
     }
 
+  g_string_free (cjk_msg, TRUE);
+
   if (sad_face)
     {
       fprintf (stderr, "  :'(\n");
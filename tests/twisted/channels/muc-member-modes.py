@@ -0,0 +1,70 @@
+"""
+Test that a MODE line touching several members changes our own flags once, and
+that our privileges follow us when we change nick.
+"""
+
+from idletest import exec_test, sync_stream
+from servicetest import EventPattern, call_async
+import constants as cs
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#test'})
+
+    q.expect_many(EventPattern('dbus-return', method='CreateChannel'),
+                  EventPattern('dbus-signal', signal='MembersChanged'))
+
+    stream.sendMessage('JOIN', '#test', prefix='alice')
+    q.expect('dbus-signal', signal='MembersChanged')
+
+    # we end up opped, however much churn the line carries on the way
+    stream.sendMessage('MODE', '#test', '+oo-o+ov', 'test', 'alice', 'test',
+                       'test', 'alice', prefix='ChanServ')
+    q.expect('dbus-signal', signal='GroupFlagsChanged',
+             args=[cs.GF_MESSAGE_REMOVE | cs.GF_CAN_REMOVE, 0])
+
+    forbidden = [EventPattern('dbus-signal', signal='GroupFlagsChanged')]
+    q.forbid_events(forbidden)
+    sync_stream(q, stream)
+
+    # other members' privileges do not touch ours
+    stream.sendMessage('MODE', '#test', '-ov', 'alice', 'alice',
+                       prefix='ChanServ')
+    sync_stream(q, stream)
+
+    # a line that takes ops away and hands them back is a no-op for us
+    stream.sendMessage('MODE', '#test', '-o+o', 'test', 'test',
+                       prefix='ChanServ')
+    sync_stream(q, stream)
+    q.unforbid_events(forbidden)
+
+    stream.sendMessage('MODE', '#test', '-o', 'test', prefix='ChanServ')
+    q.expect('dbus-signal', signal='GroupFlagsChanged',
+             args=[0, cs.GF_MESSAGE_REMOVE | cs.GF_CAN_REMOVE])
+
+    stream.sendMessage('MODE', '#test', '+o', 'test', prefix='ChanServ')
+    q.expect('dbus-signal', signal='GroupFlagsChanged',
+             args=[cs.GF_MESSAGE_REMOVE | cs.GF_CAN_REMOVE, 0])
+
+    # changing nick leaves us opped...
+    q.forbid_events(forbidden)
+    stream.sendMessage('NICK', ':newtest', prefix='test')
+    q.expect('dbus-signal', signal='MembersChanged')
+    sync_stream(q, stream)
+    q.unforbid_events(forbidden)
+
+    # ...so taking ops from our new nick is what takes them from us
+    stream.sendMessage('MODE', '#test', '-o', 'newtest', prefix='ChanServ')
+    q.expect('dbus-signal', signal='GroupFlagsChanged',
+             args=[0, cs.GF_MESSAGE_REMOVE | cs.GF_CAN_REMOVE])
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test)
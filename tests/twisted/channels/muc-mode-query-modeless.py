@@ -0,0 +1,50 @@
+"""
+Test that no MODE query is sent after joining on a server whose ISUPPORT
+CHANMODES lists no channel modes at all.
+"""
+
+from idletest import exec_test, sync_stream, BaseIRCServer
+from servicetest import EventPattern, call_async, assertEquals
+import constants as cs
+
+class ModelessServer(BaseIRCServer):
+    def sendWelcome(self):
+        BaseIRCServer.sendWelcome(self)
+        self.sendMessage('005', self.nick, 'CHANMODES=,,,', 'WHOX',
+            ':are supported by this server', prefix='idle.test.server')
+
+    def handleWHO(self, args, prefix):
+        self.sendMessage('315', self.nick, args[0], ':End of /WHO list.',
+            prefix='idle.test.server')
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    forbidden = [EventPattern('stream-MODE')]
+    q.forbid_events(forbidden)
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#modeless'})
+    ret, _ = q.expect_many(EventPattern('dbus-return', method='CreateChannel'),
+        EventPattern('dbus-signal', signal='MembersChanged'))
+    chan = bus.get_object(conn.bus_name, ret.value[0])
+
+    assertEquals(True, chan.Get(cs.CHANNEL_IFACE_ROOM_CONFIG,
+        'ConfigurationRetrieved', dbus_interface=cs.PROPERTIES_IFACE))
+
+    # the WHO for the channel's members goes out once the join burst is over,
+    # along with any MODE query
+    q.expect('stream-WHO', predicate=lambda e: e.data[0] == '#modeless')
+    sync_stream(q, stream)
+    q.unforbid_events(forbidden)
+
+    call_async(q, conn, 'Disconnect')
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_DISCONNECTED, cs.CSR_REQUESTED])
+
+if __name__ == '__main__':
+    exec_test(test, protocol=ModelessServer)
@@ -0,0 +1,66 @@
+"""
+Test that the MODE query after joining waits for the join burst, and is not
+sent at all when the server volunteers the channel modes first, or when the
+channel is a '+' channel, whose modes are fixed.
+"""
+
+from idletest import exec_test, sync_stream, BaseIRCServer
+from servicetest import EventPattern, call_async, assertEquals
+import constants as cs
+
+class PlusChannelServer(BaseIRCServer):
+    def sendWelcome(self):
+        BaseIRCServer.sendWelcome(self)
+        self.sendMessage('005', self.nick, 'CHANTYPES=#+',
+            ':are supported by this server', prefix='idle.test.server')
+
+def join(q, bus, conn, room):
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: room})
+
+    ret, _ = q.expect_many(EventPattern('dbus-return', method='CreateChannel'),
+                  EventPattern('dbus-signal', signal='MembersChanged'))
+
+    return bus.get_object(conn.bus_name, ret.value[0])
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    forbidden = [EventPattern('stream-MODE')]
+    q.forbid_events(forbidden)
+
+    join(q, bus, conn, '#first')
+    join(q, bus, conn, '#second')
+    plus = join(q, bus, conn, '+plus')
+
+    # there is nothing to ask about the '+' channel's modes
+    assertEquals(True, plus.Get(cs.CHANNEL_IFACE_ROOM_CONFIG,
+        'ConfigurationRetrieved', dbus_interface=cs.PROPERTIES_IFACE))
+
+    # the server tells us about #second on its own; answering our PING
+    # shows we have read all of that without asking about either channel
+    stream.sendMessage('324', stream.nick, '#second', '+nt',
+                       prefix='idle.test.server')
+    sync_stream(q, stream)
+    q.unforbid_events(forbidden)
+
+    # Once the join burst is over, we ask about #first. A query for #second
+    # or +plus would be sent along with it, so it would have turned up by the
+    # time the server's next PING is answered.
+    forbidden = [EventPattern('stream-MODE', data=['#second']),
+                 EventPattern('stream-MODE', data=['+plus'])]
+    q.forbid_events(forbidden)
+    q.expect('stream-MODE', data=['#first'])
+    sync_stream(q, stream)
+    q.unforbid_events(forbidden)
+
+    call_async(q, conn, 'Disconnect')
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_DISCONNECTED, cs.CSR_REQUESTED])
+
+if __name__ == '__main__':
+    exec_test(test, protocol=PlusChannelServer)
@@ -0,0 +1,55 @@
+"""
+Test that a busy channel survives a large join, a MODE burst, a netsplit and a
+message storm, all generated by the fake server.
+"""
+
+from idletest import (exec_test, sync_stream, expect_members, member_nicks,
+    BaseIRCServer)
+from servicetest import call_async, assertEquals
+import constants as cs
+
+MEMBERS = member_nicks(2000)
+SPLIT = MEMBERS[:500]
+MESSAGES = 200
+
+class BusyServer(BaseIRCServer):
+    def handleJOIN(self, args, prefix):
+        room = args[0]
+        self.rooms.append(room)
+        self.sendTraffic(self.joinTraffic(room, MEMBERS))
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#busy'})
+
+    q.expect('dbus-return', method='CreateChannel')
+    assertEquals(len(MEMBERS) + 1, len(expect_members(q, len(MEMBERS) + 1)))
+
+    # we are opped somewhere in the middle of the burst
+    opped = MEMBERS[:50] + [stream.nick] + MEMBERS[50:100]
+    stream.sendTraffic(stream.modeBurstTraffic('#busy', opped))
+    q.expect('dbus-signal', signal='GroupFlagsChanged',
+        args=[cs.GF_MESSAGE_REMOVE | cs.GF_CAN_REMOVE, 0])
+    sync_stream(q, stream)
+
+    stream.sendTraffic(stream.netsplitTraffic(SPLIT))
+    removed = 0
+    while removed < len(SPLIT):
+        e = q.expect('dbus-signal', signal='MembersChanged')
+        removed += len(e.args[2])
+    assertEquals(len(SPLIT), removed)
+
+    stream.sendTraffic(stream.privmsgTraffic('#busy', MESSAGES,
+        senders=MEMBERS[len(SPLIT):]), rate=2000, lines_per_write=50)
+    for i in xrange(MESSAGES):
+        e = q.expect('dbus-signal', signal='Received')
+        assertEquals('message %d' % i, e.args[5])
+
+if __name__ == '__main__':
+    exec_test(test, protocol=BusyServer)
@@ -0,0 +1,63 @@
+"""
+Test listing a server with a great many rooms, generated by the fake server's
+LIST traffic.
+"""
+
+from idletest import exec_test, BaseIRCServer
+from servicetest import EventPattern, call_async, assertEquals
+import dbus
+import constants as cs
+
+NUM_ROOMS = 2000
+USERS = 7
+
+class ManyRoomsServer(BaseIRCServer):
+    def handleLIST(self, args, prefix):
+        self.sendTraffic(self.listTraffic(NUM_ROOMS, users=USERS))
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        { cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_ROOM_LIST })
+    ret = q.expect('dbus-return', method='CreateChannel')
+    path, _ = ret.value
+
+    chan = bus.get_object(conn.bus_name, path)
+    list_chan = dbus.Interface(chan, cs.CHANNEL_TYPE_ROOM_LIST)
+    call_async(q, list_chan, 'ListRooms')
+    q.expect_many(
+        EventPattern('stream-LIST'),
+        EventPattern('dbus-signal', signal='ListingRooms', args=[True]))
+
+    # the rooms may come in any number of batches, but all of them before the
+    # listing is over
+    rooms = {}
+    while True:
+        e = q.expect('dbus-signal', predicate=lambda e:
+            e.signal == 'GotRooms' or
+            (e.signal == 'ListingRooms' and e.args == [False]))
+
+        if e.signal == 'ListingRooms':
+            break
+
+        for (_, channel_type, info) in e.args[0]:
+            assertEquals(cs.CHANNEL_TYPE_TEXT, channel_type)
+            assert info['name'] not in rooms, info['name']
+            rooms[info['name']] = info
+
+    assertEquals(NUM_ROOMS, len(rooms))
+
+    for i in xrange(NUM_ROOMS):
+        info = rooms['#room%d' % i]
+        assertEquals(USERS, info['members'])
+        assertEquals('topic of room %d' % i, info['subject'])
+
+    call_async(q, conn, 'Disconnect')
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_DISCONNECTED, cs.CSR_REQUESTED])
+
+if __name__ == '__main__':
+    exec_test(test, protocol=ManyRoomsServer)
@@ -0,0 +1,48 @@
+
+"""
+Test that a certificate accepted once is not asked about again when
+reconnecting to the same server.
+"""
+
+import dbus
+import constants as cs
+from idletest import exec_tests, SSLIRCServer
+from servicetest import EventPattern, call_async
+
+def connect_and_disconnect(q, conn):
+    q.expect('dbus-signal', signal='StatusChanged', args=[0, 1])
+    call_async(q, conn, 'Disconnect')
+    q.expect_many(
+            EventPattern('dbus-signal', signal='StatusChanged', args=[2, 1]),
+            EventPattern('irc-disconnected'),
+            EventPattern('dbus-return', method='Disconnect'))
+
+def test_accept(q, bus, conn, stream):
+    conn.Connect()
+    q.expect_many(
+            EventPattern('dbus-signal', signal='StatusChanged', args=[1, 1]),
+            EventPattern('irc-connected'))
+    e = q.expect('dbus-signal', signal='NewChannels')
+    channels = e.args[0]
+    path, props = channels[0]
+
+    cert = bus.get_object (conn.bus_name, props[cs.TLS_CERT_PATH])
+    cert.Accept()
+
+    connect_and_disconnect(q, conn)
+
+def test_reconnect(q, bus, conn, stream):
+    new_channels = [EventPattern('dbus-signal', signal='NewChannels')]
+    q.forbid_events(new_channels)
+
+    conn.Connect()
+    q.expect_many(
+            EventPattern('dbus-signal', signal='StatusChanged', args=[1, 1]),
+            EventPattern('irc-connected'))
+    connect_and_disconnect(q, conn)
+
+    q.unforbid_events(new_channels)
+
+if __name__ == '__main__':
+    exec_tests([test_accept, test_reconnect], {'use-ssl':dbus.Boolean(True)},
+        protocol=SSLIRCServer)
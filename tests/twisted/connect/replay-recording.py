@@ -0,0 +1,41 @@
+"""
+Test that a traffic recording can be played back to Idle.
+"""
+
+import os
+import tempfile
+
+from idletest import exec_test
+from servicetest import EventPattern, assertEquals
+from replay import read_log, write_log, replay_server, RECEIVED, SENT
+import constants as cs
+
+RECORDING = [
+    (SENT, 0, 'NICK test\r\nUSER testuser 0 * :Test User\r\n'),
+    (RECEIVED, 0.05,
+        ':idle.test.server 001 test :Welcome to the test IRC Network\r\n'
+        ':alice!alice@wonder.land PRIVMSG test :hello'),
+    # a line split across two reads
+    (RECEIVED, 0.001, ' there\r\n'),
+    ]
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    e = q.expect('dbus-signal', signal='Received')
+    assertEquals('hello there', e.args[5])
+
+if __name__ == '__main__':
+    (fd, filename) = tempfile.mkstemp(suffix='.irclog')
+    os.close(fd)
+
+    try:
+        write_log(filename, RECORDING)
+        assertEquals(RECORDING, [(direction, round(delay, 3), chunk)
+            for (direction, delay, chunk) in read_log(filename)])
+
+        exec_test(test, protocol=replay_server(filename, speed=0))
+    finally:
+        os.unlink(filename)
@@ -0,0 +1,68 @@
+"""
+Test that with IDLE_RECORD_TRAFFIC set, Idle records its traffic in a form
+replay.py can read back, in a file nobody else can read.
+"""
+
+import glob
+import os
+import shutil
+import stat
+import tempfile
+
+import dbus
+
+from idletest import exec_test
+from servicetest import call_async, assertEquals, assertLength
+from replay import read_log, RECEIVED, SENT
+import constants as cs
+
+def test(q, bus, conn, stream, directory):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    stream.sendMessage('PRIVMSG', stream.nick, ':hello', prefix='alice')
+    q.expect('dbus-signal', signal='Received')
+
+    # the recording is complete once the connection to the server is closed
+    call_async(q, conn, 'Disconnect')
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_DISCONNECTED, cs.CSR_REQUESTED])
+
+    recordings = glob.glob(os.path.join(directory, 'idle-*.irclog'))
+    assertLength(1, recordings)
+
+    # it has the password in it, so only we may read it
+    mode = os.stat(recordings[0]).st_mode
+    assertEquals(0, mode & (stat.S_IRWXG | stat.S_IRWXO))
+
+    records = list(read_log(recordings[0]))
+    assert records
+    for (direction, delay, chunk) in records:
+        assert direction in (RECEIVED, SENT), direction
+        assert delay >= 0, delay
+        assert chunk
+
+    sent = ''.join(chunk for (direction, _, chunk) in records
+        if direction == SENT)
+    received = ''.join(chunk for (direction, _, chunk) in records
+        if direction == RECEIVED)
+
+    assert ('NICK %s\r\n' % stream.nick) in sent, sent
+    assert ('PRIVMSG %s :hello\r\n' % stream.nick) in received, received
+    assert 'QUIT' in sent, sent
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    try:
+        # Idle is started by the bus, so that is where the variable has to go
+        bus = dbus.SessionBus()
+        dbus.Interface(bus.get_object('org.freedesktop.DBus',
+                '/org/freedesktop/DBus'), 'org.freedesktop.DBus') \
+            .UpdateActivationEnvironment({'IDLE_RECORD_TRAFFIC': directory})
+
+        exec_test(lambda q, bus, conn, stream:
+            test(q, bus, conn, stream, directory))
+    finally:
+        shutil.rmtree(directory)
@@ -5,12 +5,13 @@ Infrastructure code for testing Idle by pretending to be an IRC server.
 
 import os
 import sys
+import itertools
 import dbus
 import servicetest
 from servicetest import (unwrap, Event)
 import twisted
 from twisted.words.protocols import irc
-from twisted.internet import reactor, ssl
+from twisted.internet import reactor, ssl, defer
 
 def make_irc_event(type, data):
     if data:
@@ -26,6 +27,21 @@ def make_disconnected_event():
     event = make_irc_event('irc-disconnected', None)
     return event
 
+def make_line(command, *parameters, **kw):
+    """Format a raw IRC line the way irc.IRC.sendMessage does, without the
+    trailing CRLF."""
+    line = ' '.join([command] + list(parameters))
+    prefix = kw.get('prefix')
+    if prefix:
+        line = ':%s %s' % (prefix, line)
+    return line
+
+def member_nicks(n, template='member%d'):
+    return [template % i for i in xrange(n)]
+
+def _hostmask(nick):
+    return '%s!%s@%s.test.client' % (nick, nick, nick)
+
 class BaseIRCServer(irc.IRC):
     verbose = (os.environ.get('CHECK_TWISTED_VERBOSE', '') != '' or '-v' in sys.argv)
 
@@ -141,6 +157,80 @@ class BaseIRCServer(irc.IRC):
     def sendWelcome(self):
         self.sendMessage('001', self.nick, ':Welcome to the test IRC Network', prefix='idle.test.server')
 
+    # Traffic generators: each of these yields raw lines, to be fed to
+    # sendTraffic() on their own or chained together, so tests can put Idle
+    # under realistic load.
+
+    def namesTraffic(self, room, members, names_per_line=40):
+        for i in xrange(0, len(members), names_per_line):
+            yield make_line('353', self.nick, '=', room,
+                ':%s' % ' '.join(members[i:i + names_per_line]),
+                prefix='idle.test.server')
+        yield make_line('366', self.nick, room, ':End of /NAMES list',
+            prefix='idle.test.server')
+
+    def joinTraffic(self, room, members):
+        yield make_line('JOIN', room, prefix=self.nick)
+        for line in self.namesTraffic(room, members + [self.nick]):
+            yield line
+
+    def modeBurstTraffic(self, room, nicks, flag='+o', modes_per_line=4,
+            setter='ChanServ'):
+        (sign, mode) = (flag[0], flag[1:])
+        for i in xrange(0, len(nicks), modes_per_line):
+            targets = nicks[i:i + modes_per_line]
+            yield make_line('MODE', room,
+                sign + mode * len(targets), *targets, prefix=setter)
+
+    def netsplitTraffic(self, nicks,
+            servers='irc.left.test.server irc.right.test.server'):
+        for nick in nicks:
+            yield make_line('QUIT', ':%s' % servers, prefix=_hostmask(nick))
+
+    def listTraffic(self, n, users=5, template='#room%d'):
+        yield make_line('321', self.nick, 'Channel', ':Users  Name',
+            prefix='idle.test.server')
+        for i in xrange(n):
+            yield make_line('322', self.nick, template % i, str(users),
+                ':topic of room %d' % i, prefix='idle.test.server')
+        yield make_line('323', self.nick, ':End of /LIST',
+            prefix='idle.test.server')
+
+    def privmsgTraffic(self, target, count, senders=('alice',),
+            text='message %d'):
+        for i in xrange(count):
+            yield make_line('PRIVMSG', target, ':' + (text % i),
+                prefix=_hostmask(senders[i % len(senders)]))
+
+    def sendTraffic(self, lines, rate=None, lines_per_write=500):
+        """Send raw lines, coalescing lines_per_write of them into each
+        write. If rate is given (in lines per second) the writes are paced to
+        match it, otherwise everything is written at once.
+
+        Returns a Deferred which fires with the number of lines sent."""
+        lines = iter(lines)
+        d = defer.Deferred()
+        sent = [0]
+
+        def write():
+            while True:
+                batch = list(itertools.islice(lines, lines_per_write))
+
+                if batch:
+                    self.transport.write('\r\n'.join(batch) + '\r\n')
+                    sent[0] += len(batch)
+
+                if len(batch) < lines_per_write:
+                    d.callback(sent[0])
+                    return
+
+                if rate is not None:
+                    reactor.callLater(float(lines_per_write) / rate, write)
+                    return
+
+        write()
+        return d
+
     def handleCommand(self, command, prefix, params):
         self.event_func(make_irc_event('stream-%s' % command, params))
         try:
@@ -168,6 +258,16 @@ def sync_stream(q, stream):
     stream.sendMessage('PING', 'sup')
     q.expect('stream-PONG')
 
+def expect_members(q, n):
+    """Waits for MembersChanged signals to add n members between them, as a
+    join does over several: our own, then the NAMES reply's. Returns the
+    handles added."""
+    added = set()
+    while len(added) < n:
+        e = q.expect('dbus-signal', signal='MembersChanged')
+        added.update(e.args[1])
+    return added
+
 def install_colourer():
     def red(s):
         return '\x1b[31m%s\x1b[0m' % s
@@ -192,7 +292,7 @@ def install_colourer():
     sys.stdout = Colourer(sys.stdout, patterns)
     return sys.stdout
 
-def start_server(event_func, protocol=None, port=6900):
+def start_server(event_func, protocol=None, port=0):
     # set up IRC server
 
     if protocol is None:
@@ -204,7 +304,7 @@ def start_server(event_func, protocol=None, port=6900):
     port = server.listen(port, factory)
     return (server, port)
 
-def make_connection(bus, event_func, params=None):
+def make_connection(bus, event_func, params=None, port=6900):
     default_params = {
         'account': 'test',
         'server': '127.0.0.1',
@@ -214,7 +314,7 @@ def make_connection(bus, event_func, params=None):
         'charset': 'UTF-8',
         'quit-message': 'happy testing...',
         'use-ssl': dbus.Boolean(False),
-        'port': dbus.UInt32(6900),
+        'port': dbus.UInt32(port),
         'keepalive-interval': dbus.UInt32(0),
         }
 
@@ -224,6 +324,48 @@ def make_connection(bus, event_func, params=None):
     return servicetest.make_connection(bus, event_func, 'idle', 'irc',
         default_params)
 
+def report_wait_time(queue):
+    """Print how long the test spent waiting for events, and append it to
+    $IDLE_TEST_TIMINGS so run-test.sh can summarize the whole run."""
+    script = sys.argv[0]
+    base = os.environ.get('IDLE_TWISTED_PATH')
+    if base:
+        script = os.path.relpath(script, base)
+
+    print "%s: waited %.1f ms for %d events" % (script,
+        queue.wait_time * 1000.0, queue.waits)
+
+    timings = os.environ.get('IDLE_TEST_TIMINGS')
+    if timings:
+        f = open(timings, 'a')
+        f.write("%.1f %d %s\n" % (queue.wait_time * 1000.0, queue.waits,
+            script))
+        f.close()
+
+def report_metric(name, value, unit='ms'):
+    """Record a performance measurement. check-perf collects these through
+    $IDLE_PERF_RESULTS and compares them against perf/baseline."""
+    print "%s: %.1f %s" % (name, value, unit)
+
+    results = os.environ.get('IDLE_PERF_RESULTS')
+    if results:
+        f = open(results, 'a')
+        f.write("%s %.1f\n" % (name, value))
+        f.close()
+
+def cm_rss(bus, conn):
+    """Returns the resident set size of the connection manager, in kB."""
+    dbus_daemon = dbus.Interface(bus.get_object('org.freedesktop.DBus',
+        '/org/freedesktop/DBus'), 'org.freedesktop.DBus')
+    pid = dbus_daemon.GetConnectionUnixProcessID(
+        conn.object.bus_name)
+
+    for line in open('/proc/%d/status' % pid):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+
+    raise RuntimeError('no VmRSS for process %d' % pid)
+
 def exec_test_deferred (funs, params, protocol=None, timeout=None):
     colourer = None
 
@@ -238,6 +380,12 @@ def exec_test_deferred (funs, params, protocol=None, timeout=None):
     bus = dbus.SessionBus()
     # conn = make_connection(bus, queue.append, params)
     (server, port) = start_server(queue.append, protocol=protocol)
+    server_port = port.getHost().port
+
+    # tests which need to know where the server is (to name it as a fallback
+    # server, say) pass a function of the port instead
+    if callable(params):
+        params = params(server_port)
 
     bus.add_signal_receiver(
         lambda *args, **kw:
@@ -259,13 +407,15 @@ def exec_test_deferred (funs, params, protocol=None, timeout=None):
 
     try:
         for f in funs:
-            conn = make_connection(bus, queue.append, params)
+            conn = make_connection(bus, queue.append, params, server_port)
             f(queue, bus, conn, server)
     except Exception, e:
         import traceback
         traceback.print_exc()
         error = e
 
+    report_wait_time(queue)
+
     try:
         if colourer:
           sys.stdout = colourer.fh
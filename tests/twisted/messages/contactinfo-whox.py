@@ -0,0 +1,69 @@
+
+"""
+Test that members of a channel have their contact info answered from what
+WHOX told us after joining, without a WHOIS each.
+"""
+
+from idletest import exec_test, sync_stream, BaseIRCServer
+from servicetest import EventPattern, assertEquals, call_async
+from constants import *
+import dbus
+
+class WhoxServer(BaseIRCServer):
+    def sendWelcome(self):
+        BaseIRCServer.sendWelcome(self)
+        self.sendMessage('005', self.nick, 'WHOX', 'CHANTYPES=#',
+            ':are supported by this server', prefix='idle.test.server')
+
+    def handleJOIN(self, args, prefix):
+        room = args[0]
+        self.rooms.append(room)
+        self.sendJoin(room, ['alice'])
+
+    def handleWHO(self, args, prefix):
+        (mask, fields) = args[:2]
+        querytype = fields.split(',')[1]
+        self.sendMessage('354', self.nick, querytype, 'ally', 'wonder.land',
+            'alice', 'G', 'alice_account', ':Alice Liddell',
+            prefix='idle.test.server')
+        self.sendMessage('354', self.nick, querytype, self.user,
+            'idle.test.client', self.nick, 'H', '0', ':%s' % self.real_name,
+            prefix='idle.test.server')
+        self.sendMessage('315', self.nick, mask, ':End of /WHO list.',
+            prefix='idle.test.server')
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged', args=[0, 1])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+            { CHANNEL_TYPE: CHANNEL_TYPE_TEXT,
+               TARGET_HANDLE_TYPE: HT_ROOM,
+               TARGET_ID: '#idletest' })
+    q.expect('dbus-return', method='CreateChannel')
+
+    who = q.expect('stream-WHO')
+    assertEquals('#idletest', who.data[0])
+    assertEquals('%tnuhraf', who.data[1].split(',')[0])
+    sync_stream(q, stream)
+
+    alice = conn.RequestHandles(HT_CONTACT, ['alice'])[0]
+    contact_info = dbus.Interface(conn, CONN_IFACE_CONTACT_INFO)
+
+    forbidden = [EventPattern('stream-WHOIS')]
+    q.forbid_events(forbidden)
+
+    call_async(q, contact_info, 'RequestContactInfo', alice)
+    event = q.expect('dbus-return', method='RequestContactInfo')
+    vcard = dict((name, value) for (name, parameters, value) in event.value[0])
+
+    assertEquals(['Alice Liddell'], vcard['fn'])
+    assertEquals(['ally@wonder.land'], vcard['x-host'])
+    assertEquals(['alice_account'], vcard['nickname'])
+    assertEquals([str(PRESENCE_AWAY)], vcard['x-presence-type'])
+    assertEquals(['true'], vcard['x-irc-registered-nick'])
+
+    q.unforbid_events(forbidden)
+
+if __name__ == '__main__':
+    exec_test(test, protocol=WhoxServer)
@@ -0,0 +1,32 @@
+"""
+Test that Idle answers CTCP VERSION requests, but not so many of them that a
+flood of requests fills its output queue.
+"""
+
+from idletest import exec_test, sync_stream
+from servicetest import EventPattern, call_async, assertEquals
+import constants as cs
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    for i in range(10):
+        stream.sendMessage('PRIVMSG', stream.nick, ':\x01VERSION\x01',
+            prefix='alice')
+
+    for i in range(3):
+        e = q.expect('stream-NOTICE')
+        assertEquals('alice', e.data[0])
+        assert e.data[1].startswith('\x01VERSION telepathy-idle '), e.data
+
+    notice = [EventPattern('stream-NOTICE')]
+    q.forbid_events(notice)
+    sync_stream(q, stream)
+    q.unforbid_events(notice)
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test)
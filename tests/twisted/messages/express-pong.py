@@ -0,0 +1,58 @@
+"""
+Test that a PONG doesn't wait behind a long paste in the output queue.
+"""
+
+from idletest import exec_test, BaseIRCServer
+from servicetest import EventPattern, call_async, assertEquals
+from constants import *
+import dbus
+
+NUM_LINES = 50
+
+class OrderRecordingServer(BaseIRCServer):
+    def __init__(self, event_func):
+        BaseIRCServer.__init__(self, event_func)
+        self.order = []
+
+    def handlePRIVMSG(self, args, prefix):
+        self.order.append(args[1])
+
+    def handlePONG(self, args, prefix):
+        self.order.append('PONG')
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged', args=[0, 1])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+            { CHANNEL_TYPE: CHANNEL_TYPE_TEXT,
+              TARGET_HANDLE_TYPE: HT_ROOM,
+              TARGET_ID: '#paste' })
+    ret, _ = q.expect_many(
+        EventPattern('dbus-return', method='CreateChannel'),
+        EventPattern('dbus-signal', signal='MembersChanged'))
+    chan = dbus.Interface(bus.get_object(conn.bus_name, ret.value[0]),
+        CHANNEL_TYPE_TEXT)
+
+    call_async(q, chan, 'Send', 0,
+        '\n'.join([str(i) for i in range(NUM_LINES)]))
+
+    # once the paste has started going out, the server wants an answer
+    q.expect('stream-PRIVMSG', data=['#paste', '0'])
+    stream.sendMessage('PING', ':express')
+    q.expect('stream-PONG')
+
+    for i in range(1, NUM_LINES):
+        q.expect('stream-PRIVMSG', data=['#paste', str(i)])
+
+    # the PONG went out straight away, rather than after the rest of the
+    # paste; at most a line or two were already on their way
+    pong = stream.order.index('PONG')
+    assert pong <= 3, stream.order
+    assertEquals([str(i) for i in range(NUM_LINES)],
+        [line for line in stream.order if line != 'PONG'])
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test, protocol=OrderRecordingServer)
@@ -0,0 +1,52 @@
+
+"""
+Test that a long paste to one channel doesn't hold up messages to another.
+"""
+
+from idletest import exec_test
+from servicetest import EventPattern, call_async, assertEquals
+from constants import *
+import dbus
+
+def join(q, bus, conn, name):
+    call_async(q, conn.Requests, 'CreateChannel',
+            { CHANNEL_TYPE: CHANNEL_TYPE_TEXT,
+              TARGET_HANDLE_TYPE: HT_ROOM,
+              TARGET_ID: name })
+
+    ret = q.expect('dbus-return', method='CreateChannel')
+    q.expect('dbus-signal', signal='MembersChanged')
+    chan = bus.get_object(conn.bus_name, ret.value[0])
+
+    return dbus.Interface(chan, CHANNEL_TYPE_TEXT)
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged', args=[0, 1])
+
+    busy = join(q, bus, conn, '#busy')
+    quiet = join(q, bus, conn, '#quiet')
+
+    NUM_LINES = 10
+    paste = '\n'.join([str(i) for i in range(NUM_LINES)])
+    call_async(q, busy, 'Send', 0, paste)
+    call_async(q, quiet, 'Send', 0, 'hello')
+
+    received = []
+    for i in range(NUM_LINES + 1):
+        message = q.expect('stream-PRIVMSG')
+        received.append(message.data)
+
+    # lines to each channel stay in order...
+    assertEquals([['#busy', str(i)] for i in range(NUM_LINES)],
+        [m for m in received if m[0] == '#busy'])
+
+    # ...but the quiet channel takes its turn straight after the paste's first
+    # line, rather than waiting for the whole paste to go out. (The JOIN for
+    # #quiet has only just been sent, so neither line jumps the queue.)
+    assert received.index(['#quiet', 'hello']) <= 1, received
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test)
@@ -0,0 +1,78 @@
+"""
+Test that with im-channel-threshold set, a contact's private messages are kept
+back until they have sent that many, or a channel to them is requested, and
+that a channel closed with messages still unread is dropped after the
+unread-timeout.
+"""
+
+from idletest import exec_test, sync_stream
+from servicetest import EventPattern, call_async, assertEquals, \
+    make_channel_proxy
+import constants as cs
+import dbus
+
+def expect_received(q, texts):
+    for text in texts:
+        e = q.expect('dbus-signal', interface=cs.CHANNEL_TYPE_TEXT,
+            signal='Received')
+        assertEquals(text, e.args[5])
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    new_channels = [EventPattern('dbus-signal', signal='NewChannels')]
+    q.forbid_events(new_channels)
+
+    stream.sendMessage('PRIVMSG', stream.nick, ':buy stuff', prefix='spammer')
+    stream.sendMessage('PRIVMSG', stream.nick, ':hi', prefix='alice')
+    stream.sendMessage('PRIVMSG', stream.nick, ':are you there?',
+        prefix='alice')
+    sync_stream(q, stream)
+
+    q.unforbid_events(new_channels)
+
+    # Alice's third message gets her a channel, with all three in it
+    stream.sendMessage('PRIVMSG', stream.nick, ':hello?', prefix='alice')
+    e = q.expect('dbus-signal', signal='NewChannels')
+    alice_path, props = e.args[0][0]
+    assertEquals('alice', props[cs.TARGET_ID])
+    expect_received(q, ['hi', 'are you there?', 'hello?'])
+
+    # Asking for a channel to the spammer turns up what they said
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_CONTACT,
+        cs.TARGET_ID: 'spammer'})
+    path = q.expect('dbus-return', method='CreateChannel').value[0]
+    expect_received(q, ['buy stuff'])
+
+    # Closing it unread brings it straight back...
+    make_channel_proxy(conn, path, 'Channel').Close()
+    q.expect('dbus-signal', signal='ChannelClosed', args=[path])
+    q.expect('dbus-signal', signal='NewChannels')
+
+    # ...until nobody has read it for the unread-timeout. Alice's channel was
+    # never closed, so it stays.
+    alice_closed = [EventPattern('dbus-signal', signal='ChannelClosed',
+        args=[alice_path])]
+    q.forbid_events(alice_closed)
+    q.expect('dbus-signal', signal='ChannelClosed', args=[path])
+    q.unforbid_events(alice_closed)
+
+    call_async(q, conn.Requests, 'EnsureChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_CONTACT,
+        cs.TARGET_ID: 'spammer'})
+    yours, path, _ = q.expect('dbus-return', method='EnsureChannel').value
+    assert yours
+    pending = make_channel_proxy(conn, path, 'Channel.Type.Text') \
+        .ListPendingMessages(False)
+    assertEquals([], pending)
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test, params={'im-channel-threshold': dbus.UInt32(3),
+        'unread-timeout': dbus.UInt32(2)})
@@ -0,0 +1,57 @@
+"""
+Test that Idle stops reading from the server while too many received messages
+are waiting to be acknowledged, and starts again once enough of them have been.
+"""
+
+from idletest import exec_test
+from servicetest import EventPattern, call_async, assertEquals, sync_dbus
+import constants as cs
+import dbus
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#test'})
+
+    ret = q.expect('dbus-return', method='CreateChannel')
+    q.expect('dbus-signal', signal='MembersChanged')
+    chan = bus.get_object(conn.bus_name, ret.value[0])
+    text_chan = dbus.Interface(chan, cs.CHANNEL_TYPE_TEXT)
+
+    # Four pending messages reach the limit, so Idle stops reading...
+    for text in ['one', 'two', 'three', 'four']:
+        stream.sendMessage('PRIVMSG', '#test', ':%s' % text, prefix='alice')
+
+    ids = []
+    for i in range(4):
+        e = q.expect('dbus-signal', interface=cs.CHANNEL_TYPE_TEXT,
+            signal='Received')
+        ids.append(e.args[0])
+
+    # ...and doesn't see the server's PING, even once half of them have been
+    # acknowledged...
+    pong = [EventPattern('stream-PONG')]
+    q.forbid_events(pong)
+    stream.sendMessage('PING', 'backpressure')
+    sync_dbus(bus, q, conn)
+    text_chan.AcknowledgePendingMessages(ids[:2])
+    sync_dbus(bus, q, conn)
+    q.unforbid_events(pong)
+
+    # ...until a client has caught up to pending-resume-percent.
+    text_chan.AcknowledgePendingMessages(ids[2:3])
+    e = q.expect('stream-PONG')
+    assertEquals('backpressure', e.data[-1])
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test, params={
+        'max-pending-messages': dbus.UInt32(4),
+        'pending-resume-percent': dbus.UInt32(25),
+    })
@@ -0,0 +1,89 @@
+"""
+Test that when more than max-pending-in-memory messages are pending in a
+channel, the older ones, which are put on disk, are still announced straight
+away, and are all there whenever a client asks for pending messages.
+"""
+
+from idletest import exec_test, sync_stream
+from servicetest import call_async, assertEquals, assertLength
+import constants as cs
+import dbus
+
+TEXTS = ['one', 'two', 'three']
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#test'})
+
+    ret = q.expect('dbus-return', method='CreateChannel')
+    q.expect('dbus-signal', signal='MembersChanged')
+    chan = bus.get_object(conn.bus_name, ret.value[0])
+    text_chan = dbus.Interface(chan, cs.CHANNEL_TYPE_TEXT)
+    msg_chan = dbus.Interface(chan, cs.CHANNEL_IFACE_MESSAGES)
+
+    for text in TEXTS:
+        stream.sendMessage('PRIVMSG', '#test', ':%s' % text, prefix='alice')
+
+    # Nobody has to acknowledge anything for all three to be announced...
+    ids = []
+    for text in TEXTS:
+        e = q.expect('dbus-signal', interface=cs.CHANNEL_TYPE_TEXT,
+            signal='Received')
+        assertEquals(text, e.args[5])
+        ids.append(e.args[0])
+
+    sync_stream(q, stream)
+
+    # ...and the two oldest, which are only on disk, still have their text
+    # and headers when pending messages are listed, in either API...
+    pending = chan.Get(cs.CHANNEL_IFACE_MESSAGES, 'PendingMessages',
+        dbus_interface=cs.PROPERTIES_IFACE)
+    assertLength(3, pending)
+    assertEquals(TEXTS, [message[1]['content'] for message in pending])
+    assertEquals(ids,
+        [message[0]['pending-message-id'] for message in pending])
+    assertEquals(['alice'] * 3,
+        [message[0]['message-sender-id'] for message in pending])
+
+    pending = text_chan.ListPendingMessages(False)
+    assertEquals(TEXTS, [message[5] for message in pending])
+    assertEquals(ids, [message[0] for message in pending])
+
+    assertEquals({1: TEXTS[0]},
+        msg_chan.GetPendingMessageContent(ids[0], [1]))
+
+    # ...and after some of them have been acknowledged, in any order.
+    text_chan.AcknowledgePendingMessages(ids[1:2])
+    pending = chan.Get(cs.CHANNEL_IFACE_MESSAGES, 'PendingMessages',
+        dbus_interface=cs.PROPERTIES_IFACE)
+    assertEquals([TEXTS[0], TEXTS[2]],
+        [message[1]['content'] for message in pending])
+
+    text_chan.AcknowledgePendingMessages([ids[0], ids[2]])
+    assertEquals([], text_chan.ListPendingMessages(False))
+
+    # An acknowledged message can't be acknowledged again
+    call_async(q, text_chan, 'AcknowledgePendingMessages', ids[:1])
+    q.expect('dbus-error', method='AcknowledgePendingMessages',
+        name=cs.INVALID_ARGUMENT)
+
+    # Once everything on disk has gone, messages are put there afresh
+    for text in TEXTS:
+        stream.sendMessage('PRIVMSG', '#test', ':%s' % text, prefix='alice')
+        q.expect('dbus-signal', interface=cs.CHANNEL_TYPE_TEXT,
+            signal='Received')
+
+    pending = text_chan.ListPendingMessages(True)
+    assertEquals(TEXTS, [message[5] for message in pending])
+    assertEquals([], text_chan.ListPendingMessages(False))
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test, params={'max-pending-in-memory': dbus.UInt32(1)})
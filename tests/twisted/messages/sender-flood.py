@@ -0,0 +1,53 @@
+"""
+Test that once a contact has sent sender-flood-limit messages to a channel in
+quick succession, the rest arrive combined into one message, and that those
+which no longer fit are counted in a header rather than in the text.
+"""
+
+from idletest import exec_test
+from servicetest import EventPattern, call_async, assertEquals
+import constants as cs
+import dbus
+
+DROPPED = 'org.freedesktop.Telepathy.Idle.DroppedMessages'
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#test'})
+
+    q.expect('dbus-return', method='CreateChannel')
+    q.expect('dbus-signal', signal='MembersChanged')
+
+    for text in ['one', 'two', 'three', 'four', 'five']:
+        stream.sendMessage('PRIVMSG', '#test', ':%s' % text, prefix='alice')
+
+    # Combined text is capped at 4096 bytes: after 'three\nfour\nfive', ten
+    # more of these fit and the last five are only counted.
+    long_text = 'x' * 400
+    for i in range(15):
+        stream.sendMessage('PRIVMSG', '#test', ':%s' % long_text,
+            prefix='alice')
+
+    # Someone else is unaffected
+    stream.sendMessage('PRIVMSG', '#test', ':hello', prefix='bob')
+
+    combined = '\n'.join(['three', 'four', 'five'] + [long_text] * 10)
+
+    for text, dropped in [('one', None), ('two', None), ('hello', None),
+            (combined, 5)]:
+        e = q.expect('dbus-signal', interface=cs.CHANNEL_IFACE_MESSAGES,
+            signal='MessageReceived')
+        header, body = e.args[0]
+        assertEquals(text, body['content'])
+        assertEquals(dropped, header.get(DROPPED))
+
+    call_async(q, conn, 'Disconnect')
+
+if __name__ == '__main__':
+    exec_test(test, params={'sender-flood-limit': dbus.UInt32(2)})
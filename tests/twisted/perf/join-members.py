@@ -0,0 +1,42 @@
+"""
+Measure how long joining a 5000-member channel takes, from asking for the
+channel to seeing its members, and how big the connection manager is
+afterwards.
+"""
+
+import time
+
+from idletest import (exec_test, expect_members, member_nicks, report_metric,
+    cm_rss, BaseIRCServer)
+from servicetest import call_async, assertEquals
+import constants as cs
+
+MEMBERS = member_nicks(5000)
+
+class BusyServer(BaseIRCServer):
+    def handleJOIN(self, args, prefix):
+        room = args[0]
+        self.rooms.append(room)
+        self.sendTraffic(self.joinTraffic(room, MEMBERS))
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    start = time.time()
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#busy'})
+
+    # the clock stops once the NAMES reply's members are in, not at our own
+    # join, which comes first
+    members = expect_members(q, len(MEMBERS) + 1)
+    report_metric('join-5000-members', (time.time() - start) * 1000.0)
+    assertEquals(len(MEMBERS) + 1, len(members))
+
+    report_metric('rss-after-join', cm_rss(bus, conn), 'kB')
+
+if __name__ == '__main__':
+    exec_test(test, protocol=BusyServer)
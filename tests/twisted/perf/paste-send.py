@@ -0,0 +1,40 @@
+"""
+Measure how long a 1000-line paste takes to reach the server.
+"""
+
+import time
+
+import dbus
+
+from idletest import exec_test, report_metric
+from servicetest import EventPattern, call_async, assertEquals
+import constants as cs
+
+LINES = 1000
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#paste'})
+    ret, _ = q.expect_many(
+        EventPattern('dbus-return', method='CreateChannel'),
+        EventPattern('dbus-signal', signal='MembersChanged'))
+    chan = dbus.Interface(bus.get_object(conn.bus_name, ret.value[0]),
+        cs.CHANNEL_TYPE_TEXT)
+
+    paste = '\n'.join(['line %d of the paste' % i for i in xrange(LINES)])
+
+    start = time.time()
+    call_async(q, chan, 'Send', 0, paste)
+    for i in xrange(LINES):
+        e = q.expect('stream-PRIVMSG')
+        assertEquals(['#paste', 'line %d of the paste' % i], e.data)
+    report_metric('paste-1000-lines', (time.time() - start) * 1000.0)
+
+if __name__ == '__main__':
+    exec_test(test)
@@ -0,0 +1,42 @@
+"""
+Measure how long a message from the server takes to come out of the
+connection manager as a Received signal.
+"""
+
+import time
+
+from idletest import exec_test, sync_stream, report_metric
+from servicetest import EventPattern, call_async, assertEquals
+import constants as cs
+
+MESSAGES = 100
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#latency'})
+    q.expect_many(EventPattern('dbus-return', method='CreateChannel'),
+        EventPattern('dbus-signal', signal='MembersChanged'))
+    sync_stream(q, stream)
+
+    latencies = []
+    for i in xrange(MESSAGES):
+        text = 'message %d' % i
+        start = time.time()
+        stream.sendMessage('PRIVMSG', '#latency', ':%s' % text,
+            prefix='alice!alice@wonder.land')
+        e = q.expect('dbus-signal', signal='Received')
+        latencies.append((time.time() - start) * 1000.0)
+        assertEquals(text, e.args[5])
+
+    latencies.sort()
+    report_metric('privmsg-latency-median', latencies[len(latencies) / 2])
+    report_metric('privmsg-latency-max', latencies[-1])
+
+if __name__ == '__main__':
+    exec_test(test)
@@ -0,0 +1,148 @@
+"""
+Test that asking for contacts' presence tracks them with MONITOR, and with
+batched ISON polling once the MONITOR list is full, without mistaking the
+reply to somebody else's ISON for ours. Contacts stop being tracked once they
+leave the last channel we share with them, and only so many are polled.
+"""
+
+from idletest import exec_test, sync_stream, expect_members, BaseIRCServer
+from servicetest import EventPattern, assertEquals, assertContains, call_async
+import constants as cs
+
+ONLINE = ['brillana', 'miriam']
+
+# how many contacts Idle polls with ISON at most
+ISON_POLL_MAX = 100
+
+class MonitorServer(BaseIRCServer):
+    def sendWelcome(self):
+        BaseIRCServer.sendWelcome(self)
+        self.sendMessage('005', self.nick, 'MONITOR=1',
+            ':are supported by this server', prefix='idle.test.server')
+        self.monitored = 0
+
+    def handleJOIN(self, args, prefix):
+        room = args[0]
+        self.rooms.append(room)
+        self.sendJoin(room, list(ONLINE))
+
+    def handleMONITOR(self, args, prefix):
+        targets = args[1].split(',')
+
+        if args[0] == '-':
+            self.monitored -= len(targets)
+            return
+        full = targets[1 - self.monitored:]
+        targets = targets[:1 - self.monitored]
+        self.monitored += len(targets)
+
+        for target in targets:
+            if target in ONLINE:
+                self.sendMessage('730', self.nick, ':%s!x@y' % target,
+                    prefix='idle.test.server')
+            else:
+                self.sendMessage('731', self.nick, ':%s' % target,
+                    prefix='idle.test.server')
+
+        if full:
+            self.sendMessage('734', self.nick, '1', ','.join(full),
+                ':Monitor list is full.', prefix='idle.test.server')
+
+    def handleISON(self, args, prefix):
+        # first, the answer to a client's raw "ISON pat", which is not
+        # for Idle's presence tracking
+        self.sendMessage('303', self.nick, ':', prefix='idle.test.server')
+
+        online = [nick for nick in ' '.join(args).split()
+            if nick in ONLINE or nick == self.nick]
+        self.sendMessage('303', self.nick, ':%s' % ' '.join(online),
+            prefix='idle.test.server')
+
+def test(q, bus, conn, stream):
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged', args=[0, 1])
+
+    assertContains(cs.CONN_IFACE_SIMPLE_PRESENCE,
+        conn.Properties.Get(cs.CONN, "Interfaces"))
+
+    handles = conn.get_contact_handles_sync(['brillana', 'miriam', 'pat'])
+    brillana, miriam, pat = handles
+
+    attrs = conn.Contacts.GetContactAttributes(handles,
+        [cs.CONN_IFACE_SIMPLE_PRESENCE], False)
+    for handle in handles:
+        assertEquals((cs.PRESENCE_UNKNOWN, 'unknown', ''),
+            attrs[handle][cs.ATTR_PRESENCE])
+
+    # all three are asked about in a single line; one fits on the list, the
+    # other two are polled with one ISON
+    monitor = q.expect('stream-MONITOR')
+    assertEquals('+', monitor.data[0])
+    assertEquals(3, len(monitor.data[1].split(',')))
+
+    # we ask about ourselves too, to recognise the reply
+    ison = q.expect('stream-ISON')
+    nicks = ' '.join(ison.data).split()
+    assertEquals(3, len(nicks))
+    assertEquals(stream.nick, nicks[0])
+
+    seen = {}
+    while len(seen) < 3:
+        e = q.expect('dbus-signal', signal='PresencesChanged')
+        seen.update(e.args[0])
+
+    assertEquals(cs.PRESENCE_AVAILABLE, seen[brillana][0])
+    assertEquals(cs.PRESENCE_AVAILABLE, seen[miriam][0])
+    assertEquals(cs.PRESENCE_OFFLINE, seen[pat][0])
+
+    # brillana leaving the only channel we share stops us watching her...
+    call_async(q, conn.Requests, 'CreateChannel',
+        {cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: '#room'})
+    q.expect('dbus-return', method='CreateChannel')
+    expect_members(q, len(ONLINE) + 1)
+
+    stream.sendMessage('PART', '#room', prefix='brillana')
+    q.expect_many(
+        EventPattern('stream-MONITOR', data=['-', 'brillana']),
+        EventPattern('dbus-signal', signal='PresencesChanged',
+            args=[{brillana: (cs.PRESENCE_UNKNOWN, 'unknown', '')}]))
+
+    # ...and miriam quitting tells us she is offline, and stops it too
+    stream.sendMessage('QUIT', ':bye', prefix='miriam')
+    q.expect('dbus-signal', signal='PresencesChanged',
+        args=[{miriam: (cs.PRESENCE_OFFLINE, 'offline', '')}])
+
+    # Of lots more contacts, one takes brillana's place on the MONITOR list,
+    # and only as many as fit alongside pat are polled with ISON
+    others = conn.get_contact_handles_sync(
+        ['c%03d' % i for i in range(150)])
+    conn.Contacts.GetContactAttributes(others,
+        [cs.CONN_IFACE_SIMPLE_PRESENCE], False)
+
+    monitor = q.expect('stream-MONITOR')
+    assertEquals('+', monitor.data[0])
+    assertEquals(1, len(monitor.data[1].split(',')))
+
+    polled = []
+    while len(polled) < ISON_POLL_MAX - 1:
+        ison = q.expect('stream-ISON')
+        nicks = ' '.join(ison.data).split()
+        assertEquals(stream.nick, nicks[0])
+        polled += nicks[1:]
+
+    forbidden = [EventPattern('stream-ISON')]
+    q.forbid_events(forbidden)
+    sync_stream(q, stream)
+    q.unforbid_events(forbidden)
+    assertEquals(ISON_POLL_MAX - 1, len(polled))
+
+    # and our own presence is set with AWAY
+    call_async(q, conn.SimplePresence, 'SetPresence', 'away', 'biab')
+    q.expect_many(
+        EventPattern('stream-AWAY', data=['biab']),
+        EventPattern('dbus-return', method='SetPresence'))
+
+if __name__ == '__main__':
+    exec_test(test, protocol=MonitorServer)
@@ -0,0 +1,134 @@
+"""
+Play back traffic recorded by Idle with IDLE_RECORD_TRAFFIC set.
+
+A recording is RECORD_MAGIC followed by one record per chunk: a direction
+byte ('<' for what Idle received, '>' for what it sent), the microseconds
+since the previous chunk and the length of the chunk, both as 32-bit
+big-endian integers, and then the chunk itself.
+
+Run on its own, this listens for Idle to connect and feeds it everything the
+server sent in the recording, so a real-world burst can be profiled offline:
+
+    python replay.py idle-1234-0.irclog [--speed=N] [--port=N]
+
+--speed=10 plays ten times faster than recorded; --speed=0 sends everything
+at once.
+"""
+
+import struct
+import sys
+
+from twisted.internet import reactor
+import twisted.internet.protocol
+
+from idletest import BaseIRCServer, make_irc_event
+
+RECORD_MAGIC = 'IDLEREC1'
+RECEIVED = '<'
+SENT = '>'
+
+_header = struct.Struct('>cII')
+
+def read_log(filename):
+    """Yields (direction, delay in seconds, chunk) for each recorded chunk."""
+    f = open(filename, 'rb')
+
+    try:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError('%s is not a traffic recording' % filename)
+
+        while True:
+            header = f.read(_header.size)
+            if len(header) < _header.size:
+                break
+
+            (direction, delay, length) = _header.unpack(header)
+            chunk = f.read(length)
+            if len(chunk) < length:
+                break
+
+            yield (direction, delay / 1e6, chunk)
+    finally:
+        f.close()
+
+def write_log(filename, records):
+    """Writes (direction, delay in seconds, chunk) records in the same
+    format, to make recordings for tests."""
+    f = open(filename, 'wb')
+    f.write(RECORD_MAGIC)
+
+    for (direction, delay, chunk) in records:
+        f.write(_header.pack(direction, int(delay * 1e6), len(chunk)))
+        f.write(chunk)
+
+    f.close()
+
+class ReplayIRCServer(BaseIRCServer):
+    """Sends what the server sent in a recording, with the recorded timing
+    divided by speed (or all at once if speed is 0), whatever Idle says. What
+    Idle sends still shows up as stream-* events."""
+
+    def __init__(self, event_func, filename, speed=1.0):
+        BaseIRCServer.__init__(self, event_func)
+        self.records = list(read_log(filename))
+        self.speed = speed
+
+    def connectionMade(self):
+        BaseIRCServer.connectionMade(self)
+
+        at = 0.0
+        for (direction, delay, chunk) in self.records:
+            if self.speed:
+                at += delay / self.speed
+
+            if direction != RECEIVED:
+                continue
+
+            if at > 0:
+                reactor.callLater(at, self.transport.write, chunk)
+            else:
+                self.transport.write(chunk)
+
+    def handleCommand(self, command, prefix, params):
+        self.event_func(make_irc_event('stream-%s' % command, params))
+
+        # still hang up when asked to, so that Disconnect doesn't time out
+        if command == 'QUIT':
+            self.handleQUIT(params, prefix)
+
+def replay_server(filename, speed=1.0):
+    """For exec_test's protocol argument."""
+    return lambda event_func: ReplayIRCServer(event_func, filename, speed)
+
+def main(argv):
+    speed = 1.0
+    port = 6667
+    args = []
+
+    for arg in argv:
+        if arg.startswith('--speed='):
+            speed = float(arg[len('--speed='):])
+        elif arg.startswith('--port='):
+            port = int(arg[len('--port='):])
+        else:
+            args.append(arg)
+
+    if len(args) != 1:
+        print >> sys.stderr, __doc__.strip()
+        return 2
+
+    def event_func(event):
+        if event.type.startswith('stream-'):
+            print '%s %s' % (event.type[len('stream-'):], ' '.join(event.data))
+
+    server = ReplayIRCServer(event_func, args[0], speed)
+    factory = twisted.internet.protocol.Factory()
+    factory.protocol = lambda *args: server
+    server.listen(port, factory)
+    print 'replaying %d chunks on port %d' % (len(server.records), port)
+
+    reactor.run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -12,12 +12,13 @@ import os
 
 import pprint
 import unittest
+from collections import deque
 
 import dbus
 from dbus.mainloop.glib import DBusGMainLoop
 DBusGMainLoop(set_as_default=True)
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 
 import constants as cs
 
@@ -121,6 +122,10 @@ class BaseEventQueue:
     def __init__(self, timeout=None):
         self.verbose = False
         self.forbidden_events = set()
+        # event type => forbidden patterns for that type, so that checking an
+        # event does not try every forbidden pattern
+        self.forbidden_by_type = {}
+        # subqueue => deque of events, in the order they arrived
         self.event_queues = {}
 
         if timeout is None:
@@ -147,7 +152,9 @@ class BaseEventQueue:
         events. If a forbidden event occurs during an expect or expect_many,
         the test will fail.
         """
-        self.forbidden_events.update(set(patterns))
+        for pattern in patterns:
+            self.forbidden_events.add(pattern)
+            self.forbidden_by_type.setdefault(pattern.type, set()).add(pattern)
 
     def unforbid_events(self, patterns):
         """
@@ -155,16 +162,24 @@ class BaseEventQueue:
         forbidden events. These must be the same EventPattern pointers that
         were passed to forbid_events.
         """
-        self.forbidden_events.difference_update(set(patterns))
+        for pattern in patterns:
+            self.forbidden_events.discard(pattern)
+
+            same_type = self.forbidden_by_type.get(pattern.type)
+            if same_type is not None:
+                same_type.discard(pattern)
+                if not same_type:
+                    del self.forbidden_by_type[pattern.type]
 
     def unforbid_all(self):
         """
         Remove all patterns from the set of forbidden events.
         """
         self.forbidden_events.clear()
+        self.forbidden_by_type.clear()
 
     def _check_forbidden(self, event):
-        for e in self.forbidden_events:
+        for e in self.forbidden_by_type.get(event.type, ()):
             if e.match(event):
                 raise ForbiddenEventOccurred(event)
 
@@ -223,12 +238,16 @@ class BaseEventQueue:
         ret = [None] * len(patterns)
         t = time.time()
 
-        while None in ret:
+        # event type => indices of the patterns still waiting for one, in
+        # order, so each event is only matched against patterns of its type
+        waiting = {}
+        for i, pattern in enumerate(patterns):
+            waiting.setdefault(pattern.type, []).append(i)
+
+        while waiting:
             try:
-                queues = set()
-                for i, pattern in enumerate(patterns):
-                    if ret[i] is None:
-                        queues.add(pattern.subqueue)
+                queues = set(patterns[indices[0]].subqueue
+                             for indices in waiting.itervalues())
                 event = self.wait(queues)
             except TimeoutError:
                 self.log('timeout')
@@ -239,12 +258,16 @@ class BaseEventQueue:
                 raise
             self._check_forbidden(event)
 
-            for i, pattern in enumerate(patterns):
-                if ret[i] is None and pattern.match(event):
+            indices = waiting.get(event.type, [])
+            for j, i in enumerate(indices):
+                if patterns[i].match(event):
                     self.log('handled, took %0.3f ms'
                         % ((time.time() - t) * 1000.0) )
                     self.log('')
                     ret[i] = event
+                    del indices[j]
+                    if not indices:
+                        del waiting[event.type]
                     break
             else:
                 self.log('not handled')
@@ -275,38 +298,72 @@ class BaseEventQueue:
 
     def pop_next(self, queue):
         events = self.event_queues[queue]
-        e = events.pop(0)
+        e = events.popleft()
         if not events:
-           self.event_queues.pop (queue)
+           del self.event_queues[queue]
         return e
 
     def append(self, event):
         self.log ("Adding to queue")
         self.log_event (event)
-        self.event_queues[event.subqueue] = \
-            self.event_queues.get(event.subqueue, []) + [event]
+
+        events = self.event_queues.get(event.subqueue)
+        if events is None:
+            events = self.event_queues[event.subqueue] = deque()
+        events.append(event)
 
 class IteratingEventQueue(BaseEventQueue):
-    """Event queue that works by iterating the Twisted reactor."""
+    """Event queue that works by iterating the Twisted reactor.
+
+    While waiting, appending an event (or the timeout) fires a Deferred, so
+    wait() returns as soon as the reactor has dispatched the event rather
+    than on the next poll. The total time spent waiting is kept in wait_time.
+    """
 
     def __init__(self, timeout=None):
         BaseEventQueue.__init__(self, timeout)
+        self.waiter = None
+        self.wait_time = 0.0
+        self.waits = 0
+
+    def _wake(self):
+        waiter, self.waiter = self.waiter, None
+
+        if waiter is not None:
+            waiter.callback(None)
+
+    def append(self, event):
+        BaseEventQueue.append(self, event)
+        self._wake()
 
     def wait(self, queues=None):
         stop = [False]
 
         def later():
             stop[0] = True
+            self._wake()
 
         delayed_call = reactor.callLater(self.timeout, later)
 
         self.log_queues(queues)
+        started = time.time()
 
         qa = self.queues_available(queues)
         while not qa and (not stop[0]):
-            reactor.iterate(0.01)
+            woken = []
+            self.waiter = defer.Deferred()
+            self.waiter.addCallback(woken.append)
+
+            # blocks until something is dispatched; only appends and the
+            # timeout fire the waiter
+            while not woken:
+                reactor.iterate(self.timeout)
+
             qa = self.queues_available(queues)
 
+        self.wait_time += time.time() - started
+        self.waits += 1
+
         if qa:
             delayed_call.cancel()
             e = self.pop_next (qa[0])
@@ -387,6 +444,17 @@ class EventQueueTest(unittest.TestCase):
         queue = TestEventQueue([Event('test-foo'), Event('test-bar')])
         self.assertRaises(RuntimeError, queue.demand, 'test-bar')
 
+    def test_forbidden(self):
+        queue = TestEventQueue([Event('test-foo', x=1), Event('test-bar'),
+            Event('test-foo', x=2)])
+        forbidden = [EventPattern('test-foo', x=2)]
+        queue.forbid_events(forbidden)
+        assertEquals(1, queue.expect('test-foo').x)
+        self.assertRaises(ForbiddenEventOccurred, queue.expect, 'test-foo')
+
+        queue.unforbid_events(forbidden)
+        assertEquals({}, queue.forbidden_by_type)
+
 def unwrap(x):
     """Hack to unwrap D-Bus values, so that they're easier to read when
     printed."""
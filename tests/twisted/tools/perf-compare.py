@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Compare the measurements from a check-perf run against the baselines.
+
+usage: perf-compare.py BASELINE RESULTS [--update]
+
+BASELINE has one "metric baseline tolerance" line per metric, tolerance being
+a percentage; RESULTS has one "metric value" line per measurement. Every
+metric is lower-is-better. Exits with status 1 if any measurement is over its
+budget, or if a baselined metric was not measured at all. With --update,
+BASELINE is rewritten with the new measurements, keeping its comments and
+tolerances.
+"""
+
+import sys
+
+def read_pairs(filename):
+    for line in open(filename):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line.split()
+
+def main(baseline_file, results_file, update=False):
+    baselines = {}
+    order = []
+    for (name, value, tolerance) in read_pairs(baseline_file):
+        baselines[name] = (float(value), float(tolerance))
+        order.append(name)
+
+    results = {}
+    for (name, value) in read_pairs(results_file):
+        # if a metric is somehow measured twice, judge the worse one
+        results[name] = max(float(value), results.get(name, 0.0))
+
+    if update:
+        lines = []
+        for line in open(baseline_file):
+            fields = line.split()
+            if fields and not line.startswith('#') and fields[0] in results:
+                line = '%-25s %-9g %s\n' % (fields[0],
+                    results[fields[0]], fields[2])
+            lines.append(line)
+        open(baseline_file, 'w').writelines(lines)
+        return 0
+
+    failed = False
+    for name in order:
+        (baseline, tolerance) = baselines[name]
+        budget = baseline * (1 + tolerance / 100)
+
+        if name not in results:
+            print "MISSING: %s" % name
+            failed = True
+            continue
+
+        value = results[name]
+        if value > budget:
+            verdict = 'REGRESSION'
+            failed = True
+        else:
+            verdict = 'ok'
+
+        print "%-12s %-25s %10.1f (baseline %.1f, budget %.1f)" % (
+            verdict + ':', name, value, baseline, budget)
+
+    for name in sorted(set(results) - set(baselines)):
+        print "%-12s %-25s %10.1f (no baseline)" % ('new:', name,
+            results[name])
+
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--update']
+    if len(args) != 2:
+        print >> sys.stderr, __doc__.strip()
+        sys.exit(2)
+
+    sys.exit(main(args[0], args[1], '--update' in sys.argv))
@@ -24,7 +24,8 @@
 
 import sys
 import os.path
-import xml.dom.minidom
+import hashlib
+import xml.sax
 
 from libtpcodegen import file_set_contents
 from libglibcodegen import Signature, type_to_gtype, cmp_by_name, \
@@ -43,6 +44,105 @@ def get_emits_changed(node):
     except IndexError:
         return None
 
+# The only parts of the spec this generator looks at. Everything else
+# (docstrings, tp:mapping, tp:enum...) is skipped while parsing, with its
+# children hoisted into the nearest interesting ancestor.
+INTERESTING = frozenset(['node', 'interface', 'method', 'signal', 'property',
+                         'arg', 'annotation'])
+
+class _AttributeNode(object):
+    def __init__(self, value):
+        self.nodeValue = value
+
+class _Element(object):
+    """Just enough of a DOM element for this generator: attributes looked
+    up by qualified name, and descendants by tag name in document order."""
+
+    def __init__(self, name, attrs):
+        self.tagName = name
+        self._attrs = attrs
+        self._descendants = []
+
+    def getAttribute(self, name):
+        return self._attrs.get(name, '')
+
+    def getAttributeNode(self, name):
+        if name not in self._attrs:
+            return None
+        return _AttributeNode(self._attrs[name])
+
+    def getElementsByTagName(self, name):
+        return [e for e in self._descendants if e.tagName == name]
+
+class _TreeBuilder(xml.sax.handler.ContentHandler):
+    def __init__(self):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.root = _Element(None, {})
+        self._open = [self.root]
+        self._depth = []
+
+    def startElement(self, name, attrs):
+        if name not in INTERESTING:
+            self._depth.append(False)
+            return
+
+        element = _Element(name, dict(attrs.items()))
+        for ancestor in self._open:
+            ancestor._descendants.append(element)
+        self._open.append(element)
+        self._depth.append(True)
+
+    def endElement(self, name):
+        if self._depth.pop():
+            self._open.pop()
+
+def parse(filename):
+    """Build the cut-down tree for filename in a single SAX pass, without
+    keeping character data or uninteresting elements around."""
+    builder = _TreeBuilder()
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, False)
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(builder)
+    parser.parse(filename)
+    return builder.root
+
+def output_files(basename):
+    return [basename + '.h', basename + '.c', basename + '-gtk-doc.h']
+
+def input_hash(xmlfile, args):
+    """Hash everything that can change the output: the spec, the command
+    line, and the source of this generator and its libraries."""
+    h = hashlib.sha1()
+    h.update('\0'.join(args))
+    tools = os.path.dirname(os.path.abspath(__file__))
+    for path in [xmlfile, os.path.abspath(__file__),
+                 os.path.join(tools, 'libtpcodegen.py'),
+                 os.path.join(tools, 'libglibcodegen.py')]:
+        h.update('\0')
+        h.update(open(path, 'rb').read())
+    return h.hexdigest()
+
+def up_to_date(basename, digest):
+    try:
+        old = open(basename + '.hash').read().strip()
+    except IOError:
+        return False
+
+    return old == digest and all(os.path.exists(f)
+                                 for f in output_files(basename))
+
+def file_set_contents_if_changed(filename, contents):
+    """Like file_set_contents(), but leaves the file, and so its timestamp,
+    alone if it already holds contents; then make doesn't recompile it."""
+    try:
+        if open(filename, 'rb').read() == contents:
+            return
+    except IOError:
+        pass
+
+    file_set_contents(filename, contents)
+
 class Generator(object):
 
     def __init__(self, dom, prefix, basename, signal_marshal_prefix,
@@ -763,9 +863,12 @@ class Generator(object):
 
         self.h('')
         self.b('')
-        file_set_contents(self.basename + '.h', '\n'.join(self.__header))
-        file_set_contents(self.basename + '.c', '\n'.join(self.__body))
-        file_set_contents(self.basename + '-gtk-doc.h', '\n'.join(self.__docs))
+        file_set_contents_if_changed(self.basename + '.h',
+                                     '\n'.join(self.__header))
+        file_set_contents_if_changed(self.basename + '.c',
+                                     '\n'.join(self.__body))
+        file_set_contents_if_changed(self.basename + '-gtk-doc.h',
+                                     '\n'.join(self.__docs))
 
 def cmdline_error():
     print """\
@@ -832,9 +935,19 @@ if __name__ == '__main__':
             allow_havoc = True
 
     try:
-        dom = xml.dom.minidom.parse(argv[0])
+        xmlfile = argv[0]
     except IndexError:
         cmdline_error()
 
+    # Skip regenerating altogether when only the timestamp of the spec
+    # changed; the outputs are left as they are either way.
+    digest = input_hash(xmlfile, sys.argv[1:])
+    if up_to_date(basename, digest):
+        sys.exit(0)
+
+    dom = parse(xmlfile)
+
     Generator(dom, prefix, basename, signal_marshal_prefix, headers,
               end_headers, not_implemented_func, allow_havoc)()
+
+    file_set_contents(basename + '.hash', digest + '\n')